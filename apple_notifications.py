@@ -0,0 +1,201 @@
+"""
+Local verification of App Store Server Notifications V2.
+
+Apple signs each notification, and the transaction / renewal info inside it,
+as an ES256 JWS. The x5c header carries the leaf certificate, the Apple
+Worldwide Developer Relations intermediate and Apple Root CA - G3. The chain
+and the signatures are checked with the cryptography package:
+- the root must match a pinned SHA-256 fingerprint
+- chains that already passed verification are cached, with the leaf's
+  public key, until the first certificate in them expires, so a repeat
+  notification costs one P-256 signature check per JWS
+"""
+
+import base64
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+
+logger = logging.getLogger('apple_notifications')
+
+# SHA-256 of the DER encoding of Apple Root CA - G3
+APPLE_ROOT_CA_G3_SHA256 = "63343abfb89a6a03ebb57e9b3f5fa7be7c4f5c756f3017b3a8c488c3653e9179"
+
+# Marker extensions Apple puts on the App Store signing leaf and the WWDR intermediate
+_OID_APP_STORE_LEAF_MARKER = "1.2.840.113635.100.6.11.1"
+_OID_WWDR_INTERMEDIATE_MARKER = "1.2.840.113635.100.6.2.1"
+
+
+class InvalidNotificationError(ValueError):
+    """The signed payload is malformed, untrusted or for another app."""
+
+
+def _b64url_decode(segment):
+    try:
+        return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+    except (ValueError, TypeError):
+        raise InvalidNotificationError("JWS segment is not valid base64url")
+
+
+class _Certificate:
+    """
+    The parts of an X.509 certificate that chain verification needs.
+    """
+
+    def __init__(self, der):
+        try:
+            self.certificate = x509.load_der_x509_certificate(der)
+            extensions = self.certificate.extensions
+        except (ValueError, x509.DuplicateExtension):
+            raise InvalidNotificationError("Malformed certificate")
+        self.fingerprint = self.certificate.fingerprint(hashes.SHA256()).hex()
+        self.not_before = self.certificate.not_valid_before_utc.timestamp()
+        self.not_after = self.certificate.not_valid_after_utc.timestamp()
+        self.extension_oids = {extension.oid.dotted_string for extension in extensions}
+        try:
+            self.is_ca = extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+        except x509.ExtensionNotFound:
+            self.is_ca = False
+
+    def public_key(self):
+        return self.certificate.public_key()
+
+    def valid_at(self, now, skew):
+        return self.not_before - skew <= now <= self.not_after + skew
+
+    def signed_by(self, issuer):
+        try:
+            self.certificate.verify_directly_issued_by(issuer.certificate)
+        except (ValueError, TypeError, InvalidSignature):
+            return False
+        return True
+
+
+class AppleNotificationVerifier:
+    """
+    Verifies App Store Server Notifications V2 for one bundle ID.
+
+    decode_notification() returns the notification payload with
+    data.transactionInfo / data.renewalInfo decoded from their own JWS, or
+    raises InvalidNotificationError.
+    """
+
+    def __init__(self, bundle_id, trusted_root_fingerprints=(APPLE_ROOT_CA_G3_SHA256,),
+                 chain_cache_size=64, clock_skew_seconds=60):
+        self.bundle_id = bundle_id
+        self.trusted_root_fingerprints = frozenset(f.lower().replace(':', '') for f in trusted_root_fingerprints)
+        self.chain_cache_size = chain_cache_size
+        self.clock_skew_seconds = clock_skew_seconds
+
+        self._chains = OrderedDict()    # (leaf, intermediate, root) x5c strings -> (expires_at, leaf key)
+        self._chains_lock = threading.Lock()
+
+    def decode_notification(self, signed_payload):
+        payload = self.verify_jws(signed_payload)
+
+        data = payload.get('data')
+        if not isinstance(data, dict):
+            # TEST and summary notifications carry no app data to check
+            return payload
+        if data.get('bundleId') != self.bundle_id:
+            raise InvalidNotificationError("Notification is for another bundle ID")
+
+        for signed_key, key in (('signedTransactionInfo', 'transactionInfo'),
+                                ('signedRenewalInfo', 'renewalInfo')):
+            if data.get(signed_key):
+                data[key] = self.verify_jws(data[signed_key])
+        transaction = data.get('transactionInfo')
+        if transaction and transaction.get('bundleId', self.bundle_id) != self.bundle_id:
+            raise InvalidNotificationError("Transaction is for another bundle ID")
+        return payload
+
+    def verify_jws(self, jws):
+        if not isinstance(jws, str):
+            raise InvalidNotificationError("JWS must be a string")
+        parts = jws.split('.')
+        if len(parts) != 3:
+            raise InvalidNotificationError("JWS must have three segments")
+
+        try:
+            header = json.loads(_b64url_decode(parts[0]))
+            payload = json.loads(_b64url_decode(parts[1]))
+        except ValueError:
+            raise InvalidNotificationError("JWS segments are not valid JSON")
+        if not isinstance(header, dict) or not isinstance(payload, dict):
+            raise InvalidNotificationError("JWS segments are not JSON objects")
+        if header.get('alg') != 'ES256':
+            raise InvalidNotificationError("Unexpected JWS algorithm")
+
+        public_key = self._verified_leaf_key(header.get('x5c'))
+
+        signature = _b64url_decode(parts[2])
+        if len(signature) != 64:
+            raise InvalidNotificationError("Bad JWS signature length")
+        # JWS carries r || s; cryptography takes the DER Ecdsa-Sig-Value
+        r = int.from_bytes(signature[:32], 'big')
+        s = int.from_bytes(signature[32:], 'big')
+        try:
+            public_key.verify(encode_dss_signature(r, s), (parts[0] + '.' + parts[1]).encode('ascii'),
+                              ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature:
+            raise InvalidNotificationError("Invalid JWS signature")
+        return payload
+
+    def _verified_leaf_key(self, x5c):
+        if not isinstance(x5c, list) or len(x5c) != 3 or not all(isinstance(c, str) for c in x5c):
+            raise InvalidNotificationError("x5c must hold leaf, intermediate and root")
+
+        key = tuple(x5c)
+        now = time.time()
+        with self._chains_lock:
+            entry = self._chains.get(key)
+            if entry is not None and now <= entry[0]:
+                self._chains.move_to_end(key)
+                return entry[1]
+
+        public_key, expires_at = self._verify_chain(x5c, now)
+
+        with self._chains_lock:
+            self._chains[key] = (expires_at, public_key)
+            self._chains.move_to_end(key)
+            while len(self._chains) > self.chain_cache_size:
+                self._chains.popitem(last=False)
+        return public_key
+
+    def _verify_chain(self, x5c, now):
+        try:
+            ders = [base64.b64decode(c, validate=True) for c in x5c]
+        except ValueError:
+            raise InvalidNotificationError("x5c certificate is not valid base64")
+        leaf, intermediate, root = (_Certificate(der) for der in ders)
+
+        if root.fingerprint not in self.trusted_root_fingerprints:
+            raise InvalidNotificationError("Untrusted root certificate")
+        for certificate in (leaf, intermediate, root):
+            if not certificate.valid_at(now, self.clock_skew_seconds):
+                raise InvalidNotificationError("Certificate is expired or not yet valid")
+
+        if not intermediate.is_ca or _OID_WWDR_INTERMEDIATE_MARKER not in intermediate.extension_oids:
+            raise InvalidNotificationError("Intermediate is not an Apple WWDR CA")
+        if _OID_APP_STORE_LEAF_MARKER not in leaf.extension_oids:
+            raise InvalidNotificationError("Leaf is not an App Store signing certificate")
+
+        if not intermediate.signed_by(root):
+            raise InvalidNotificationError("Intermediate certificate not signed by root")
+        if not leaf.signed_by(intermediate):
+            raise InvalidNotificationError("Leaf certificate not signed by intermediate")
+
+        public_key = leaf.public_key()
+        if not isinstance(public_key, ec.EllipticCurvePublicKey) or public_key.curve.name != 'secp256r1':
+            raise InvalidNotificationError("ES256 requires a P-256 signing key")
+
+        logger.info("Verified App Store signing chain", extra={'leaf': leaf.fingerprint[:16]})
+        return public_key, min(leaf.not_after, intermediate.not_after, root.not_after)
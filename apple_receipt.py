@@ -0,0 +1,222 @@
+"""
+Offline decoding of App Store receipts (the base64 appStoreReceiptURL data).
+
+A receipt is a PKCS#7 SignedData container whose content is a SET of
+receipt attributes (type, version, value). decode_receipt() reads just
+enough of it to turn away receipts Apple would reject anyway, before a
+verifyReceipt round trip: malformed base64 and bad ASN.1 raise
+InvalidReceiptError, and the bundle ID is returned for the caller to check.
+It also returns the first original_transaction_id found among the in-app
+purchases, which is stable across renewals and so usable as a routing and
+lookup key.
+
+The signature is NOT checked here; Apple's answer stays the only verdict
+that can grant premium. Current receipts use BER with indefinite lengths,
+so the reader accepts those as well as DER.
+"""
+
+import base64
+import binascii
+from collections import namedtuple
+
+# Receipt attribute types (Apple's "Receipt Fields")
+BUNDLE_ID_ATTRIBUTE = 2
+IN_APP_ATTRIBUTE = 17
+ORIGINAL_TRANSACTION_ID_ATTRIBUTE = 1705
+
+# DER content octets of the PKCS#7 signedData and data OIDs
+_OID_PKCS7_SIGNED_DATA = bytes.fromhex('2a864886f70d010702')
+_OID_PKCS7_DATA = bytes.fromhex('2a864886f70d010701')
+
+_MAX_DEPTH = 32     # Nesting limit for indefinite lengths and constructed strings
+
+ReceiptInfo = namedtuple('ReceiptInfo', ['bundle_id', 'original_transaction_id'])
+
+
+class InvalidReceiptError(ValueError):
+    """The receipt is not a decodable App Store receipt."""
+
+
+def decode_receipt(receipt):
+    """
+    Decode a base64 receipt (str or bytes) into a ReceiptInfo.
+    Raises InvalidReceiptError if it is malformed.
+    """
+    if isinstance(receipt, str):
+        receipt = receipt.encode()
+    try:
+        data = base64.b64decode(receipt, validate=True)
+    except binascii.Error:
+        try:
+            # Line-wrapped base64 is still base64
+            data = base64.b64decode(b''.join(receipt.split()), validate=True)
+        except binascii.Error:
+            raise InvalidReceiptError("Receipt is not valid base64")
+    if not data:
+        raise InvalidReceiptError("Receipt is empty")
+
+    return _read_attributes(_signed_content(memoryview(data)))
+
+
+def _signed_content(data):
+    """
+    The encapsulated content of a PKCS#7 SignedData ContentInfo.
+    """
+    tag, start, end, _ = _ber_element(data, 0, len(data))
+    if tag != 0x30:
+        raise InvalidReceiptError("Receipt is not a PKCS#7 container")
+    children = _ber_children(data, start, end)
+    if len(children) < 2:
+        raise InvalidReceiptError("Receipt is not PKCS#7 signed data")
+    content_type, explicit = children[:2]
+    if content_type[0] != 0x06 or data[content_type[1]:content_type[2]] != _OID_PKCS7_SIGNED_DATA:
+        raise InvalidReceiptError("Receipt is not PKCS#7 signed data")
+    signed_data = _only_child(data, explicit, 0xa0, 0x30)
+
+    # SignedData: version, digestAlgorithms, encapContentInfo, ...
+    fields = _ber_children(data, signed_data[1], signed_data[2])
+    if len(fields) < 3 or fields[2][0] != 0x30:
+        raise InvalidReceiptError("Malformed PKCS#7 signed data")
+    encapsulated = _ber_children(data, fields[2][1], fields[2][2])
+    if (len(encapsulated) != 2 or encapsulated[0][0] != 0x06
+            or data[encapsulated[0][1]:encapsulated[0][2]] != _OID_PKCS7_DATA):
+        raise InvalidReceiptError("Receipt has no signed content")
+    return _octet_string(data, _only_child(data, encapsulated[1], 0xa0))
+
+
+def _read_attributes(payload):
+    bundle_id = None
+    original_transaction_id = None
+
+    for attribute_type, value in _receipt_attributes(payload, (BUNDLE_ID_ATTRIBUTE, IN_APP_ATTRIBUTE)):
+        if attribute_type == BUNDLE_ID_ATTRIBUTE:
+            bundle_id = _string_value(value)
+        elif original_transaction_id is None:
+            for _, in_app_value in _receipt_attributes(value, (ORIGINAL_TRANSACTION_ID_ATTRIBUTE,)):
+                original_transaction_id = _string_value(in_app_value) or None
+                break
+        if bundle_id and original_transaction_id:
+            # A long purchase history doesn't need to be walked any further
+            break
+
+    if not bundle_id:
+        raise InvalidReceiptError("Receipt has no bundle ID")
+    return ReceiptInfo(bundle_id, original_transaction_id)
+
+
+def _receipt_attributes(data, wanted):
+    """
+    Yields (type, value bytes) for the attributes in a SET of
+    ReceiptAttribute whose type is in wanted. Other attributes are
+    skipped after reading their type.
+    """
+    tag, offset, end, _ = _ber_element(data, 0, len(data))
+    if tag != 0x31:
+        raise InvalidReceiptError("Receipt payload is not an attribute set")
+    while offset < end:
+        tag, start, stop, offset = _ber_element(data, offset, end)
+        if tag != 0x30:
+            raise InvalidReceiptError("Malformed receipt attribute")
+        type_tag, type_start, type_end, field = _ber_element(data, start, stop)
+        if type_tag != 0x02:
+            raise InvalidReceiptError("Malformed receipt attribute")
+        attribute_type = int.from_bytes(data[type_start:type_end], 'big', signed=True)
+        if attribute_type not in wanted:
+            continue
+
+        version_tag, _, _, field = _ber_element(data, field, stop)
+        value = _ber_element(data, field, stop)
+        if version_tag != 0x02 or value[0] not in (0x04, 0x24) or value[3] != stop:
+            raise InvalidReceiptError("Malformed receipt attribute")
+        yield attribute_type, _octet_string(data, value)
+
+
+def _string_value(value):
+    """
+    The text of a UTF8String / IA5String wrapped in an attribute value.
+    """
+    tag, start, end, _ = _ber_element(value, 0, len(value))
+    if tag not in (0x0c, 0x16):
+        raise InvalidReceiptError("Malformed receipt string")
+    try:
+        return bytes(value[start:end]).decode('utf-8')
+    except UnicodeDecodeError:
+        raise InvalidReceiptError("Malformed receipt string")
+
+
+def _only_child(data, element, expected_tag, child_tag=None):
+    """
+    The single element inside an explicitly tagged element.
+    """
+    tag, start, end = element[:3]
+    if tag != expected_tag:
+        raise InvalidReceiptError("Malformed PKCS#7 signed data")
+    children = _ber_children(data, start, end)
+    if len(children) != 1 or (child_tag is not None and children[0][0] != child_tag):
+        raise InvalidReceiptError("Malformed PKCS#7 signed data")
+    return children[0]
+
+
+def _octet_string(data, element, depth=0):
+    """
+    Contents of an OCTET STRING, joining the segments of a constructed one.
+    """
+    tag, start, end = element[:3]
+    if tag == 0x04:
+        return data[start:end]
+    if tag != 0x24 or depth >= _MAX_DEPTH:
+        raise InvalidReceiptError("Expected an OCTET STRING")
+    return b''.join(
+        bytes(_octet_string(data, child, depth + 1)) for child in _ber_children(data, start, end)
+    )
+
+
+# Minimal BER reader (definite and indefinite lengths, low tag numbers only)
+
+def _ber_element(data, offset, limit, depth=0):
+    """
+    Returns (tag, value_start, value_end, next_offset) of the TLV at offset.
+    For an indefinite length, value_end is where its end-of-contents starts.
+    """
+    if offset + 2 > limit:
+        raise InvalidReceiptError("Truncated ASN.1")
+    tag = data[offset]
+    if tag & 0x1f == 0x1f:
+        raise InvalidReceiptError("Unsupported ASN.1 tag")
+    length = data[offset + 1]
+    offset += 2
+
+    if length == 0x80:
+        if not tag & 0x20 or depth >= _MAX_DEPTH:
+            raise InvalidReceiptError("Bad ASN.1 length")
+        value_start = offset
+        while True:
+            if offset + 2 > limit:
+                raise InvalidReceiptError("Truncated ASN.1")
+            if data[offset] == 0 and data[offset + 1] == 0:
+                return tag, value_start, offset, offset + 2
+            offset = _ber_element(data, offset, limit, depth + 1)[3]
+
+    if length & 0x80:
+        count = length & 0x7f
+        if count > 4 or offset + count > limit:
+            raise InvalidReceiptError("Bad ASN.1 length")
+        length = int.from_bytes(data[offset:offset + count], 'big')
+        offset += count
+    end = offset + length
+    if end > limit:
+        raise InvalidReceiptError("Truncated ASN.1")
+    return tag, offset, end, end
+
+
+def _ber_children(data, start, end):
+    """
+    [(tag, value_start, value_end, next_offset)] for the TLVs in data[start:end].
+    """
+    children = []
+    offset = start
+    while offset < end:
+        child = _ber_element(data, offset, end)
+        children.append(child)
+        offset = child[3]
+    return children
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Benchmark and regression replay for firestore.rules, using the offline
+evaluator in firestore_rules.py.
+
+Generates a deterministic stream of synthetic accesses (seeded): owners,
+other signed-in users and unauthenticated clients reading and writing user
+documents, recordings, deeper subcollections, and collections outside
+/users, with list requests on collections. Each batch goes through
+RulesEngine.check_batch().
+
+Every run checks the app's intended policy - a signed-in user may access
+/users/{uid} and everything under it, nothing else is accessible - and
+exits with status 1 on a violation.
+
+    python benchmarks/bench_firestore_rules.py --accesses 2000000
+    python benchmarks/bench_firestore_rules.py --record benchmarks/rules_snapshot.json
+    python benchmarks/bench_firestore_rules.py --replay benchmarks/rules_snapshot.json --rules new.rules
+
+--record stores every verdict of the workload as a bitmap; --replay
+regenerates the same workload, evaluates it against the (possibly changed)
+rules and lists the accesses whose verdict changed, exiting 1 if any did.
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from firestore_rules import load_rules  # noqa: E402
+
+DEFAULT_RULES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'firestore.rules')
+DOCUMENT_OPERATIONS = ('get', 'get', 'get', 'create', 'update', 'delete')
+
+
+def synthetic_accesses(count, users, seed, batch_size=100000):
+    """
+    Yields lists of (uid, path, operation) tuples, batch_size at a time.
+    """
+    rng = random.Random(seed)
+    user_ids = [f'user{i:05d}' for i in range(users)]
+    ids = [f'{i:04x}' for i in range(64)]
+    # (weight, path template, is a collection)
+    shapes = (
+        (35, 'users/{owner}/recordings/{a}', False),
+        (20, 'users/{owner}', False),
+        (10, 'users/{owner}/recordings', True),
+        (15, 'users/{owner}/tasks/{a}/notes/{b}', False),
+        (5, 'users', True),
+        (10, '{top}/{a}', False),
+        (5, 'users/{owner}/tasks', True),
+    )
+    weights = [weight for weight, _, _ in shapes]
+    produced = 0
+    while produced < count:
+        size = min(batch_size, count - produced)
+        # Draw each dimension for the whole batch at once
+        owners = rng.choices(user_ids, k=size)
+        others = rng.choices(user_ids, k=size)
+        requesters = rng.choices((0, 1, 2), weights=(70, 20, 10), k=size)
+        picked = rng.choices(shapes, weights=weights, k=size)
+        first_ids = rng.choices(ids, k=size)
+        second_ids = rng.choices(ids, k=size)
+        tops = rng.choices(('tasks', 'recordings', 'config'), k=size)
+        operations = rng.choices(DOCUMENT_OPERATIONS, k=size)
+
+        batch = []
+        for i in range(size):
+            owner = owners[i]
+            requester = requesters[i]
+            uid = owner if requester == 0 else others[i] if requester == 1 else None
+            _, template, collection = picked[i]
+            path = template.format(owner=owner, a=first_ids[i], b=second_ids[i], top=tops[i])
+            batch.append((uid, path, 'list' if collection else operations[i]))
+        produced += size
+        yield batch
+
+
+def intended_policy(uid, path):
+    """The access rule the app is built around: owners only, under /users/{uid}."""
+    segments = path.split('/')
+    return uid is not None and len(segments) >= 2 and segments[0] == 'users' and segments[1] == uid
+
+
+def run(engine, count, users, seed, batch_size):
+    """
+    Evaluate the workload. Returns (verdict bytes, seconds, policy violations).
+    """
+    verdicts = bytearray()
+    violations = []
+    elapsed = 0.0
+    for batch in synthetic_accesses(count, users, seed, batch_size):
+        started = time.perf_counter()
+        results = engine.check_batch(batch)
+        elapsed += time.perf_counter() - started
+        verdicts.extend(results)
+        for access, allowed in zip(batch, results):
+            if allowed != intended_policy(access[0], access[1]) and len(violations) < 10:
+                violations.append((access, allowed))
+    return bytes(verdicts), elapsed, violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="firestore.rules benchmark and regression replay")
+    parser.add_argument('--rules', default=DEFAULT_RULES)
+    parser.add_argument('--accesses', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=100000)
+    parser.add_argument('--record', metavar='FILE', help="write the verdicts to a snapshot file")
+    parser.add_argument('--replay', metavar='FILE', help="compare verdicts with a snapshot file")
+    args = parser.parse_args()
+
+    snapshot = None
+    if args.replay:
+        with open(args.replay, 'r') as f:
+            snapshot = json.load(f)
+        args.accesses, args.users, args.seed = snapshot['accesses'], snapshot['users'], snapshot['seed']
+
+    with open(args.rules, 'rb') as f:
+        rules_sha256 = hashlib.sha256(f.read()).hexdigest()
+    started = time.perf_counter()
+    engine = load_rules(args.rules)
+    compile_ms = (time.perf_counter() - started) * 1000
+
+    verdicts, seconds, violations = run(engine, args.accesses, args.users, args.seed, args.batch_size)
+    allowed = sum(verdicts)
+
+    print(f"Rules:        {args.rules} (rules_version {engine.version}, compiled in {compile_ms:.2f}ms)")
+    print(f"Accesses:     {len(verdicts):,} ({args.users} users, seed {args.seed})")
+    print(f"Allowed:      {allowed:,} ({allowed / max(1, len(verdicts)):.1%})")
+    print(f"Evaluation:   {seconds:.2f}s, {len(verdicts) / seconds:,.0f} checks/s, "
+          f"{seconds / max(1, len(verdicts)) * 1e9:.0f}ns per check")
+
+    failed = False
+    if violations:
+        failed = True
+        print("❌ Verdicts that break the intended owner-only policy:")
+        for (uid, path, operation), was_allowed in violations:
+            print(f"   {'ALLOW' if was_allowed else 'DENY '} {operation:6} {path}  as {uid}")
+    else:
+        print("✅ Every verdict matches the owner-only policy")
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            json.dump({
+                'rules_sha256': rules_sha256,
+                'accesses': args.accesses,
+                'users': args.users,
+                'seed': args.seed,
+                'allowed': allowed,
+                'verdicts': base64.b64encode(zlib.compress(verdicts, 9)).decode()
+            }, f, indent=2)
+        print(f"📝 Recorded {len(verdicts):,} verdicts to {args.record}")
+
+    if snapshot is not None:
+        expected = zlib.decompress(base64.b64decode(snapshot['verdicts']))
+        changed = [i for i, (a, b) in enumerate(zip(expected, verdicts)) if a != b]
+        if not changed and len(expected) == len(verdicts):
+            print(f"✅ Replay matches {args.replay} ({len(verdicts):,} verdicts)")
+        else:
+            failed = True
+            print(f"❌ {len(changed):,} verdict(s) changed since {args.replay}:")
+            wanted = set(changed[:20])
+            index = 0
+            for batch in synthetic_accesses(args.accesses, args.users, args.seed, args.batch_size):
+                for uid, path, operation in batch:
+                    if index in wanted:
+                        was = 'ALLOW' if expected[index] else 'DENY'
+                        now = 'ALLOW' if verdicts[index] else 'DENY'
+                        print(f"   {was:5} -> {now:5} {operation:6} {path}  as {uid}")
+                    index += 1
+                if index > max(wanted, default=0):
+                    break
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Benchmark parse_apple_response / find_active_premium on synthetic receipts.
+
+Shows that scan time per transaction and peak extra memory stay flat as the
+purchase history grows (the scan never copies or concatenates the arrays).
+
+Usage:
+    python benchmarks/bench_purchase_scan.py [--sizes 100,1000,10000] [--repeat 50]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import receipt_validation_endpoint as rv  # noqa: E402
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def synthetic_apple_response(transactions):
+    """
+    Build a verifyReceipt-shaped response with `transactions` monthly renewals,
+    the newest of which is still active, split across in_app and
+    latest_receipt_info like a long-lived subscriber's receipt.
+    """
+    now_ms = int(time.time() * 1000)
+    purchases = []
+    for i in range(transactions):
+        expires_ms = now_ms - (transactions - i - 1) * 30 * DAY_MS + 15 * DAY_MS
+        purchases.append({
+            'product_id': 'brain_dumpster_monthly_premium',
+            'transaction_id': str(2000000000 + i),
+            'original_transaction_id': '1000000000',
+            'purchase_date_ms': str(expires_ms - 30 * DAY_MS),
+            'expires_date_ms': str(expires_ms)
+        })
+
+    half = transactions // 2
+    return {
+        'status': 0,
+        'environment': 'Production',
+        'receipt': {'bundle_id': rv.EXPECTED_BUNDLE_ID, 'in_app': purchases[:half]},
+        'latest_receipt_info': purchases[half:]
+    }
+
+
+def bench(transactions, repeat):
+    apple_response = synthetic_apple_response(transactions)
+
+    # Warm up and sanity-check the verdict
+    result = rv.parse_apple_response(apple_response)
+    assert result['isPremium'], result
+
+    start = time.process_time()
+    for _ in range(repeat):
+        rv.parse_apple_response(apple_response)
+    cpu = (time.process_time() - start) / repeat
+
+    tracemalloc.start()
+    rv.parse_apple_response(apple_response)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return cpu, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    print(f"{'transactions':>12}  {'cpu/scan':>10}  {'ns/txn':>8}  {'peak alloc':>10}")
+    for size in sizes:
+        cpu, peak = bench(size, args.repeat)
+        print(f"{size:>12}  {cpu * 1000:>8.3f}ms  {cpu / size * 1e9:>8.0f}  {peak / 1024:>8.1f}KB")
+
+
+if __name__ == '__main__':
+    main()
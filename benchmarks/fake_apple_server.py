@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for Apple's verifyReceipt, for benchmarks and load tests.
+
+Serves POST /production/verifyReceipt and POST /sandbox/verifyReceipt with
+verifyReceipt-shaped responses. Behaviour is configurable:
+- latency: mean and jitter per call
+- error_rate: fraction of calls answered with 21005 (server unavailable)
+- sandbox_rate: fraction of receipts that are sandbox receipts; production
+  answers those with 21007 and sandbox answers production receipts with 21008
+- transactions: renewal entries per receipt (response size)
+
+Whether a receipt is sandbox is derived from its hash, so the same receipt
+always lands in the same environment across calls and runs.
+
+Usage:
+    python benchmarks/fake_apple_server.py --port 8099 --latency-ms 300 --sandbox-rate 0.1
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUNDLE_ID = "com.braindumpster.app"
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+class FakeAppleConfig:
+    def __init__(self, latency_ms=300.0, jitter_ms=100.0, error_rate=0.0,
+                 sandbox_rate=0.0, transactions=12, seed=None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.sandbox_rate = sandbox_rate
+        self.transactions = transactions
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0.0, self.latency_ms + jitter) / 1000.0
+
+    def should_fail(self):
+        if self.error_rate <= 0:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+def _der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        header = bytes([tag, length])
+    else:
+        size = (length.bit_length() + 7) // 8
+        header = bytes([tag, 0x80 | size]) + length.to_bytes(size, 'big')
+    return header + content
+
+
+def _receipt_attribute(attribute_type, value):
+    def integer(number):
+        return _der(0x02, number.to_bytes((number.bit_length() + 8) // 8, 'big'))
+    return _der(0x30, integer(attribute_type) + integer(1) + _der(0x04, value))
+
+
+def encode_receipt(bundle_id=BUNDLE_ID, original_transaction_id='1000000000', padding=b''):
+    """
+    Base64 receipt shaped like a real one, for clients of this server: a
+    PKCS#7 signed-data container (without certificates or signature) holding
+    the bundle ID, one in-app purchase and `padding` as an opaque attribute
+    to reach a given size. Enough to pass the backend's offline decoding.
+    """
+    in_app = _der(0x31, _receipt_attribute(1705, _der(0x0c, original_transaction_id.encode())))
+    payload = _der(0x31, _receipt_attribute(2, _der(0x0c, bundle_id.encode()))
+                   + _receipt_attribute(17, in_app)
+                   + _receipt_attribute(1000, padding))
+    encapsulated = _der(0x30, _der(0x06, bytes.fromhex('2a864886f70d010701'))
+                        + _der(0xa0, _der(0x04, payload)))
+    signed_data = _der(0x30, _der(0x02, b'\x01') + _der(0x31, b'') + encapsulated + _der(0x31, b''))
+    content_info = _der(0x30, _der(0x06, bytes.fromhex('2a864886f70d010702')) + _der(0xa0, signed_data))
+    return base64.b64encode(content_info).decode()
+
+
+def receipt_is_sandbox(receipt_data, sandbox_rate):
+    if sandbox_rate <= 0:
+        return False
+    digest = hashlib.sha256(receipt_data.encode()).digest()
+    return int.from_bytes(digest[:4], 'big') / 2 ** 32 < sandbox_rate
+
+
+def build_response(receipt_data, environment, transactions):
+    now_ms = int(time.time() * 1000)
+    original_transaction_id = str(int(hashlib.sha256(receipt_data.encode()).hexdigest()[:12], 16))
+    purchases = []
+    for i in range(transactions):
+        expires_ms = now_ms - (transactions - i - 1) * 30 * DAY_MS + 15 * DAY_MS
+        purchases.append({
+            'product_id': 'brain_dumpster_monthly_premium',
+            'transaction_id': f'{original_transaction_id}{i:04d}',
+            'original_transaction_id': original_transaction_id,
+            'purchase_date_ms': str(expires_ms - 30 * DAY_MS),
+            'expires_date_ms': str(expires_ms)
+        })
+    return {
+        'status': 0,
+        'environment': 'Sandbox' if environment == 'sandbox' else 'Production',
+        'receipt': {'bundle_id': BUNDLE_ID, 'in_app': purchases[:1]},
+        'latest_receipt_info': purchases,
+        'latest_receipt': receipt_data
+    }
+
+
+def make_handler(config, stats):
+    class FakeAppleHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length)
+            environment = 'sandbox' if self.path.startswith('/sandbox') else 'production'
+
+            time.sleep(config.delay())
+
+            try:
+                receipt_data = json.loads(body).get('receipt-data') or ''
+            except ValueError:
+                receipt_data = ''
+
+            if not receipt_data:
+                payload = {'status': 21002}
+            elif config.should_fail():
+                payload = {'status': 21005}
+            else:
+                is_sandbox = receipt_is_sandbox(receipt_data, config.sandbox_rate)
+                if environment == 'production' and is_sandbox:
+                    payload = {'status': 21007}
+                elif environment == 'sandbox' and not is_sandbox:
+                    payload = {'status': 21008}
+                else:
+                    payload = build_response(receipt_data, environment, config.transactions)
+
+            with stats['lock']:
+                stats['calls'] += 1
+                stats[environment] += 1
+
+            data = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeAppleHandler
+
+
+class _FakeAppleHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Must be set before the socket starts listening, hence the subclass
+    request_queue_size = 1024
+
+
+class FakeAppleServer:
+    """
+    Runs the fake verifyReceipt service on a background thread.
+
+        with FakeAppleServer(FakeAppleConfig(latency_ms=50)) as server:
+            rv.APPLE_PRODUCTION_URL = server.production_url
+    """
+
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or FakeAppleConfig()
+        self.stats = {'calls': 0, 'production': 0, 'sandbox': 0, 'lock': threading.Lock()}
+        self.httpd = _FakeAppleHTTPServer((host, port), make_handler(self.config, self.stats))
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def production_url(self):
+        return self.base_url + '/production/verifyReceipt'
+
+    @property
+    def sandbox_url(self):
+        return self.base_url + '/sandbox/verifyReceipt'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Apple verifyReceipt server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--latency-ms', type=float, default=300.0)
+    parser.add_argument('--jitter-ms', type=float, default=100.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--sandbox-rate', type=float, default=0.0)
+    parser.add_argument('--transactions', type=int, default=12)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    config = FakeAppleConfig(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        sandbox_rate=args.sandbox_rate,
+        transactions=args.transactions,
+        seed=args.seed
+    )
+    server = FakeAppleServer(config, args.host, args.port)
+    print(f"Fake verifyReceipt listening on {server.base_url}")
+    print(f"   Production: {server.production_url}")
+    print(f"   Sandbox:    {server.sandbox_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
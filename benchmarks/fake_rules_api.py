@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Firebase Rules API, for deploy_firestore_rules.py.
+
+Serves the calls a rules deploy makes, per project, from memory:
+    GET   /v1/projects/{p}/releases/{release}     404 until one is created
+    POST  /v1/projects/{p}/releases
+    PATCH /v1/projects/{p}/releases/{release}     body {"release": {...}}
+    POST  /v1/projects/{p}/rulesets
+    GET   /v1/projects/{p}/rulesets/{id}
+
+Every call needs a Bearer token and waits latency_ms. Stats count calls
+per method and kind, and new TCP connections, so tests can check that an
+unchanged deploy creates no ruleset and that clients reuse connections.
+
+Usage:
+    python benchmarks/fake_rules_api.py --port 8098 --latency-ms 150
+    python deploy_firestore_rules.py --api-url http://127.0.0.1:8098/v1 --access-token local \\
+        --projects staging,production --cache ''
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeRulesState:
+    def __init__(self, latency_ms=100.0):
+        self.latency_ms = latency_ms
+        self.rulesets = {}      # ruleset name -> ruleset
+        self.releases = {}      # release name -> release
+        self.stats = {'connections': 0}
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+def make_handler(state):
+    class FakeRulesHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            state.count('connections')
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_PATCH(self):
+            self._handle('PATCH')
+
+        def _handle(self, method):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            time.sleep(state.latency_ms / 1000.0)
+
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                return self._error(401, 'UNAUTHENTICATED')
+            try:
+                payload = json.loads(body) if body else {}
+            except ValueError:
+                return self._error(400, 'INVALID_ARGUMENT')
+
+            parts = self.path.strip('/').split('/')
+            if len(parts) < 4 or parts[0] != 'v1' or parts[1] != 'projects':
+                return self._error(404, 'NOT_FOUND')
+            project, kind = parts[2], parts[3]
+            name = '/'.join(parts[1:])
+            state.count(f'{method} {kind}')
+
+            with state.lock:
+                if kind == 'rulesets' and method == 'POST' and len(parts) == 4:
+                    files = payload.get('source', {}).get('files')
+                    if not files:
+                        return self._error(400, 'INVALID_ARGUMENT')
+                    ruleset = {
+                        'name': f'projects/{project}/rulesets/{uuid.uuid4()}',
+                        'source': {'files': files},
+                        'createTime': _now()
+                    }
+                    state.rulesets[ruleset['name']] = ruleset
+                    return self._send(ruleset)
+
+                if kind == 'rulesets' and method == 'GET' and len(parts) == 5:
+                    ruleset = state.rulesets.get(name)
+                    return self._send(ruleset) if ruleset else self._error(404, 'NOT_FOUND')
+
+                if kind == 'releases' and method == 'GET' and len(parts) == 5:
+                    release = state.releases.get(name)
+                    return self._send(release) if release else self._error(404, 'NOT_FOUND')
+
+                if kind == 'releases' and method in ('POST', 'PATCH'):
+                    release = payload.get('release', payload) if method == 'PATCH' else payload
+                    release_name = release.get('name')
+                    if method == 'PATCH' and release_name != name:
+                        return self._error(400, 'INVALID_ARGUMENT')
+                    if release.get('rulesetName') not in state.rulesets:
+                        return self._error(404, 'NOT_FOUND')
+                    exists = release_name in state.releases
+                    if exists != (method == 'PATCH'):
+                        return self._error(404 if method == 'PATCH' else 409,
+                                           'NOT_FOUND' if method == 'PATCH' else 'ALREADY_EXISTS')
+                    now = _now()
+                    stored = {
+                        'name': release_name,
+                        'rulesetName': release['rulesetName'],
+                        'createTime': state.releases[release_name]['createTime'] if exists else now,
+                        'updateTime': now
+                    }
+                    state.releases[release_name] = stored
+                    return self._send(stored)
+
+            return self._error(404, 'NOT_FOUND')
+
+        def _error(self, code, status):
+            self._send({'error': {'code': code, 'status': status}}, code)
+
+        def _send(self, payload, code=200):
+            data = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeRulesHandler
+
+
+class _FakeRulesHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class FakeRulesServer:
+    """
+    Runs the fake Rules API on a background thread.
+
+        with FakeRulesServer(FakeRulesState(latency_ms=20)) as server:
+            client = RulesClient(StaticToken('local'), api_url=server.api_url)
+    """
+
+    def __init__(self, state=None, host='127.0.0.1', port=0):
+        self.state = state or FakeRulesState()
+        self.httpd = _FakeRulesHTTPServer((host, port), make_handler(self.state))
+        self._thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Firebase Rules API server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8098)
+    parser.add_argument('--latency-ms', type=float, default=100.0)
+    args = parser.parse_args()
+
+    server = FakeRulesServer(FakeRulesState(args.latency_ms), args.host, args.port)
+    print(f"Fake Rules API listening on {server.api_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Load test for receipt_validation_endpoint.py against a fake verifyReceipt.
+
+Starts the fake Apple server and the Flask app (threaded WSGI server) in
+this process, drives them with concurrent HTTP clients and reports
+p50/p95/p99 latency, requests per second and the number of Apple calls.
+
+After each scenario, --memory-samples requests with new receipts are sent
+one at a time through Flask's test client under tracemalloc, and the median
+per-request peak of Python allocations is reported (peak_kb). The test
+client skips the dev server, whose end-of-request drain reads in 10MB
+blocks and would swamp the figure. The fake Apple server still runs in this
+process, so its share of a request (parsing the body, echoing the receipt
+as latest_receipt) is included; use --receipt-kb to see how it scales.
+
+Scenarios:
+    cold     every request carries a new receipt (all cache misses)
+    repeat   receipts drawn from a small pool (verdict cache hits)
+    burst    groups of identical receipts sent at once (in-flight coalescing)
+    sandbox  sandbox receipts from a fixed set of users (21007 redirects,
+             then remembered environments)
+    errors   Apple answers 10% of calls with 21005
+
+Baselines:
+    python benchmarks/load_test.py --save-baseline benchmarks/baseline.json
+    python benchmarks/load_test.py --compare benchmarks/baseline.json --tolerance 0.2
+
+--compare exits with status 1 when a scenario's p95 or throughput is worse
+than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import statistics
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Benchmarks run without Firebase and against a throwaway database
+os.environ.setdefault('FIREBASE_AUTH_ENABLED', '0')
+os.environ.setdefault('SUBSCRIPTION_DB_PATH', os.path.join(tempfile.mkdtemp(), 'bench.db'))
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import requests  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import receipt_validation_endpoint as rv  # noqa: E402
+from fake_apple_server import FakeAppleConfig, FakeAppleServer, encode_receipt  # noqa: E402
+
+AUTH_HEADERS = {'Authorization': 'Bearer bench'}
+
+SCENARIOS = {
+    'cold': {'apple': {}, 'pool': None, 'burst': 1},
+    'repeat': {'apple': {}, 'pool': 50, 'burst': 1},
+    'burst': {'apple': {}, 'pool': None, 'burst': 8},
+    'sandbox': {'apple': {'sandbox_rate': 1.0}, 'pool': None, 'burst': 1, 'users': 50},
+    'errors': {'apple': {'error_rate': 0.1}, 'pool': None, 'burst': 1},
+}
+
+
+def make_receipt(index, size_kb, rng):
+    """
+    Base64 receipt of roughly size_kb kilobytes, unique per index.
+    """
+    raw_size = max(16, int(size_kb * 1024 * 3 / 4) - 128)
+    padding = index.to_bytes(8, 'big') + rng.randbytes(raw_size - 8)
+    return encode_receipt(rv.EXPECTED_BUNDLE_ID, str(1000000000 + index), padding)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def build_workload(scenario, requests_count, size_kb, seed):
+    """
+    List of request bodies. Bursts are consecutive identical bodies.
+    """
+    rng = random.Random(seed)
+    spec = SCENARIOS[scenario]
+    pool = None
+    if spec['pool']:
+        pool = [make_receipt(i, size_kb, rng) for i in range(spec['pool'])]
+
+    bodies = []
+    index = 0
+    while len(bodies) < requests_count:
+        if pool is not None:
+            receipt = rng.choice(pool)
+        else:
+            receipt = make_receipt(index, size_kb, rng)
+        users = spec.get('users')
+        user_id = f'user-{index % users}' if users else f'user-{index}'
+        body = {
+            'receiptData': receipt,
+            'userId': user_id,
+            'bundleId': rv.EXPECTED_BUNDLE_ID,
+            'appVersion': 'bench',
+            'deviceInfo': {'model': 'bench', 'osVersion': 'bench', 'locale': 'en_US'}
+        }
+        bodies.extend([body] * spec['burst'])
+        index += 1
+    return bodies[:requests_count]
+
+
+def reset_service_state():
+    rv.verdict_cache.clear()
+    rv.receipt_environments = rv.ReceiptEnvironmentMemory()
+
+
+def measure_peak_memory(scenario, args):
+    """
+    Median tracemalloc peak (KB) over args.memory_samples sequential requests.
+    Bodies are encoded before tracing starts so only request handling counts.
+    """
+    if args.memory_samples <= 0:
+        return None
+
+    reset_service_state()
+    rng = random.Random(args.seed + 1)
+    bodies = []
+    for body in build_workload(scenario, args.memory_samples, args.receipt_kb, args.seed + 1):
+        # New receipts, so every request goes to (fake) Apple
+        body = dict(body, receiptData=make_receipt(rng.getrandbits(62), args.receipt_kb, rng))
+        bodies.append(json.dumps(body).encode())
+
+    client = rv.app.test_client()
+    headers = dict(AUTH_HEADERS, **{'Content-Type': 'application/json'})
+    peaks = []
+    tracemalloc.start()
+    try:
+        for data in bodies:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            client.post('/api/verify-receipt', data=data, headers=headers).close()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+    finally:
+        tracemalloc.stop()
+    return round(statistics.median(peaks) / 1024, 1)
+
+
+def run_scenario(scenario, app_url, apple_server, args):
+    spec = SCENARIOS[scenario]
+    config = apple_server.config
+    config.error_rate = spec['apple'].get('error_rate', 0.0)
+    config.sandbox_rate = spec['apple'].get('sandbox_rate', 0.0)
+
+    reset_service_state()
+    workload = build_workload(scenario, args.requests, args.receipt_kb, args.seed)
+    apple_calls_before = apple_server.stats['calls']
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    cursor = [0]
+
+    def next_batch():
+        # Hand out whole bursts so identical receipts really go out together
+        with lock:
+            start = cursor[0]
+            if start >= len(workload):
+                return []
+            end = start + 1
+            while end < len(workload) and workload[end] is workload[start]:
+                end += 1
+            cursor[0] = end
+            return workload[start:end]
+
+    def client():
+        session = requests.Session()
+        while True:
+            batch = next_batch()
+            if not batch:
+                return
+            threads = []
+            results = []
+
+            def send(body):
+                started = time.perf_counter()
+                try:
+                    poster = session.post if len(batch) == 1 else requests.post
+                    response = poster(app_url, json=body, headers=AUTH_HEADERS, timeout=60)
+                    # 400 is a legitimate "receipt rejected" verdict
+                    ok = response.status_code < 500 and response.status_code != 401
+                except requests.RequestException:
+                    ok = False
+                results.append((time.perf_counter() - started, ok))
+
+            if len(batch) == 1:
+                send(batch[0])
+            else:
+                for body in batch:
+                    thread = threading.Thread(target=send, args=(body,))
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+
+            with lock:
+                for latency, ok in results:
+                    latencies.append(latency)
+                    if not ok:
+                        errors[0] += 1
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    apple_calls = apple_server.stats['calls'] - apple_calls_before
+    peak_kb = measure_peak_memory(scenario, args)
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': round(elapsed, 3),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'apple_calls': apple_calls,
+        'peak_kb': peak_kb,
+    }
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scenario, result in results.items():
+        base = baseline.get('results', {}).get(scenario)
+        if not base:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{scenario}: p95 {result['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{scenario}: {result['rps']} req/s vs baseline {base['rps']} req/s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receipt validation load test")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--apple-latency-ms', type=float, default=300.0)
+    parser.add_argument('--apple-jitter-ms', type=float, default=50.0)
+    parser.add_argument('--transactions', type=int, default=12)
+    parser.add_argument('--receipt-kb', type=float, default=8.0)
+    parser.add_argument('--memory-samples', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--save-baseline')
+    parser.add_argument('--compare')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+
+    apple_config = FakeAppleConfig(
+        latency_ms=args.apple_latency_ms,
+        jitter_ms=args.apple_jitter_ms,
+        transactions=args.transactions,
+        seed=args.seed
+    )
+
+    with FakeAppleServer(apple_config) as apple_server:
+        rv.APPLE_PRODUCTION_URL = apple_server.production_url
+        rv.APPLE_SANDBOX_URL = apple_server.sandbox_url
+
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        app_server = make_server('127.0.0.1', 0, rv.app, threaded=True)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+        app_url = f'http://127.0.0.1:{app_server.server_port}/api/verify-receipt'
+
+        results = {}
+        print(f"{'scenario':<10} {'reqs':>6} {'errs':>5} {'req/s':>8} "
+              f"{'p50':>9} {'p95':>9} {'p99':>9} {'apple':>6} {'peak_kb':>9}")
+        for scenario in scenarios:
+            result = run_scenario(scenario, app_url, apple_server, args)
+            results[scenario] = result
+            print(f"{scenario:<10} {result['requests']:>6} {result['errors']:>5} {result['rps']:>8} "
+                  f"{result['p50_ms']:>7}ms {result['p95_ms']:>7}ms {result['p99_ms']:>7}ms "
+                  f"{result['apple_calls']:>6} {result['peak_kb'] if result['peak_kb'] is not None else '-':>9}")
+
+        app_server.shutdown()
+
+    report = {
+        'settings': {key: value for key, value in vars(args).items()
+                     if key not in ('save_baseline', 'compare', 'tolerance')},
+        'results': results
+    }
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != report['settings']:
+            print("⚠️  Baseline was recorded with different settings")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("❌ Regressions:")
+            for line in regressions:
+                print(f"   {line}")
+            sys.exit(1)
+        print("✅ No regressions against baseline")
+
+
+if __name__ == '__main__':
+    main()
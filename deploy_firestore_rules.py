@@ -1,101 +1,371 @@
 #!/usr/bin/env python3
 """
 Deploy Firestore Security Rules using the Firebase REST API
+
+Rulesets are content-addressed: the rules source is hashed and compared
+with the ruleset the project's cloud.firestore release points at, and
+projects that already run these exact rules are skipped without creating a
+ruleset. Rulesets are immutable, so their digests are cached locally by
+name and an unchanged project costs one GET.
+
+The access token is reused from memory until shortly before it expires
+(--cache-tokens also keeps it in the cache file for later runs), one HTTP
+session is shared by every call, and several projects are deployed
+concurrently.
+
+Usage:
+    python deploy_firestore_rules.py
+    python deploy_firestore_rules.py --projects braindumpster-staging,voicereminder-e1c91
+    python deploy_firestore_rules.py --force
+
+Against the local stand-in (benchmarks/fake_rules_api.py):
+    python deploy_firestore_rules.py --api-url http://127.0.0.1:8098/v1 --access-token local
 """
+import argparse
+import calendar
+import hashlib
 import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Set up credentials
-CREDENTIALS_PATH = "/Users/furkancekic/projects/braindumpster_python/firebase_config.json"
 PROJECT_ID = "voicereminder-e1c91"
-RULES_FILE = "/Users/furkancekic/projects/last_tasks/firestore.rules"
+RULES_FILE = os.path.join(BASE_DIR, "firestore.rules")
+CREDENTIALS_PATH = os.environ.get(
+    'GOOGLE_APPLICATION_CREDENTIALS', os.path.join(BASE_DIR, "firebase_config.json")
+)
+RULES_API_URL = os.environ.get('FIREBASE_RULES_API_URL', "https://firebaserules.googleapis.com/v1")
+RELEASE_ID = "cloud.firestore"
+CACHE_PATH = os.environ.get(
+    'FIRESTORE_RULES_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'braindumpster', 'firestore_rules.json')
+)
 
-def get_access_token():
-    """Get OAuth2 access token from service account credentials"""
-    print("🔐 Loading service account credentials...")
-    credentials = service_account.Credentials.from_service_account_file(
-        CREDENTIALS_PATH,
-        scopes=['https://www.googleapis.com/auth/cloud-platform']
-    )
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+TOKEN_EXPIRY_MARGIN_SECONDS = 120    # Refresh this long before the token expires
+REQUEST_TIMEOUT_SECONDS = 30
 
-    # Refresh the credentials to get an access token
-    credentials.refresh(Request())
-    return credentials.token
 
-def deploy_firestore_rules():
-    print("📖 Reading Firestore rules...")
-    with open(RULES_FILE, 'r') as f:
-        rules_content = f.read()
+class RulesDeployError(Exception):
+    def __init__(self, message, status_code=None, body=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+def rules_digest(files):
+    """
+    sha256 of a ruleset's source files ([{'name', 'content'}]), independent
+    of file order.
+    """
+    canonical = sorted((f['name'], f['content']) for f in files)
+    return hashlib.sha256(json.dumps(canonical, separators=(',', ':')).encode()).hexdigest()
+
+
+def read_rules(path=RULES_FILE):
+    with open(path, 'r') as f:
+        return [{"name": os.path.basename(path), "content": f.read()}]
 
-    print("🔑 Getting access token...")
-    access_token = get_access_token()
 
-    print("🚀 Deploying Firestore rules...")
+class DeployCache:
+    """
+    Ruleset digests by ruleset name, and access tokens until they expire.
+    Digests are kept in one JSON file (mode 0600); tokens stay in memory
+    unless persist_tokens is set. path=None keeps everything in memory only.
+    """
 
-    # Step 1: Create a new ruleset
-    create_ruleset_url = f"https://firebaserules.googleapis.com/v1/projects/{PROJECT_ID}/rulesets"
+    def __init__(self, path=CACHE_PATH, persist_tokens=False):
+        self.path = path
+        self.persist_tokens = persist_tokens
+        self.lock = threading.Lock()
+        self.data = {'rulesets': {}, 'tokens': {}}
+        if path:
+            try:
+                with open(path, 'r') as f:
+                    loaded = json.load(f)
+            except (OSError, ValueError):
+                loaded = {}
+            self.data['rulesets'].update(loaded.get('rulesets', {}))
+            if persist_tokens:
+                self.data['tokens'].update(loaded.get('tokens', {}))
+            elif loaded.get('tokens'):
+                # Written with persist_tokens before; don't leave tokens on disk
+                with self.lock:
+                    self._save()
 
-    ruleset_payload = {
-        "source": {
-            "files": [
-                {
-                    "name": "firestore.rules",
-                    "content": rules_content
-                }
-            ]
+    def ruleset_digest(self, ruleset_name):
+        with self.lock:
+            return self.data['rulesets'].get(ruleset_name)
+
+    def set_ruleset_digest(self, ruleset_name, digest):
+        with self.lock:
+            self.data['rulesets'][ruleset_name] = digest
+            self._save()
+
+    def token(self, key):
+        with self.lock:
+            entry = self.data['tokens'].get(key)
+        if entry and entry['expires_at'] - TOKEN_EXPIRY_MARGIN_SECONDS > time.time():
+            return entry['token']
+        return None
+
+    def set_token(self, key, token, expires_at):
+        with self.lock:
+            self.data['tokens'][key] = {'token': token, 'expires_at': expires_at}
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        now = time.time()
+        self.data['tokens'] = {
+            key: entry for key, entry in self.data['tokens'].items() if entry['expires_at'] > now
         }
-    }
+        saved = {'rulesets': self.data['rulesets']}
+        if self.persist_tokens:
+            saved['tokens'] = self.data['tokens']
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️  Could not write cache {self.path}: {e}")
+
+
+class ServiceAccountToken:
+    """
+    OAuth2 access token for a service account, refreshed only when the
+    cached one is about to expire. Safe to share between threads: concurrent
+    callers wait for a single refresh.
+    """
+
+    def __init__(self, credentials_path=CREDENTIALS_PATH, cache=None):
+        self.credentials_path = credentials_path
+        self.cache = cache or DeployCache(None)
+        self.lock = threading.Lock()
+        self._credentials = None
+        self._key = None
+
+    def __call__(self):
+        with self.lock:
+            if self._key is None:
+                self._load_credentials()
+            token = self.cache.token(self._key)
+            if token is None:
+                token = self._refresh()
+            return token
+
+    def _load_credentials(self):
+        from google.oauth2 import service_account
+
+        print("🔐 Loading service account credentials...")
+        self._credentials = service_account.Credentials.from_service_account_file(
+            self.credentials_path, scopes=SCOPES
+        )
+        self._key = f"{self._credentials.service_account_email} {' '.join(SCOPES)}"
+
+    def _refresh(self):
+        from google.auth.transport.requests import Request
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+        print("🔑 Getting access token...")
+        self._credentials.refresh(Request())
+        expiry = self._credentials.expiry
+        if expiry is not None:
+            # google-auth reports expiry as a naive UTC datetime
+            expires_at = calendar.timegm(expiry.utctimetuple())
+        else:
+            expires_at = time.time() + TOKEN_EXPIRY_MARGIN_SECONDS * 2
+        self.cache.set_token(self._key, self._credentials.token, expires_at)
+        return self._credentials.token
 
-    response = requests.post(create_ruleset_url, headers=headers, json=ruleset_payload)
 
-    if response.status_code != 200:
-        print(f"❌ Failed to create ruleset: {response.status_code}")
-        print(f"   Response: {response.text}")
-        return False
+class StaticToken:
+    """A fixed access token, e.g. for the local Rules API stand-in."""
 
-    ruleset_data = response.json()
-    ruleset_name = ruleset_data.get("name")
-    print(f"✅ Ruleset created: {ruleset_name}")
+    def __init__(self, token):
+        self.token = token
 
-    # Step 2: Create a release that points to this ruleset
-    release_url = f"https://firebaserules.googleapis.com/v1/projects/{PROJECT_ID}/releases"
+    def __call__(self):
+        return self.token
 
-    # For Firebase Rules API, the release payload structure is different
-    release_payload = {
-        "release": {
-            "name": f"projects/{PROJECT_ID}/releases/cloud.firestore",
+
+def make_session(pool_size=10):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Content-Type'] = 'application/json'
+    return session
+
+
+class RulesClient:
+    """
+    The handful of Firebase Rules API calls a deploy needs, over one
+    shared session.
+    """
+
+    def __init__(self, token_source, session=None, api_url=RULES_API_URL):
+        self.token_source = token_source
+        self.session = session or make_session()
+        self.api_url = api_url.rstrip('/')
+
+    def get_release(self, project_id):
+        """The project's cloud.firestore release, or None if it has none."""
+        return self._call('GET', f"projects/{project_id}/releases/{RELEASE_ID}", allow_404=True)
+
+    def get_ruleset(self, ruleset_name):
+        return self._call('GET', ruleset_name)
+
+    def create_ruleset(self, project_id, files):
+        return self._call('POST', f"projects/{project_id}/rulesets", {"source": {"files": files}})
+
+    def update_release(self, project_id, ruleset_name, create=False):
+        release = {
+            "name": f"projects/{project_id}/releases/{RELEASE_ID}",
             "rulesetName": ruleset_name
         }
-    }
+        if create:
+            return self._call('POST', f"projects/{project_id}/releases", release)
+        # The Rules API wraps PATCH bodies in a "release" field
+        return self._call('PATCH', f"projects/{project_id}/releases/{RELEASE_ID}", {"release": release})
+
+    def _call(self, method, path, payload=None, allow_404=False):
+        response = self.session.request(
+            method,
+            f"{self.api_url}/{path}",
+            headers={"Authorization": f"Bearer {self.token_source()}"},
+            data=json.dumps(payload) if payload is not None else None,
+            timeout=REQUEST_TIMEOUT_SECONDS
+        )
+        if allow_404 and response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise RulesDeployError(
+                f"{method} {path} failed: {response.status_code}",
+                response.status_code, response.text
+            )
+        return response.json()
+
+
+def deploy_project(client, cache, project_id, files, digest=None, force=False):
+    """
+    Release files to one project unless it already runs them. Returns a
+    result dict with status 'unchanged', 'deployed' or 'failed'.
+    """
+    started = time.perf_counter()
+    digest = digest or rules_digest(files)
+    result = {'project': project_id, 'digest': digest}
+    try:
+        release = client.get_release(project_id)
+        current_ruleset = release.get('rulesetName') if release else None
+
+        if current_ruleset and not force:
+            current_digest = cache.ruleset_digest(current_ruleset)
+            if current_digest is None:
+                ruleset = client.get_ruleset(current_ruleset)
+                current_digest = rules_digest(ruleset.get('source', {}).get('files', []))
+                cache.set_ruleset_digest(current_ruleset, current_digest)
+            if current_digest == digest:
+                result.update(status='unchanged', ruleset=current_ruleset)
+                return result
+
+        ruleset_name = client.create_ruleset(project_id, files).get("name")
+        cache.set_ruleset_digest(ruleset_name, digest)
+        release = client.update_release(project_id, ruleset_name, create=release is None)
+        result.update(
+            status='deployed',
+            ruleset=release.get('rulesetName', ruleset_name),
+            previous_ruleset=current_ruleset,
+            update_time=release.get('updateTime')
+        )
+    except (RulesDeployError, requests.RequestException) as e:
+        result.update(status='failed', error=str(e), response=getattr(e, 'body', None))
+    finally:
+        result['seconds'] = time.perf_counter() - started
+    return result
+
+
+def deploy_firestore_rules(projects, files, client, cache, force=False, max_workers=8):
+    """
+    Deploy to every project concurrently. Returns the per-project results
+    in the order of projects.
+    """
+    digest = rules_digest(files)
+    # Fetch the token once up front so workers don't queue behind the refresh
+    client.token_source()
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(projects)))) as executor:
+        return list(executor.map(
+            lambda project_id: deploy_project(client, cache, project_id, files, digest, force),
+            projects
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deploy firestore.rules to one or more projects")
+    parser.add_argument('--projects', default=os.environ.get('FIRESTORE_RULES_PROJECTS', PROJECT_ID),
+                        help="comma-separated Firebase project IDs")
+    parser.add_argument('--rules', default=RULES_FILE)
+    parser.add_argument('--credentials', default=CREDENTIALS_PATH, help="service account JSON file")
+    parser.add_argument('--access-token', default=os.environ.get('FIREBASE_RULES_ACCESS_TOKEN'),
+                        help="use this access token instead of the service account")
+    parser.add_argument('--api-url', default=RULES_API_URL)
+    parser.add_argument('--cache', default=CACHE_PATH, help="cache file ('' for none)")
+    parser.add_argument('--cache-tokens', action='store_true',
+                        help="also keep access tokens in the cache file for later runs")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--force', action='store_true', help="release even if the rules are unchanged")
+    args = parser.parse_args()
+
+    projects = list(dict.fromkeys(
+        project_id.strip() for project_id in args.projects.split(',') if project_id.strip()
+    ))
+    if not projects:
+        parser.error("--projects must name at least one Firebase project ID")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    print("📖 Reading Firestore rules...")
+    files = read_rules(args.rules)
 
-    # Use PATCH to update the existing release
-    patch_url = f"https://firebaserules.googleapis.com/v1/projects/{PROJECT_ID}/releases/cloud.firestore"
+    cache = DeployCache(args.cache or None, persist_tokens=args.cache_tokens)
+    if args.access_token:
+        token_source = StaticToken(args.access_token)
+    else:
+        token_source = ServiceAccountToken(args.credentials, cache)
+    client = RulesClient(token_source, make_session(args.workers), args.api_url)
 
-    response = requests.patch(patch_url, headers=headers, json=release_payload)
+    print(f"🚀 Deploying Firestore rules to {len(projects)} project(s)...")
+    started = time.perf_counter()
+    results = deploy_firestore_rules(projects, files, client, cache, args.force, args.workers)
 
-    if response.status_code != 200:
-        print(f"❌ Failed to create/update release: {response.status_code}")
-        print(f"   Response: {response.text}")
-        return False
+    for result in results:
+        if result['status'] == 'unchanged':
+            print(f"⏭️  {result['project']}: rules unchanged ({result['ruleset']})")
+        elif result['status'] == 'deployed':
+            print(f"✅ {result['project']}: rules deployed successfully!")
+            print(f"   Ruleset: {result['ruleset']}")
+            print(f"   Update time: {result['update_time']}")
+        else:
+            print(f"❌ {result['project']}: {result['error']}")
+            if result.get('response'):
+                print(f"   Response: {result['response']}")
+    print(f"   Digest: {results[0]['digest'][:16]}  ({time.perf_counter() - started:.2f}s)")
 
-    release_data = response.json()
-    print(f"✅ Rules deployed successfully!")
-    print(f"   Release: {release_data.get('name')}")
-    print(f"   Ruleset: {release_data.get('rulesetName')}")
-    print(f"   Update time: {release_data.get('updateTime')}")
+    return all(result['status'] != 'failed' for result in results)
 
-    return True
 
 if __name__ == "__main__":
     try:
-        success = deploy_firestore_rules()
+        success = main()
         exit(0 if success else 1)
     except Exception as e:
         print(f"❌ Error: {e}")
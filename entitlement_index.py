@@ -0,0 +1,227 @@
+"""
+In-memory entitlement index: "is this user premium?" without Apple or a
+database round trip.
+
+The index keeps one small entry per stored subscription, loaded from a
+SubscriptionStore snapshot. Writes made by this process are applied
+directly with update(); writes made by other worker processes (validations,
+App Store notifications) reach it through the store's change log, which a
+background thread (start()) follows every refresh_interval seconds, so
+get() never touches the store once the index is loaded. Entries carry their
+expiry, so a subscription stops counting as premium the moment it expires
+without any invalidation.
+"""
+
+import calendar
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger('entitlement_index')
+
+
+class EntitlementIndexUnavailable(Exception):
+    """The index could not be loaded from the store in this process."""
+
+
+class EntitlementIndex:
+    """
+    user_id -> (is_premium, expires_at, product_id, expires_date,
+    environment, updated_at), rebuilt lazily in every process. Both times
+    are kept as epoch seconds.
+
+    Reads are a dict lookup. A record only replaces an entry with an older
+    or equal updated_at, so a refresh that read the store just before a
+    local write landed can't roll the entry back. updated_at is compared
+    as a time, not as a string: isoformat() leaves out zero microseconds.
+    """
+
+    def __init__(self, store, refresh_interval=1.0, change_batch_size=1000,
+                 change_retention_seconds=60 * 60, prune_interval=10 * 60):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self.change_batch_size = change_batch_size
+        self.change_retention_seconds = change_retention_seconds
+        self.prune_interval = prune_interval
+
+        self._entries = {}
+        self._change_seq = 0
+        self._pid = None
+        self._next_refresh = 0.0
+        self._next_prune = 0.0
+        self._refresh_lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def get(self, user_id, now=None):
+        """
+        The user's entitlement: isPremium, productId, expirationDate and
+        environment. Users without a stored subscription are not premium.
+        A dict lookup, unless the index still has to be loaded in this
+        process.
+        """
+        if self._pid != os.getpid():
+            self.refresh()
+
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return {'isPremium': False, 'productId': None, 'expirationDate': None, 'environment': None}
+
+        is_premium, expires_at, product_id, expires_date, environment, _ = entry
+        if now is None:
+            now = time.time()
+        return {
+            'isPremium': is_premium and (expires_at is None or expires_at > now),
+            'productId': product_id,
+            'expirationDate': expires_date,
+            'environment': environment
+        }
+
+    def revoked(self, user_id):
+        """
+        Whether the user's stored subscription has been marked not premium
+        (refund, revocation, lapse). Only reads what is already loaded.
+        """
+        entry = self._entries.get(user_id) if self._pid == os.getpid() else None
+        return entry is not None and not entry[0]
+
+    def update(self, record):
+        """
+        Apply a record this process just wrote to the store.
+        """
+        if self._pid == os.getpid():
+            self._apply([record])
+
+    def start(self):
+        """
+        Load the index and start following the change log in the background.
+        A failed load is logged and retried by the poller.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        try:
+            self.refresh()
+        except EntitlementIndexUnavailable as e:
+            logger.warning("Entitlement index not loaded", extra={'error': str(e)})
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._poll, name='entitlement-index', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _poll(self):
+        while not self._stopping.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except EntitlementIndexUnavailable as e:
+                logger.warning("Entitlement index not loaded", extra={'error': str(e)})
+
+    def refresh(self):
+        """
+        Load the index on first use in this process, then pick up changes
+        committed by other processes. Concurrent callers don't wait for a
+        refresh already in progress; they read the current entries.
+        """
+        loaded = self._pid == os.getpid()
+        if not self._refresh_lock.acquire(blocking=not loaded):
+            return
+        try:
+            if self._pid != os.getpid():
+                self._load()
+            elif time.monotonic() >= self._next_refresh:
+                self._follow_changes()
+        finally:
+            self._refresh_lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, user_id):
+        """
+        Whether the user has a stored subscription. Only reads what is
+        already loaded; False before the index is loaded in this process.
+        """
+        return self._pid == os.getpid() and user_id in self._entries
+
+    def _load(self):
+        try:
+            change_seq, records = self.store.snapshot()
+        except Exception as e:
+            raise EntitlementIndexUnavailable(f"Could not load entitlements: {e}") from e
+
+        entries = {}
+        for record in records:
+            entry = _entry(record)
+            current = entries.get(record['user_id'])
+            if current is None or current[5] <= entry[5]:
+                entries[record['user_id']] = entry
+
+        with self._apply_lock:
+            self._entries = entries
+            self._change_seq = change_seq
+            self._pid = os.getpid()
+        self._next_refresh = time.monotonic() + self.refresh_interval
+        logger.info("Entitlement index loaded", extra={'entries': len(entries)})
+
+    def _follow_changes(self):
+        try:
+            while True:
+                changes = self.store.changes_since(self._change_seq, self.change_batch_size)
+                if changes is None:
+                    # Fell behind the retained change log
+                    logger.warning("Entitlement index fell behind the change log, reloading")
+                    self._load()
+                    break
+                change_seq, records = changes
+                self._apply(records)
+                self._change_seq = change_seq
+                if len(records) < self.change_batch_size:
+                    break
+
+            if time.time() >= self._next_prune:
+                self._next_prune = time.time() + self.prune_interval
+                self.store.prune_changes(time.time() - self.change_retention_seconds)
+        except Exception as e:
+            # Keep serving what we have; the next refresh tries again
+            logger.warning("Entitlement index refresh failed", extra={'error': str(e)})
+        self._next_refresh = time.monotonic() + self.refresh_interval
+
+    def _apply(self, records):
+        with self._apply_lock:
+            for record in records:
+                entry = _entry(record)
+                current = self._entries.get(record['user_id'])
+                if current is None or current[5] <= entry[5]:
+                    self._entries[record['user_id']] = entry
+
+
+def _entry(record):
+    expires_date = record.get('expires_date')
+    expires_at = None
+    if expires_date:
+        # Unreadable expiry: treat as already expired
+        expires_at = _epoch(expires_date, 0.0)
+    updated_at = record.get('updated_at')
+    return (
+        bool(record.get('is_premium', True)),
+        expires_at,
+        record.get('product_id'),
+        expires_date,
+        record.get('environment'),
+        _epoch(updated_at, 0.0) if updated_at else time.time()
+    )
+
+
+def _epoch(value, default):
+    """Epoch seconds of a naive-UTC ISO 8601 time such as '2026-01-01T00:00:00Z'."""
+    try:
+        parsed = datetime.fromisoformat(value.rstrip('Z'))
+    except (TypeError, ValueError):
+        return default
+    return calendar.timegm(parsed.utctimetuple()) + parsed.microsecond / 1e6
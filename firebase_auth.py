@@ -0,0 +1,221 @@
+"""
+Local Firebase ID token verification.
+
+Verifies RS256 ID tokens against Google's published signing keys without a
+network call per request:
+- signing keys are fetched once and kept for the Cache-Control max-age
+- tokens that already passed verification are kept in a bounded LRU until
+  their own `exp`, so repeat requests skip the RSA work entirely
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+logger = logging.getLogger('firebase_auth')
+
+FIREBASE_JWKS_URL = "https://www.googleapis.com/service_accounts/v1/jwk/securetoken@system.gserviceaccount.com"
+FIREBASE_ISSUER_PREFIX = "https://securetoken.google.com/"
+
+# DER prefix of the DigestInfo for SHA-256 (RFC 8017, section 9.2)
+_SHA256_DIGEST_INFO = bytes.fromhex("3031300d060960864801650304020105000420")
+
+
+class InvalidTokenError(ValueError):
+    """The token is malformed, has a bad signature or failed a claim check."""
+
+
+class SigningKeysUnavailable(Exception):
+    """Google's signing keys could not be fetched and none are cached."""
+
+
+def _b64url_decode(segment):
+    try:
+        return base64.urlsafe_b64decode(segment + '=' * (-len(segment) % 4))
+    except (ValueError, TypeError):
+        raise InvalidTokenError("Token segment is not valid base64url")
+
+
+def _rsa_pkcs1_sha256_verify(n, e, message, signature):
+    """
+    RSASSA-PKCS1-v1_5 verification with SHA-256. Verification only uses
+    public values, so plain modular exponentiation is safe here.
+    """
+    k = (n.bit_length() + 7) // 8
+    if len(signature) != k:
+        return False
+
+    s = int.from_bytes(signature, 'big')
+    if s >= n:
+        return False
+
+    encoded = pow(s, e, n).to_bytes(k, 'big')
+    digest_info = _SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+    padding_length = k - len(digest_info) - 3
+    if padding_length < 8:
+        return False
+    expected = b'\x00\x01' + b'\xff' * padding_length + b'\x00' + digest_info
+    return hmac.compare_digest(encoded, expected)
+
+
+class FirebaseTokenVerifier:
+    """
+    Verifies Firebase ID tokens for one project.
+
+    verify() returns the decoded claims with `uid` set, or raises
+    InvalidTokenError / SigningKeysUnavailable.
+    """
+
+    def __init__(self, project_id, jwks_url=FIREBASE_JWKS_URL, session=None,
+                 token_cache_size=10000, clock_skew_seconds=60,
+                 default_keys_max_age=3600, unknown_kid_refresh_seconds=60,
+                 fetch_timeout=5):
+        self.project_id = project_id
+        self.issuer = FIREBASE_ISSUER_PREFIX + project_id
+        self.jwks_url = jwks_url
+        self.session = session or requests.Session()
+        self.token_cache_size = token_cache_size
+        self.clock_skew_seconds = clock_skew_seconds
+        self.default_keys_max_age = default_keys_max_age
+        self.unknown_kid_refresh_seconds = unknown_kid_refresh_seconds
+        self.fetch_timeout = fetch_timeout
+
+        self._keys = {}                 # kid -> (n, e)
+        self._keys_expire_at = 0.0
+        self._keys_fetched_at = 0.0
+        self._keys_lock = threading.Lock()
+
+        self._tokens = OrderedDict()    # token -> (exp, claims)
+        self._tokens_lock = threading.Lock()
+
+    def cached(self, token):
+        """
+        Claims for a token that was already verified and hasn't expired,
+        or None. Never does network or RSA work.
+        """
+        now = time.time()
+        with self._tokens_lock:
+            entry = self._tokens.get(token)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._tokens[token]
+                return None
+            self._tokens.move_to_end(token)
+            return dict(entry[1])
+
+    def verify(self, token):
+        claims = self.cached(token)
+        if claims is not None:
+            return claims
+
+        claims = self._verify_uncached(token, time.time())
+
+        with self._tokens_lock:
+            self._tokens[token] = (claims['exp'], claims)
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.token_cache_size:
+                self._tokens.popitem(last=False)
+
+        return dict(claims)
+
+    def _verify_uncached(self, token, now):
+        parts = token.split('.')
+        if len(parts) != 3:
+            raise InvalidTokenError("Token must have three segments")
+
+        try:
+            header = json.loads(_b64url_decode(parts[0]))
+            claims = json.loads(_b64url_decode(parts[1]))
+        except ValueError:
+            raise InvalidTokenError("Token segments are not valid JSON")
+        if not isinstance(header, dict) or not isinstance(claims, dict):
+            raise InvalidTokenError("Token segments are not JSON objects")
+
+        if header.get('alg') != 'RS256':
+            raise InvalidTokenError("Unexpected token algorithm")
+
+        key = self._signing_key(header.get('kid'))
+        signing_input = (parts[0] + '.' + parts[1]).encode('ascii')
+        if not _rsa_pkcs1_sha256_verify(key[0], key[1], signing_input, _b64url_decode(parts[2])):
+            raise InvalidTokenError("Invalid token signature")
+
+        if claims.get('aud') != self.project_id:
+            raise InvalidTokenError("Token has the wrong audience")
+        if claims.get('iss') != self.issuer:
+            raise InvalidTokenError("Token has the wrong issuer")
+
+        subject = claims.get('sub')
+        if not isinstance(subject, str) or not subject or len(subject) > 128:
+            raise InvalidTokenError("Token has an invalid subject")
+
+        exp = claims.get('exp')
+        iat = claims.get('iat')
+        if not isinstance(exp, (int, float)) or exp <= now - self.clock_skew_seconds:
+            raise InvalidTokenError("Token has expired")
+        if not isinstance(iat, (int, float)) or iat > now + self.clock_skew_seconds:
+            raise InvalidTokenError("Token was issued in the future")
+        auth_time = claims.get('auth_time')
+        if auth_time is not None and auth_time > now + self.clock_skew_seconds:
+            raise InvalidTokenError("Token has an invalid auth_time")
+
+        claims['uid'] = subject
+        return claims
+
+    def _signing_key(self, kid):
+        if not kid:
+            raise InvalidTokenError("Token has no key ID")
+
+        now = time.time()
+        with self._keys_lock:
+            key = self._keys.get(kid)
+            if key is not None and now < self._keys_expire_at:
+                return key
+
+            # Refresh on expiry, or on an unknown kid (Google rotated keys),
+            # but don't let bad tokens make us hammer the endpoint.
+            stale = now >= self._keys_expire_at
+            if stale or now - self._keys_fetched_at >= self.unknown_kid_refresh_seconds:
+                try:
+                    self._refresh_keys(now)
+                except (requests.RequestException, ValueError) as e:
+                    self._keys_fetched_at = now
+                    if not self._keys:
+                        raise SigningKeysUnavailable(str(e))
+                    logger.warning("Signing key refresh failed, using cached keys", extra={'error': str(e)})
+
+            key = self._keys.get(kid)
+            if key is None:
+                raise InvalidTokenError("Token signed with an unknown key")
+            return key
+
+    def _refresh_keys(self, now):
+        response = self.session.get(self.jwks_url, timeout=self.fetch_timeout)
+        response.raise_for_status()
+        keys = {}
+        for jwk in response.json().get('keys', []):
+            if jwk.get('kty') != 'RSA' or not jwk.get('kid'):
+                continue
+            n = int.from_bytes(_b64url_decode(jwk['n']), 'big')
+            e = int.from_bytes(_b64url_decode(jwk['e']), 'big')
+            keys[jwk['kid']] = (n, e)
+        if not keys:
+            raise ValueError("No RSA signing keys in response")
+
+        max_age = self.default_keys_max_age
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        if match:
+            max_age = int(match.group(1))
+
+        self._keys = keys
+        self._keys_fetched_at = now
+        self._keys_expire_at = now + max_age
+        logger.info("Loaded signing keys", extra={'keys': len(keys), 'max_age': max_age})
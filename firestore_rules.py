@@ -0,0 +1,764 @@
+"""
+Offline evaluator for firestore.rules.
+
+compile_rules() parses a rules file and compiles its match blocks into a
+path trie (literal segments in a dict, {wildcards} and {glob=**} tails as
+branches) whose leaves hold the allow conditions for each of the five
+request methods, compiled to Python closures. RulesEngine.check() and
+check_batch() then answer (auth uid, path, operation) requests without the
+emulator or a live project:
+
+    engine = load_rules('firestore.rules')
+    engine.check('u1', 'users/u1/recordings/r1', 'get')          # True
+    engine.check_batch([(None, 'users/u1', 'update'), ...])      # [False, ...]
+
+A request is allowed if any allow statement of any matching block grants
+its method, as in Firestore. read covers get and list, write covers create,
+update and delete. A list request names a collection and matches the rules
+for documents in it, with the document wildcard bound to no particular ID.
+Conditions that raise an error (e.g. request.auth.uid without auth) deny,
+and && / || tolerate an error on one side when the other decides the
+result, as Firestore does.
+
+Supported: rules_version 1 and 2, nested match blocks, functions, the
+usual operators, member/index access and the common string/list/map
+methods, and request.resource / resource for the incoming and existing
+document. Calls that read other documents (get(), exists(), ...), path
+literals and request.time (there are no timestamp or duration values
+offline) are not available and raise FirestoreRulesError at compile time.
+"""
+
+import re
+
+OPERATIONS = ('get', 'list', 'create', 'update', 'delete')
+
+_METHOD_GROUPS = {
+    'read': ('get', 'list'),
+    'write': ('create', 'update', 'delete'),
+}
+for _operation in OPERATIONS:
+    _METHOD_GROUPS[_operation] = (_operation,)
+
+DOCUMENTS_PREFIX = ('databases', '(default)', 'documents')
+
+
+class FirestoreRulesError(ValueError):
+    """The rules file can't be parsed or compiled."""
+
+
+class _EvalError(Exception):
+    """A condition errored while being evaluated (treated as deny)."""
+
+
+class _AnyDocument:
+    """The document ID a list request is matched with: equal to nothing."""
+
+    def __repr__(self):
+        return '<any document>'
+
+
+ANY_DOCUMENT = _AnyDocument()
+
+
+# Tokenizer
+
+_TOKEN = re.compile(r'''
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+  | (?P<number>\d+(?:\.\d+)?)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<op>&&|\|\||==|!=|<=|>=|[-+*/%<>!.,;:(){}\[\]=?])
+''', re.S | re.X)
+# The path after `match`, e.g. /users/{userId}/{document=**}
+_PATH = re.compile(r'(?:/(?:\{[^}\s]*\}|[^/\s{}]+))+')
+
+
+def _tokenize(text):
+    tokens = []
+    position, end = 0, len(text)
+    while position < end:
+        match = None
+        if tokens and tokens[-1][:2] == ('name', 'match'):
+            match = _PATH.match(text, position)
+        if match is not None:
+            tokens.append(('path', match.group(), text.count('\n', 0, position) + 1))
+            position = match.end()
+            continue
+        match = _TOKEN.match(text, position)
+        if match is None:
+            line = text.count('\n', 0, position) + 1
+            raise FirestoreRulesError(f"Unexpected character {text[position]!r} on line {line}")
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            continue
+        value = match.group()
+        if kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'string':
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        tokens.append((kind, value, text.count('\n', 0, match.start()) + 1))
+    tokens.append(('end', None, text.count('\n') + 1))
+    return tokens
+
+
+# Parser: rules file -> match tree, expressions -> tuples
+
+class _Match:
+    def __init__(self, segments):
+        self.segments = segments      # [('literal', s) | ('var', name) | ('glob', name)]
+        self.allows = []              # [(operations, expression or None)]
+        self.functions = {}
+        self.children = []
+
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.pos = 0
+        self.version = 1
+
+    def parse(self):
+        if self._accept('name', 'rules_version'):
+            self._expect('op', '=')
+            self.version = int(float(self._expect('string')))
+            self._expect('op', ';')
+        self._expect('name', 'service')
+        service = [self._expect('name')]
+        while self._accept('op', '.'):
+            service.append(self._expect('name'))
+        if '.'.join(service) != 'cloud.firestore':
+            raise FirestoreRulesError(f"Not a Firestore rules file: service {'.'.join(service)}")
+        root = _Match([])
+        self._block(root)
+        self._expect('end')
+        return root
+
+    def _block(self, match):
+        self._expect('op', '{')
+        while not self._accept('op', '}'):
+            if self._accept('name', 'match'):
+                child = _Match(self._path())
+                self._block(child)
+                match.children.append(child)
+            elif self._accept('name', 'allow'):
+                operations = []
+                while True:
+                    method = self._expect('name')
+                    if method not in _METHOD_GROUPS:
+                        self.pos -= 1
+                        self._fail("Unknown method")
+                    operations.extend(_METHOD_GROUPS[method])
+                    if not self._accept('op', ','):
+                        break
+                condition = None
+                if self._accept('op', ':'):
+                    self._expect('name', 'if')
+                    condition = self._expression()
+                self._expect('op', ';')
+                match.allows.append((tuple(operations), condition))
+            elif self._accept('name', 'function'):
+                name = self._expect('name')
+                self._expect('op', '(')
+                params = []
+                while not self._accept('op', ')'):
+                    params.append(self._expect('name'))
+                    self._accept('op', ',')
+                self._expect('op', '{')
+                self._expect('name', 'return')
+                body = self._expression()
+                self._accept('op', ';')
+                self._expect('op', '}')
+                match.functions[name] = (params, body)
+            elif not self._accept('op', ';'):
+                self._fail("Expected match, allow or function")
+
+    def _path(self):
+        path = self._expect('path')
+        segments = []
+        for part in path.strip('/').split('/'):
+            if part.startswith('{') and part.endswith('}'):
+                name = part[1:-1]
+                if name.endswith('=**'):
+                    segments.append(('glob', name[:-3]))
+                else:
+                    segments.append(('var', name))
+            else:
+                segments.append(('literal', part))
+        return segments
+
+    # Expressions, lowest precedence first
+
+    def _expression(self):
+        condition = self._or()
+        if self._accept('op', '?'):
+            if_true = self._expression()
+            self._expect('op', ':')
+            return ('?', condition, if_true, self._expression())
+        return condition
+
+    def _or(self):
+        left = self._and()
+        while self._accept('op', '||'):
+            left = ('||', left, self._and())
+        return left
+
+    def _and(self):
+        left = self._comparison()
+        while self._accept('op', '&&'):
+            left = ('&&', left, self._comparison())
+        return left
+
+    def _comparison(self):
+        left = self._additive()
+        while True:
+            kind, value, _ = self.tokens[self.pos]
+            if kind == 'op' and value in ('==', '!=', '<', '<=', '>', '>='):
+                self.pos += 1
+                left = (value, left, self._additive())
+            elif kind == 'name' and value in ('in', 'is'):
+                self.pos += 1
+                right = ('literal', self._expect('name')) if value == 'is' else self._additive()
+                left = (value, left, right)
+            else:
+                return left
+
+    def _additive(self):
+        left = self._multiplicative()
+        while True:
+            kind, value, _ = self.tokens[self.pos]
+            if kind == 'op' and value in ('+', '-'):
+                self.pos += 1
+                left = (value, left, self._multiplicative())
+            else:
+                return left
+
+    def _multiplicative(self):
+        left = self._unary()
+        while True:
+            kind, value, _ = self.tokens[self.pos]
+            if kind == 'op' and value in ('*', '/', '%'):
+                self.pos += 1
+                left = (value, left, self._unary())
+            else:
+                return left
+
+    def _unary(self):
+        if self._accept('op', '!'):
+            return ('!', self._unary())
+        if self._accept('op', '-'):
+            return ('neg', self._unary())
+        return self._postfix()
+
+    def _postfix(self):
+        node = self._primary()
+        while True:
+            if self._accept('op', '.'):
+                name = self._expect('name')
+                if self._accept('op', '('):
+                    node = ('method', node, name, self._arguments())
+                else:
+                    node = ('member', node, name)
+            elif self._accept('op', '['):
+                index = self._expression()
+                self._expect('op', ']')
+                node = ('index', node, index)
+            else:
+                return node
+
+    def _arguments(self):
+        arguments = []
+        while not self._accept('op', ')'):
+            arguments.append(self._expression())
+            if not self._accept('op', ','):
+                self._expect('op', ')')
+                break
+        return arguments
+
+    def _primary(self):
+        kind, value, _ = self.tokens[self.pos]
+        self.pos += 1
+        if kind in ('number', 'string'):
+            return ('literal', value)
+        if kind == 'name':
+            if value in ('true', 'false'):
+                return ('literal', value == 'true')
+            if value == 'null':
+                return ('literal', None)
+            if self._accept('op', '('):
+                return ('call', value, self._arguments())
+            return ('var', value)
+        if kind == 'op' and value == '(':
+            node = self._expression()
+            self._expect('op', ')')
+            return node
+        if kind == 'op' and value == '[':
+            items = []
+            while not self._accept('op', ']'):
+                items.append(self._expression())
+                self._accept('op', ',')
+            return ('list', items)
+        self.pos -= 1
+        self._fail("Expected an expression")
+
+    # Token helpers
+
+    def _accept(self, kind, value=None):
+        token = self.tokens[self.pos]
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return True
+        return False
+
+    def _expect(self, kind, value=None):
+        token = self.tokens[self.pos]
+        if token[0] != kind or (value is not None and token[1] != value):
+            self._fail(f"Expected {value or kind}")
+        self.pos += 1
+        return token[1]
+
+    def _fail(self, message):
+        kind, value, line = self.tokens[self.pos]
+        found = 'end of file' if kind == 'end' else repr(value)
+        raise FirestoreRulesError(f"{message} on line {line}, found {found}")
+
+
+# Expression compiler: tuples -> closures over an environment dict
+
+_COMPARISONS = {
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '+': lambda a, b: a + b,
+    '-': lambda a, b: a - b,
+    '*': lambda a, b: a * b,
+    '/': lambda a, b: a / b,
+    '%': lambda a, b: a % b,
+}
+
+_TYPES = {
+    'string': str, 'int': int, 'float': float, 'number': (int, float), 'bool': bool,
+    'list': list, 'map': dict, 'null': type(None), 'path': str,
+}
+
+_METHODS = {
+    'size': lambda value: len(value),
+    'keys': lambda value: list(value.keys()),
+    'values': lambda value: list(value.values()),
+    'hasAll': lambda value, items: all(item in value for item in items),
+    'hasAny': lambda value, items: any(item in value for item in items),
+    'hasOnly': lambda value, items: all(item in items for item in value),
+    'matches': lambda value, pattern: re.fullmatch(pattern, value) is not None,
+    'lower': lambda value: value.lower(),
+    'upper': lambda value: value.upper(),
+    'split': lambda value, separator: value.split(separator),
+    'get': lambda value, key, default: value.get(key, default),
+}
+
+# Functions that need database or service state the offline engine doesn't have
+_UNAVAILABLE = ('get', 'exists', 'getAfter', 'existsAfter', 'debug')
+
+
+def _compile_expression(node, functions):
+    kind = node[0]
+
+    if kind == 'literal':
+        value = node[1]
+        return lambda env: value
+
+    if kind == 'var':
+        name = node[1]
+
+        def variable(env):
+            try:
+                return env[name]
+            except KeyError:
+                raise _EvalError(f"Unknown variable {name}")
+        return variable
+
+    if kind == 'list':
+        items = [_compile_expression(item, functions) for item in node[1]]
+        return lambda env: [item(env) for item in items]
+
+    if kind == 'member':
+        # a.b.c is one lookup chain rather than nested closures
+        names = []
+        while node[0] == 'member':
+            names.append(node[2])
+            node = node[1]
+        names.reverse()
+        root = node[1] if node[0] == 'var' else None
+        if root == 'request' and names[0] == 'time':
+            raise FirestoreRulesError("request.time can't be evaluated offline")
+        target = None if root is not None else _compile_expression(node, functions)
+
+        def member(env):
+            try:
+                value = env[root] if target is None else target(env)
+                for name in names:
+                    value = value[name]
+            except (KeyError, TypeError, IndexError):
+                raise _EvalError(f"No field {'.'.join(names)}")
+            return value
+        return member
+
+    if kind == 'index':
+        target = _compile_expression(node[1], functions)
+        index = _compile_expression(node[2], functions)
+
+        def subscript(env):
+            try:
+                return target(env)[index(env)]
+            except (KeyError, IndexError, TypeError):
+                raise _EvalError("Bad index")
+        return subscript
+
+    if kind == '&&':
+        left = _compile_expression(node[1], functions)
+        right = _compile_expression(node[2], functions)
+
+        def conjunction(env):
+            try:
+                if left(env) is not True:
+                    return False
+            except _EvalError:
+                if right(env) is not True:
+                    return False
+                raise
+            return right(env) is True
+        return conjunction
+
+    if kind == '||':
+        left = _compile_expression(node[1], functions)
+        right = _compile_expression(node[2], functions)
+
+        def disjunction(env):
+            try:
+                if left(env) is True:
+                    return True
+            except _EvalError:
+                if right(env) is True:
+                    return True
+                raise
+            return right(env) is True
+        return disjunction
+
+    if kind == '!':
+        operand = _compile_expression(node[1], functions)
+
+        def negation(env):
+            value = operand(env)
+            if not isinstance(value, bool):
+                raise _EvalError("! needs a bool")
+            return not value
+        return negation
+
+    if kind == 'neg':
+        operand = _compile_expression(node[1], functions)
+        return lambda env: -operand(env)
+
+    if kind == '?':
+        condition = _compile_expression(node[1], functions)
+        if_true = _compile_expression(node[2], functions)
+        if_false = _compile_expression(node[3], functions)
+        return lambda env: if_true(env) if condition(env) is True else if_false(env)
+
+    if kind == 'in':
+        item = _compile_expression(node[1], functions)
+        container = _compile_expression(node[2], functions)
+
+        def membership(env):
+            try:
+                return item(env) in container(env)
+            except TypeError:
+                raise _EvalError("Bad operands for in")
+        return membership
+
+    if kind == 'is':
+        value = _compile_expression(node[1], functions)
+        type_name = node[2][1]
+        if type_name not in _TYPES:
+            raise FirestoreRulesError(f"Unknown type {type_name}")
+        expected = _TYPES[type_name]
+
+        def type_check(env):
+            result = value(env)
+            if type_name in ('int', 'float', 'number') and isinstance(result, bool):
+                return False
+            return isinstance(result, expected)
+        return type_check
+
+    if kind in _COMPARISONS:
+        operation = _COMPARISONS[kind]
+        left = _compile_expression(node[1], functions)
+        right = _compile_expression(node[2], functions)
+        if kind in ('==', '!='):
+            if node[2][0] == 'literal':
+                value = node[2][1]
+                if kind == '==':
+                    return lambda env: left(env) == value
+                return lambda env: left(env) != value
+            if kind == '==':
+                return lambda env: left(env) == right(env)
+            return lambda env: left(env) != right(env)
+
+        def arithmetic(env):
+            try:
+                return operation(left(env), right(env))
+            except (TypeError, ZeroDivisionError):
+                raise _EvalError(f"Bad operands for {kind}")
+        return arithmetic
+
+    if kind == 'method':
+        target = _compile_expression(node[1], functions)
+        name = node[2]
+        if name not in _METHODS:
+            raise FirestoreRulesError(f"Unsupported method .{name}()")
+        method = _METHODS[name]
+        arguments = [_compile_expression(argument, functions) for argument in node[3]]
+
+        def call_method(env):
+            try:
+                return method(target(env), *[argument(env) for argument in arguments])
+            except (TypeError, AttributeError, ValueError, re.error):
+                raise _EvalError(f"Bad call to .{name}()")
+        return call_method
+
+    if kind == 'call':
+        name = node[1]
+        if name not in functions:
+            if name in _UNAVAILABLE:
+                raise FirestoreRulesError(f"{name}() reads database state and can't be evaluated offline")
+            raise FirestoreRulesError(f"Unknown function {name}()")
+        params, body = functions[name]
+        if len(params) != len(node[2]):
+            raise FirestoreRulesError(f"{name}() takes {len(params)} arguments")
+        arguments = [_compile_expression(argument, functions) for argument in node[2]]
+        # Bodies are compiled on first call, so functions may refer to each other
+        compiled = []
+
+        def call(env):
+            if not compiled:
+                compiled.append(_compile_expression(body, functions))
+            scope = dict(env)
+            for param, argument in zip(params, arguments):
+                scope[param] = argument(env)
+            return compiled[0](scope)
+        return call
+
+    raise FirestoreRulesError(f"Unsupported expression {kind}")
+
+
+def _always(env):
+    return True
+
+
+# Path trie
+
+class _Node:
+    __slots__ = ('literals', 'variables', 'globs', 'grants')
+
+    def __init__(self):
+        self.literals = {}      # segment -> _Node
+        self.variables = []     # [(name, _Node)]
+        self.globs = []         # [(name, grants)]: {name=**} tails
+        self.grants = None      # {operation: [condition]} for paths ending here
+
+    def child(self, segment):
+        kind, value = segment
+        if kind == 'literal':
+            node = self.literals.get(value)
+            if node is None:
+                node = self.literals[value] = _Node()
+            return node
+        for name, node in self.variables:
+            if name == value:
+                return node
+        node = _Node()
+        self.variables.append((value, node))
+        return node
+
+
+def _add_grants(grants, allows, functions):
+    for operations, condition in allows:
+        compiled = _always if condition is None else _compile_expression(condition, functions)
+        for operation in operations:
+            grants.setdefault(operation, []).append(compiled)
+
+
+class RulesEngine:
+    """
+    Compiled rules. check() answers one request; check_batch() answers many.
+
+    Which blocks match a path depends only on its shape: segments that are
+    not a literal anywhere in the rules behave alike, whatever their value.
+    Matches are cached per (shape, operation), with wildcard values taken
+    from the request path by position, so after warm-up a check is one
+    dict lookup plus the conditions themselves.
+    """
+
+    MATCH_CACHE_SIZE = 100000
+
+    def __init__(self, root, version):
+        self.version = version
+        self.root = _Node()
+        self._literals = {}          # Every literal path segment, mapped to itself
+        self._match_cache = {}
+        self._compile(root, self.root, {})
+
+    def _compile(self, match, node, functions):
+        functions = dict(functions, **match.functions)
+        for child in match.children:
+            target = node
+            segments = child.segments
+            for index, segment in enumerate(segments):
+                if segment[0] == 'glob':
+                    if index != len(segments) - 1 or child.children:
+                        raise FirestoreRulesError("{name=**} is only supported at the end of a path")
+                    grants = {}
+                    _add_grants(grants, child.allows, dict(functions, **child.functions))
+                    target.globs.append((segment[1], grants))
+                    break
+                if segment[0] == 'literal':
+                    self._literals[segment[1]] = segment[1]
+                target = target.child(segment)
+            else:
+                if target.grants is None:
+                    target.grants = {}
+                _add_grants(target.grants, child.allows, dict(functions, **child.functions))
+                self._compile(child, target, functions)
+
+    def matches(self, path, operation):
+        """
+        [(conditions, bindings)] for the blocks granting operation on path.
+        """
+        prefix, segments = _split(path, operation)
+        return [(conditions, _bind(segments, constants, variables, glob))
+                for conditions, constants, variables, glob in self._match(prefix, segments, operation)]
+
+    def _match(self, prefix, segments, operation):
+        """
+        [(conditions, constants, variables, glob)] for the blocks granting
+        operation on prefix + segments: wildcard values bound within the
+        database prefix, (name, index) of the others in segments, and the
+        (name, start, prefix part) of a {name=**} tail.
+        """
+        shape = tuple(map(self._literals.get, segments))
+        key = (None if prefix is DOCUMENTS_PREFIX else prefix, shape, operation)
+        found = self._match_cache.get(key)
+        if found is None:
+            walked = []
+            full_shape = tuple(map(self._literals.get, prefix)) + shape
+            self._walk(self.root, full_shape, 0, (), operation, walked)
+            offset = len(prefix)
+            found = []
+            for conditions, variables, glob in walked:
+                constants = {name: prefix[index] for name, index in variables if index < offset}
+                relative = tuple((name, index - offset) for name, index in variables if index >= offset)
+                if glob is not None:
+                    name, start = glob
+                    glob = (name, max(0, start - offset), '/'.join(prefix[start:offset]))
+                found.append((conditions, constants, relative, glob))
+            if len(self._match_cache) >= self.MATCH_CACHE_SIZE:
+                self._match_cache.clear()
+            self._match_cache[key] = found
+        return found
+
+    def _walk(self, node, shape, index, variables, operation, found):
+        for name, grants in node.globs:
+            if (index < len(shape) or self.version >= 2) and operation in grants:
+                found.append((grants[operation], variables, (name, index)))
+        if index == len(shape):
+            if node.grants and operation in node.grants:
+                found.append((node.grants[operation], variables, None))
+            return
+        segment = shape[index]
+        if segment is not None:
+            child = node.literals.get(segment)
+            if child is not None:
+                self._walk(child, shape, index + 1, variables, operation, found)
+        for name, child in node.variables:
+            self._walk(child, shape, index + 1, variables + ((name, index),), operation, found)
+
+    def check(self, uid, path, operation, auth=None, resource=None, request_resource=None):
+        """
+        Whether the request is allowed. uid None means unauthenticated;
+        auth may give the whole request.auth map (uid, token) instead.
+        resource is the existing document's data and request_resource the
+        data being written (request.resource), if the rules look at them.
+        """
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation {operation!r}")
+        prefix, segments = _split(path, operation)
+        found = self._match(prefix, segments, operation)
+        if not found:
+            return False
+        if auth is None and uid is not None:
+            auth = {'uid': uid, 'token': {}}
+        request = {'auth': auth, 'method': operation, 'path': path,
+                   'resource': {'data': request_resource} if request_resource is not None else None}
+        resource = {'data': resource} if resource is not None else None
+        for conditions, constants, variables, glob in found:
+            env = _bind(segments, constants, variables, glob)
+            env['request'] = request
+            env['resource'] = resource
+            for condition in conditions:
+                try:
+                    if condition(env) is True:
+                        return True
+                except Exception:
+                    # An error in a condition denies, like in Firestore
+                    continue
+        return False
+
+    def check_batch(self, requests):
+        """
+        [allowed] for an iterable of (uid, path, operation) tuples.
+        """
+        check = self.check
+        return [check(uid, path, operation) for uid, path, operation in requests]
+
+
+def _split(path, operation):
+    """
+    (database prefix, segments below it) of a request path, which may be
+    given relative to /databases/(default)/documents. A list request gets
+    ANY_DOCUMENT appended for the document wildcard.
+    """
+    segments = path.strip('/').split('/')
+    if '' in segments:
+        segments = [segment for segment in segments if segment]
+    prefix = DOCUMENTS_PREFIX
+    if len(segments) >= 3 and segments[0] == 'databases' and segments[2] == 'documents':
+        prefix = tuple(segments[:3])
+        segments = segments[3:]
+    if operation == 'list':
+        segments.append(ANY_DOCUMENT)
+    return prefix, segments
+
+
+def _bind(segments, constants, variables, glob):
+    bindings = dict(constants)
+    for name, index in variables:
+        bindings[name] = segments[index]
+    if glob is not None:
+        name, start, prefix_part = glob
+        tail = segments[start:]
+        if tail and tail[-1] is ANY_DOCUMENT:
+            tail = tail[:-1]
+        bindings[name] = '/'.join(([prefix_part] if prefix_part else []) + tail)
+    return bindings
+
+
+def compile_rules(text):
+    parser = _Parser(text)
+    root = parser.parse()
+    return RulesEngine(root, parser.version)
+
+
+def load_rules(path='firestore.rules'):
+    with open(path, 'r') as f:
+        return compile_rules(f.read())
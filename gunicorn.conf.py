@@ -0,0 +1,87 @@
+"""
+Gunicorn configuration for the receipt validation backend.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Runs behind nginx_braindumpster.conf (proxy_pass http://127.0.0.1:5001).
+Most of a request is spent waiting on Apple, so the default worker is
+gthread: a few processes, many threads each. Set GUNICORN_WORKER_CLASS to
+an async worker (e.g. gevent) to hold even more pending Apple calls.
+
+Signals:
+    HUP   start new workers with the current config, then gracefully stop
+          the old ones (in-flight Apple calls finish first)
+    TERM  graceful shutdown, waiting up to graceful_timeout
+    USR2  start a new master with new code (zero-downtime upgrade)
+"""
+import multiprocessing
+import os
+
+# Must be set before the app module is imported (preload below)
+os.environ.setdefault('METRICS_DIR', '/tmp/braindumpster-metrics')
+
+NGINX_PROXY_READ_TIMEOUT = 60
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:5001')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))  # async workers
+
+# Load config and build shared objects once in the master; workers fork from it
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# A request can legitimately take APPLE_REQUEST_DEADLINE + connect against
+# Apple, which is kept under nginx's proxy_read_timeout; anything slower is stuck.
+timeout = NGINX_PROXY_READ_TIMEOUT + 15
+graceful_timeout = NGINX_PROXY_READ_TIMEOUT
+keepalive = 75
+
+# Recycle workers now and then to bound memory growth from caches
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 20000))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+proc_name = 'braindumpster-receipts'
+
+
+def on_starting(server):
+    from metrics import reset_metrics_dir
+    reset_metrics_dir(os.environ.get('METRICS_DIR'))
+
+
+def when_ready(server):
+    import receipt_validation_endpoint as rv
+
+    worst_case = rv.APPLE_REQUEST_DEADLINE + rv.APPLE_CONNECT_TIMEOUT
+    if worst_case >= NGINX_PROXY_READ_TIMEOUT:
+        server.log.warning(
+            "Apple worst case %ss exceeds nginx proxy_read_timeout %ss",
+            worst_case, NGINX_PROXY_READ_TIMEOUT
+        )
+
+
+def post_fork(server, worker):
+    import receipt_validation_endpoint as rv
+    rv.start_background_services()
+
+
+def worker_exit(server, worker):
+    import receipt_validation_endpoint as rv
+    rv.stop_background_services()
+    # The exiting worker's counters live on in its snapshot file
+    try:
+        rv.metrics.flush()
+    except OSError as e:
+        server.log.warning("Could not write metrics snapshot: %s", e)
+
+
+def child_exit(server, worker):
+    # Runs in the master once the worker is gone: fold its snapshot into the
+    # aggregate so recycled workers (max_requests) don't pile up files
+    from metrics import retire_snapshot
+    try:
+        retire_snapshot(os.environ.get('METRICS_DIR'), worker.pid)
+    except OSError as e:
+        server.log.warning("Could not retire metrics snapshot: %s", e)
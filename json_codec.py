@@ -0,0 +1,41 @@
+"""
+JSON encoding for request/response bodies and Apple verifyReceipt calls.
+
+Uses orjson when it is installed (pip install orjson), which parses and
+writes bytes directly and is several times faster than the standard
+library on large receipts and purchase histories; falls back to the json
+module otherwise. loads() accepts bytes or str, dumps() returns bytes.
+
+dumps(obj, default) calls default for objects the codec can't encode, as
+json.dumps does. With a default, orjson hands it datetimes too, so both
+backends write them the same way.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:  # Optional: the stdlib codec is used instead
+    orjson = None
+
+# Raised by loads() on malformed input; a ValueError either way
+JSONDecodeError = orjson.JSONDecodeError if orjson is not None else json.JSONDecodeError
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+
+if orjson is not None:
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj, default=None):
+        if default is None:
+            return orjson.dumps(obj)
+        return orjson.dumps(obj, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+else:
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj, default=None):
+        return json.dumps(obj, separators=(',', ':'), default=default).encode()
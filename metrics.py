@@ -0,0 +1,281 @@
+"""
+In-process latency histograms and counters with Prometheus text export.
+
+Each process records into its own MetricsRegistry. When a metrics directory
+is configured, every process periodically snapshots its values to
+<dir>/<pid>.json, and render_prometheus() sums the snapshots of all
+processes, so any worker can answer a scrape for the whole server. When a
+worker exits, retire_snapshot() folds its snapshot into <dir>/aggregate.json,
+so recycled workers don't leave a file each behind.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+AGGREGATE_SNAPSHOT = 'aggregate.json'
+
+DEFAULT_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+
+def _labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in (labels or {}).items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels_key, extra=None):
+    pairs = list(labels_key) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class MetricsRegistry:
+    """
+    Thread-safe counters and fixed-bucket histograms.
+
+    Metrics are declared once with counter() / histogram() and then updated
+    with inc() / observe() / timer().
+    """
+
+    def __init__(self, metrics_dir=None, flush_interval=5.0):
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+
+        self._meta = {}          # name -> (type, help, buckets)
+        self._counters = {}      # (name, labels_key) -> float
+        self._histograms = {}    # (name, labels_key) -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+        self._flusher = None
+        self._flusher_pid = None
+        self._flush_lock = threading.Lock()
+
+    # Declaration
+
+    def counter(self, name, help_text):
+        self._meta[name] = ('counter', help_text, None)
+
+    def histogram(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+
+    # Recording
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, _labels_key(labels))
+        self._ensure_flusher()
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        buckets = self._meta[name][2]
+        key = (name, _labels_key(labels))
+        self._ensure_flusher()
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[index] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def timer(self, name, labels=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels)
+
+    # Multi-process snapshots
+
+    def _snapshot(self):
+        with self._lock:
+            return _to_snapshot(self._counters, self._histograms)
+
+    def flush(self):
+        """
+        Write this process's values to <metrics_dir>/<pid>.json (atomically).
+        Also call it when a process exits, so the values recorded since the
+        last periodic flush still count.
+        """
+        if not self.metrics_dir:
+            return
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, f'{os.getpid()}.json')
+        tmp_path = path + '.tmp'
+        with self._flush_lock:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._snapshot(), f)
+            os.replace(tmp_path, path)
+
+    def _ensure_flusher(self):
+        if not self.metrics_dir or self._flusher_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+            # Values inherited across fork belong to the parent's snapshot
+            if self._flusher is not None:
+                self._counters.clear()
+                self._histograms.clear()
+            self._flusher = threading.Thread(
+                target=self._flush_loop,
+                name='metrics-flush',
+                daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def _collect(self):
+        """
+        Merge this process's live values with every other process's snapshot.
+        """
+        snapshots = [self._snapshot()]
+        if self.metrics_dir and os.path.isdir(self.metrics_dir):
+            own = f'{os.getpid()}.json'
+            for filename in os.listdir(self.metrics_dir):
+                if not filename.endswith('.json') or filename == own:
+                    continue
+                try:
+                    with open(os.path.join(self.metrics_dir, filename)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+
+        return _merge(snapshots)
+
+    # Export
+
+    def render_prometheus(self):
+        counters, histograms = self._collect()
+        lines = []
+
+        for name, (metric_type, help_text, buckets) in sorted(self._meta.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+
+            if metric_type == 'counter':
+                for (series_name, labels), value in sorted(counters.items()):
+                    if series_name == name:
+                        lines.append(f'{name}{_format_labels(labels)} {value}')
+                continue
+
+            for (series_name, labels), series in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, series):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {series[-1]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {series[-2]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {series[-1]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _to_snapshot(counters, histograms):
+    return {
+        'counters': [[name, list(map(list, labels)), value]
+                     for (name, labels), value in counters.items()],
+        'histograms': [[name, list(map(list, labels)), list(series)]
+                       for (name, labels), series in histograms.items()]
+    }
+
+
+def _merge(snapshots):
+    """
+    (counters, histograms) summed over snapshots.
+    """
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, series in snapshot['histograms']:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = list(series)
+            elif len(merged) == len(series):
+                histograms[key] = [a + b for a, b in zip(merged, series)]
+    return counters, histograms
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def retire_snapshot(metrics_dir, pid):
+    """
+    Fold the snapshot of an exited process into the aggregate snapshot and
+    remove its file. Call it once the process is gone (gunicorn child_exit).
+    """
+    if not metrics_dir:
+        return
+    path = os.path.join(metrics_dir, f'{pid}.json')
+    aggregate_path = os.path.join(metrics_dir, AGGREGATE_SNAPSHOT)
+
+    with open(aggregate_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            snapshot = _read_snapshot(path)
+        except ValueError:
+            snapshot = None         # Torn or corrupt; its values are lost either way
+        if snapshot is not None:
+            try:
+                aggregate = _read_snapshot(aggregate_path)
+            except ValueError:
+                aggregate = None
+            counters, histograms = _merge([snapshot] + ([aggregate] if aggregate else []))
+            tmp_path = aggregate_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(_to_snapshot(counters, histograms), f)
+            os.replace(tmp_path, aggregate_path)
+        for stale in (path, path + '.tmp'):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+
+
+def reset_metrics_dir(metrics_dir):
+    """
+    Remove snapshots left by a previous server run. Call once from the
+    parent process before workers start.
+    """
+    if not metrics_dir or not os.path.isdir(metrics_dir):
+        return
+    for filename in os.listdir(metrics_dir):
+        if filename.endswith(('.json', '.json.tmp', '.json.lock')):
+            try:
+                os.remove(os.path.join(metrics_dir, filename))
+            except OSError:
+                pass
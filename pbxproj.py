@@ -0,0 +1,675 @@
+"""
+Reading and editing Xcode project files (project.pbxproj) without regexes.
+
+PBXProject.load() parses the old-style plist once into an object graph and
+indexes it by object ID, by isa, by group path, by resolved file path and by
+build phase. Edits (add_file, remove_file, ensure_group, ...) are dict operations
+on that graph, and save() writes the whole file back in one pass, in the
+layout Xcode itself writes: isa sections, one-line PBXBuildFile and
+PBXFileReference entries, and /* name */ comments after object IDs. An
+unmodified project round-trips byte for byte.
+
+Removed objects are dropped from the `files`/`children` lists that refer to
+them while serializing, so a removal never has to search a list. An ID that
+is removed and added back in the same place keeps its position.
+
+    project = PBXProject.load('Braindumpster.xcodeproj')
+    project.add_file('Utilities/PDFGenerator.swift')
+    project.save()
+"""
+
+import hashlib
+import os
+import posixpath
+import re
+
+PROJECT_FILE = 'Braindumpster.xcodeproj/project.pbxproj'
+
+# Objects Xcode writes on a single line
+_SINGLE_LINE_ISAS = ('PBXBuildFile', 'PBXFileReference')
+
+# Keys whose object ID values Xcode doesn't annotate with a comment
+_UNCOMMENTED_KEYS = ('remoteGlobalIDString', 'TestTargetID')
+
+_UNQUOTED = re.compile(r'[A-Za-z0-9_$./]+')
+_TOKEN = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<comment>/\*.*?\*/|//[^\n]*)
+  | (?P<quoted>"(?:[^"\\]|\\.)*")
+  | (?P<punct>[{}();=,])
+  | (?P<word>[^\s{}();=,"/]+(?:/(?![/*])[^\s{}();=,"/]*)*)
+''', re.S | re.X)
+_ESCAPES = {'n': '\n', 't': '\t', '"': '"', '\\': '\\'}
+
+# lastKnownFileType by extension
+FILE_TYPES = {
+    '.swift': 'sourcecode.swift',
+    '.m': 'sourcecode.c.objc',
+    '.mm': 'sourcecode.cpp.objcpp',
+    '.c': 'sourcecode.c.c',
+    '.h': 'sourcecode.c.h',
+    '.json': 'text.json',
+    '.plist': 'text.plist',
+    '.storekit': 'text',
+    '.strings': 'text.plist.strings',
+    '.xcassets': 'folder.assetcatalog',
+    '.entitlements': 'text.plist.entitlements',
+}
+SOURCE_EXTENSIONS = ('.swift', '.m', '.mm', '.c')
+HEADER_EXTENSIONS = ('.h',)
+
+_PHASE_COMMENTS = {
+    'PBXSourcesBuildPhase': 'Sources',
+    'PBXResourcesBuildPhase': 'Resources',
+    'PBXFrameworksBuildPhase': 'Frameworks',
+    'PBXHeadersBuildPhase': 'Headers',
+    'PBXCopyFilesBuildPhase': 'CopyFiles',
+    'PBXShellScriptBuildPhase': 'ShellScript',
+}
+
+
+class PBXProjectError(ValueError):
+    """The project file can't be parsed, or an edit doesn't fit the graph."""
+
+
+class PBXProject:
+    """
+    The object graph of one project.pbxproj.
+
+    objects maps ID -> object dict (values are str, list or dict). Lookups:
+    ids_of(isa), group(path), file_ref(path), build_files(file_ref_id),
+    phase(isa, target) - all O(1) against indexes built at load time and
+    kept current by the edit methods.
+    """
+
+    def __init__(self, data, path=None):
+        self.path = path
+        self.data = data
+        self.objects = data.get('objects')
+        if not isinstance(self.objects, dict) or data.get('rootObject') not in self.objects:
+            raise PBXProjectError("Not an Xcode project: no objects or root object")
+        self.root_id = data['rootObject']
+        self.comments = {}       # ID -> comment written after it
+        self._removed = {}       # removed ID -> (owner ID, list key) it is still listed in
+        self._revived = {}
+        self._build_indexes()
+
+    # Loading and saving
+
+    @classmethod
+    def load(cls, path=PROJECT_FILE):
+        """
+        Parse a project.pbxproj, or the one inside an .xcodeproj directory.
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, 'project.pbxproj')
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        return cls.parse(text, path)
+
+    @classmethod
+    def parse(cls, text, path=None):
+        comments = {}
+        data = _Parser(text, comments).parse()
+        if not isinstance(data, dict):
+            raise PBXProjectError("Project file is not a dictionary")
+        project = cls(data, path)
+        project.comments = comments
+        return project
+
+    def save(self, path=None):
+        path = path or self.path
+        if path is None:
+            raise PBXProjectError("No path to save the project to")
+        if os.path.isdir(path):
+            path = os.path.join(path, 'project.pbxproj')
+        text = self.dumps()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        self.path = path
+
+    def dumps(self):
+        return _Writer(self).write()
+
+    # Lookups
+
+    def get(self, object_id):
+        if object_id in self._removed:
+            return None
+        return self.objects.get(object_id)
+
+    def ids_of(self, isa):
+        """IDs of every object of the given isa, in file order."""
+        return list(self._by_isa.get(isa, ()))
+
+    @property
+    def main_group(self):
+        return self.objects[self.root_id]['mainGroup']
+
+    def children(self, group_id):
+        return self.live(self.objects[group_id].get('children', ()))
+
+    def group(self, path):
+        """
+        ID of the group at a display path such as 'Views/MeetingRecorder'
+        ('' is the main group), or None.
+        """
+        return self._groups_by_path.get(_normalize(path))
+
+    def group_path(self, group_id):
+        return self._group_paths.get(group_id)
+
+    def file_ref(self, path):
+        """
+        ID of the PBXFileReference whose file is at path (relative to the
+        project directory), or None.
+        """
+        return self._files_by_path.get(_normalize(path))
+
+    def file_paths(self):
+        """{path relative to the project directory: file reference ID}."""
+        return dict(self._files_by_path)
+
+    def build_files(self, file_ref_id):
+        """IDs of the PBXBuildFiles that build this file reference."""
+        return list(self._build_files_by_ref.get(file_ref_id, ()))
+
+    def phase_of(self, build_file_id):
+        return self._phase_of.get(build_file_id)
+
+    def phase_files(self, phase_id):
+        return self.live(self.objects[phase_id].get('files', ()))
+
+    def live(self, items):
+        """A list value as it will be written: without removed objects."""
+        removed = self._removed
+        return [item for item in items if not (isinstance(item, str) and item in removed)]
+
+    def target(self, name=None):
+        """
+        ID of the native target with this name; with no name, the only one.
+        """
+        targets = self.ids_of('PBXNativeTarget')
+        if name is None:
+            if len(targets) != 1:
+                raise PBXProjectError(f"Project has {len(targets)} targets, name one")
+            return targets[0]
+        for target_id in targets:
+            if self.objects[target_id].get('name') == name:
+                return target_id
+        raise PBXProjectError(f"No target named {name!r}")
+
+    def phase(self, isa='PBXSourcesBuildPhase', target=None):
+        """ID of the target's build phase of this isa, or None."""
+        return self._phases.get((self.target(target), isa))
+
+    # Edits
+
+    def new_id(self, *seed):
+        """
+        A fresh 24-hex-digit object ID derived from seed, so the same edit
+        to the same project always produces the same IDs.
+        """
+        base = '\0'.join(str(part) for part in seed)
+        counter = 0
+        while True:
+            text = base if counter == 0 else f'{base}\0{counter}'
+            object_id = hashlib.sha1(text.encode('utf-8')).hexdigest()[:24].upper()
+            if object_id not in self.objects:
+                return object_id
+            counter += 1
+
+    def add_object(self, object_id, obj, comment=None):
+        if object_id in self.objects:
+            raise PBXProjectError(f"Object ID {object_id} is already in use")
+        if object_id in self._removed:
+            self._revived[object_id] = self._removed.pop(object_id)
+        self.objects[object_id] = obj
+        if comment is not None:
+            self.comments[object_id] = comment
+        self._by_isa.setdefault(obj.get('isa'), {})[object_id] = None
+        return object_id
+
+    def remove_object(self, object_id, listed_in=None):
+        """
+        Remove an object. listed_in is the (owner ID, key) of the list that
+        refers to it, if any; the entry itself is skipped when writing.
+        """
+        obj = self.objects.pop(object_id, None)
+        if obj is None:
+            return None
+        self._removed[object_id] = listed_in
+        self.comments.pop(object_id, None)
+        self._by_isa.get(obj.get('isa'), {}).pop(object_id, None)
+        return obj
+
+    def ensure_group(self, path):
+        """
+        ID of the group at a display path, creating it (and any missing
+        parents) with a name and no path of its own, like the existing
+        Views and Utilities groups.
+        """
+        path = _normalize(path)
+        group_id = self._groups_by_path.get(path)
+        if group_id is not None:
+            return group_id
+        parent_path, name = posixpath.split(path)
+        parent_id = self.ensure_group(parent_path)
+        group_id = self.add_object(
+            self.new_id('PBXGroup', path),
+            {'isa': 'PBXGroup', 'children': [], 'name': name, 'sourceTree': '<group>'},
+            name
+        )
+        self._append(parent_id, 'children', group_id)
+        self._parent[group_id] = parent_id
+        self._groups_by_path[path] = group_id
+        self._group_paths[group_id] = path
+        self._group_dirs[group_id] = self._group_dirs[parent_id]
+        return group_id
+
+    def add_file(self, path, group=None, phase=None, target=None):
+        """
+        Add the file at path (relative to the project directory) to a group
+        and to a build phase, returning its file reference ID. An existing
+        reference to the same path is reused.
+
+        group defaults to the group named after the file's directory,
+        created if needed. phase is a build phase isa, False for none, or
+        by default default_phase(path).
+        """
+        path = _normalize(path)
+        name = posixpath.basename(path)
+        extension = posixpath.splitext(name)[1].lower()
+        if phase is None:
+            phase = default_phase(path)
+
+        file_ref_id = self._files_by_path.get(path)
+        if file_ref_id is None:
+            group_id = self.ensure_group(posixpath.dirname(path) if group is None else group)
+            group_dir = self._group_dirs[group_id]
+            relative = posixpath.relpath(path, group_dir) if group_dir else path
+
+            file_ref = {'isa': 'PBXFileReference'}
+            if relative != name:
+                file_ref['includeInIndex'] = '1'
+            if extension in FILE_TYPES:
+                file_ref['lastKnownFileType'] = FILE_TYPES[extension]
+            if relative != name:
+                file_ref['name'] = name
+            file_ref['path'] = relative
+            file_ref['sourceTree'] = '<group>'
+
+            file_ref_id = self.add_object(self.new_id('PBXFileReference', path), file_ref, name)
+            self._append(group_id, 'children', file_ref_id)
+            self._parent[file_ref_id] = group_id
+            self._files_by_path[path] = file_ref_id
+            self._path_of_file[file_ref_id] = path
+
+        if phase:
+            phase_id = self.phase(phase, target)
+            if phase_id is None:
+                raise PBXProjectError(f"Target has no {phase}")
+            if not self.in_phase(file_ref_id, phase_id):
+                self._add_build_file(file_ref_id, phase_id)
+        return file_ref_id
+
+    def in_phase(self, file_ref_id, phase_id):
+        return any(self._phase_of.get(build_file_id) == phase_id
+                   for build_file_id in self._build_files_by_ref.get(file_ref_id, ()))
+
+    def remove_file(self, path):
+        """
+        Remove the file reference at path, its build files and its entries
+        in groups and build phases. Returns False if it wasn't there.
+        """
+        file_ref_id = self._files_by_path.pop(_normalize(path), None)
+        if file_ref_id is None:
+            return False
+        for build_file_id in self._build_files_by_ref.pop(file_ref_id, ()):
+            phase_id = self._phase_of.pop(build_file_id, None)
+            self.remove_object(build_file_id, phase_id and (phase_id, 'files'))
+        group_id = self._parent.pop(file_ref_id, None)
+        self._path_of_file.pop(file_ref_id, None)
+        self.remove_object(file_ref_id, group_id and (group_id, 'children'))
+        return True
+
+    def remove_group(self, path):
+        """
+        Remove the empty group at a display path. Returns False if there is
+        no such group; raises PBXProjectError if it still has children.
+        """
+        path = _normalize(path)
+        group_id = self._groups_by_path.get(path)
+        if group_id is None:
+            return False
+        if not path or self.children(group_id):
+            raise PBXProjectError(f"Group {path!r} is not empty")
+        del self._groups_by_path[path]
+        self._group_paths.pop(group_id, None)
+        self._group_dirs.pop(group_id, None)
+        parent_id = self._parent.pop(group_id, None)
+        self.remove_object(group_id, parent_id and (parent_id, 'children'))
+        return True
+
+    def remove_build_file(self, build_file_id):
+        obj = self.objects.get(build_file_id)
+        if obj is None:
+            return False
+        build_files = self._build_files_by_ref.get(obj.get('fileRef'))
+        if build_files and build_file_id in build_files:
+            build_files.remove(build_file_id)
+        phase_id = self._phase_of.pop(build_file_id, None)
+        self.remove_object(build_file_id, phase_id and (phase_id, 'files'))
+        return True
+
+    def _append(self, owner_id, key, object_id):
+        listed_in = self._revived.pop(object_id, None)
+        if listed_in == (owner_id, key):
+            # Removed and added back: it is still listed where it was
+            return
+        if listed_in is not None and listed_in[0] in self.objects:
+            self.objects[listed_in[0]][listed_in[1]].remove(object_id)
+        self.objects[owner_id].setdefault(key, []).append(object_id)
+
+    def _add_build_file(self, file_ref_id, phase_id):
+        name = self.comments.get(file_ref_id)
+        phase_name = self.comments.get(phase_id) or _PHASE_COMMENTS.get(self.objects[phase_id]['isa'])
+        build_file_id = self.add_object(
+            self.new_id('PBXBuildFile', file_ref_id, phase_id),
+            {'isa': 'PBXBuildFile', 'fileRef': file_ref_id},
+            f'{name} in {phase_name}'
+        )
+        self._append(phase_id, 'files', build_file_id)
+        self._build_files_by_ref.setdefault(file_ref_id, []).append(build_file_id)
+        self._phase_of[build_file_id] = phase_id
+        return build_file_id
+
+    # Indexes
+
+    def _build_indexes(self):
+        self._by_isa = {}
+        for object_id, obj in self.objects.items():
+            if not isinstance(obj, dict):
+                raise PBXProjectError(f"Object {object_id} is not a dictionary")
+            self._by_isa.setdefault(obj.get('isa'), {})[object_id] = None
+
+        # Group tree: display paths (names) for lookups, directories for file paths
+        self._parent = {}
+        self._groups_by_path = {}
+        self._group_paths = {}
+        self._group_dirs = {}
+        self._files_by_path = {}
+        self._path_of_file = {}
+        main_group = self.main_group
+        self._groups_by_path[''] = main_group
+        self._group_paths[main_group] = ''
+        self._group_dirs[main_group] = _normalize(self.objects[main_group].get('path', ''))
+        stack = [main_group]
+        while stack:
+            group_id = stack.pop()
+            for child_id in self.objects[group_id].get('children', ()):
+                child = self.objects.get(child_id)
+                if child is None or child_id in self._parent:
+                    continue
+                self._parent[child_id] = group_id
+                child_dir = self._resolve(child, self._group_dirs[group_id])
+                if child.get('isa') in ('PBXGroup', 'PBXVariantGroup'):
+                    display = posixpath.join(self._group_paths[group_id],
+                                             child.get('name') or child.get('path', ''))
+                    self._groups_by_path.setdefault(display, child_id)
+                    self._group_paths[child_id] = display
+                    self._group_dirs[child_id] = child_dir
+                    stack.append(child_id)
+                elif child.get('isa') == 'PBXFileReference' and child_dir is not None:
+                    self._files_by_path.setdefault(child_dir, child_id)
+                    self._path_of_file[child_id] = child_dir
+
+        # File references outside any group still resolve from the project directory
+        for file_ref_id in self._by_isa.get('PBXFileReference', ()):
+            if file_ref_id not in self._parent:
+                path = self._resolve(self.objects[file_ref_id], self._group_dirs[main_group])
+                if path is not None:
+                    self._files_by_path.setdefault(path, file_ref_id)
+                    self._path_of_file[file_ref_id] = path
+
+        # Build phases per target, and which phase each build file is in
+        self._phases = {}
+        self._phase_of = {}
+        self._build_files_by_ref = {}
+        for target_id in self._by_isa.get('PBXNativeTarget', ()):
+            for phase_id in self.objects[target_id].get('buildPhases', ()):
+                phase = self.objects.get(phase_id)
+                if phase is None:
+                    continue
+                self._phases.setdefault((target_id, phase.get('isa')), phase_id)
+                for build_file_id in phase.get('files', ()):
+                    self._phase_of[build_file_id] = phase_id
+        for build_file_id in self._by_isa.get('PBXBuildFile', ()):
+            file_ref_id = self.objects[build_file_id].get('fileRef')
+            if file_ref_id is not None:
+                self._build_files_by_ref.setdefault(file_ref_id, []).append(build_file_id)
+
+    @staticmethod
+    def _resolve(obj, group_dir):
+        """
+        Project-relative path of a group-relative item, or None for items
+        relative to SDKs, built products and the like.
+        """
+        source_tree = obj.get('sourceTree', '<group>')
+        path = obj.get('path', '')
+        if source_tree == '<group>':
+            return _normalize(posixpath.join(group_dir, path)) if group_dir else _normalize(path)
+        if source_tree == 'SOURCE_ROOT':
+            return _normalize(path)
+        return None
+
+
+def default_phase(path):
+    """
+    The build phase isa a file goes into by default: Sources for code,
+    none (False) for headers, Resources for everything else.
+    """
+    extension = posixpath.splitext(path)[1].lower()
+    if extension in SOURCE_EXTENSIONS:
+        return 'PBXSourcesBuildPhase'
+    if extension in HEADER_EXTENSIONS:
+        return False
+    return 'PBXResourcesBuildPhase'
+
+
+def _normalize(path):
+    path = posixpath.normpath(path.replace(os.sep, '/')) if path else ''
+    return '' if path == '.' else path.strip('/')
+
+
+class _Parser:
+    """
+    Recursive-descent parser for the old-style (NeXTSTEP) plist format.
+    Comments right after a key of the objects dictionary are kept as that
+    object's comment.
+    """
+
+    def __init__(self, text, comments):
+        self.text = text
+        self.comments = comments
+        self.tokens = []
+        self.pos = 0
+        self._tokenize()
+
+    def _tokenize(self):
+        tokens = self.tokens
+        position, end = 0, len(self.text)
+        while position < end:
+            match = _TOKEN.match(self.text, position)
+            if match is None:
+                raise PBXProjectError(f"Unexpected character at offset {position}")
+            position = match.end()
+            kind = match.lastgroup
+            if kind == 'space':
+                continue
+            if kind == 'comment':
+                value = match.group()
+                if value.startswith('/*') and tokens and tokens[-1][0] == 'string':
+                    tokens[-1] = ('string', tokens[-1][1], value[2:-2].strip())
+                continue
+            if kind == 'quoted':
+                tokens.append(('string', _unquote(match.group()[1:-1]), None))
+            elif kind == 'word':
+                tokens.append(('string', match.group(), None))
+            else:
+                tokens.append((match.group(), None, None))
+
+    def parse(self):
+        value = self._value(None)
+        if self.pos != len(self.tokens):
+            raise PBXProjectError("Trailing data after the project dictionary")
+        return value
+
+    def _next(self):
+        if self.pos >= len(self.tokens):
+            raise PBXProjectError("Unexpected end of project file")
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _expect(self, kind):
+        token = self._next()
+        if token[0] != kind:
+            raise PBXProjectError(f"Expected {kind!r}, found {token[1] or token[0]!r}")
+
+    def _value(self, key):
+        kind, value, _ = self._next()
+        if kind == 'string':
+            return value
+        if kind == '{':
+            return self._dict(key == 'objects')
+        if kind == '(':
+            items = []
+            while self.tokens[self.pos][0] != ')':
+                items.append(self._value(None))
+                if self.tokens[self.pos][0] != ')':
+                    self._expect(',')
+            self.pos += 1
+            return items
+        raise PBXProjectError(f"Unexpected {kind!r}")
+
+    def _dict(self, is_objects):
+        result = {}
+        while True:
+            kind, key, comment = self._next()
+            if kind == '}':
+                return result
+            if kind != 'string':
+                raise PBXProjectError(f"Expected a key, found {kind!r}")
+            if is_objects and comment is not None:
+                self.comments[key] = comment
+            self._expect('=')
+            result[key] = self._value(key)
+            self._expect(';')
+
+
+def _unquote(text):
+    if '\\' not in text:
+        return text
+    return re.sub(r'\\(.)', lambda m: _ESCAPES.get(m.group(1), m.group(1)), text, flags=re.S)
+
+
+def _quote(value):
+    if _UNQUOTED.fullmatch(value):
+        return value
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\t', '\\t')
+    return f'"{escaped}"'
+
+
+class _Writer:
+    """
+    Serializes a PBXProject in Xcode's own layout.
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self.objects = project.objects
+        self.comments = project.comments
+        self.out = []
+
+    def write(self):
+        out = self.out
+        out.append('// !$*UTF8*$!\n{\n')
+        for key, value in self.project.data.items():
+            out.append(f'\t{_quote(key)} = ')
+            if key == 'objects':
+                self._objects()
+            else:
+                self._value(value, 1, key)
+            out.append(';\n')
+        out.append('}\n')
+        return ''.join(out)
+
+    def _objects(self):
+        out = self.out
+        out.append('{\n')
+        sections = {}
+        for object_id, obj in self.objects.items():
+            sections.setdefault(obj.get('isa', ''), []).append(object_id)
+        for isa in sorted(sections):
+            out.append(f'\n/* Begin {isa} section */\n')
+            single_line = isa in _SINGLE_LINE_ISAS
+            for object_id in sorted(sections[isa]):
+                out.append('\t\t')
+                self._reference(object_id)
+                out.append(' = ')
+                if single_line:
+                    self._inline(self.objects[object_id])
+                else:
+                    self._value(self.objects[object_id], 2, None)
+                out.append(';\n')
+            out.append(f'/* End {isa} section */\n')
+        out.append('\t}')
+
+    def _reference(self, value, key=None):
+        self.out.append(_quote(value))
+        if key not in _UNCOMMENTED_KEYS:
+            comment = self.comments.get(value)
+            if comment is not None and value in self.objects:
+                self.out.append(f' /* {comment} */')
+
+    def _value(self, value, depth, key):
+        out = self.out
+        if isinstance(value, dict):
+            out.append('{\n')
+            indent = '\t' * (depth + 1)
+            for child_key, child in value.items():
+                out.append(f'{indent}{_quote(child_key)} = ')
+                self._value(child, depth + 1, child_key)
+                out.append(';\n')
+            out.append('\t' * depth + '}')
+        elif isinstance(value, list):
+            out.append('(\n')
+            indent = '\t' * (depth + 1)
+            for item in self.project.live(value):
+                out.append(indent)
+                self._value(item, depth + 1, key)
+                out.append(',\n')
+            out.append('\t' * depth + ')')
+        else:
+            self._reference(value, key)
+
+    def _inline(self, value, key=None):
+        out = self.out
+        if isinstance(value, dict):
+            out.append('{')
+            for child_key, child in value.items():
+                out.append(f'{_quote(child_key)} = ')
+                self._inline(child, child_key)
+                out.append('; ')
+            out.append('}')
+        elif isinstance(value, list):
+            out.append('(')
+            for item in self.project.live(value):
+                self._inline(item, key)
+                out.append(', ')
+            out.append(')')
+        else:
+            self._reference(value, key)
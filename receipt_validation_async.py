@@ -0,0 +1,533 @@
+"""
+Asyncio-native validation path for the receipt validation backend.
+
+Serves the same routes as the Flask app (verify-receipt, verify-receipts,
+the Apple webhook, entitlement, health and metrics) as an ASGI app so one
+process can keep thousands of Apple calls pending without tying up a
+thread for each:
+
+    uvicorn receipt_validation_async:app --host 127.0.0.1 --port 5001 --workers 4
+
+Request checks, the verdict cache, environment routing, response parsing,
+persistence and the Apple circuit breakers / hedge policies are the same
+functions and objects the Flask routes in receipt_validation_endpoint.py
+use. Only the Apple HTTP calls (httpx), hedging, backoff sleeps, in-flight
+coalescing and token verification on a cache miss are async here; the
+blocking subscription store calls run in worker threads.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from urllib.parse import parse_qsl
+
+import httpx
+
+import json_codec
+import receipt_validation_endpoint as rv
+from firebase_auth import InvalidTokenError, SigningKeysUnavailable
+from structured_logging import request_id_var
+
+logger = logging.getLogger('receipt_validation.async')
+
+# Outbound Apple connections per worker process (shared by all pending calls)
+ASYNC_APPLE_MAX_CONNECTIONS = 500
+ASYNC_APPLE_MAX_KEEPALIVE = 100
+MAX_REQUEST_BODY_BYTES = 4 * 1024 * 1024
+
+
+class AsyncSingleFlight:
+    """
+    asyncio counterpart of rv.SingleFlight: concurrent identical validations
+    await the first one's result instead of calling Apple again.
+
+    The call runs as its own task and every caller awaits it through
+    asyncio.shield, so a caller that is cancelled (e.g. its client went
+    away) stops waiting without cancelling the call for the others.
+    """
+
+    def __init__(self, wait_timeout=rv.SINGLE_FLIGHT_WAIT_TIMEOUT):
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+
+    async def do(self, key, factory):
+        task = self._calls.get(key)
+        if task is not None:
+            logger.info("Waiting on in-flight validation for same receipt")
+            rv.metrics.inc('receipt_coalesced_requests_total')
+            result = await asyncio.wait_for(asyncio.shield(task), self.wait_timeout)
+            return dict(result)
+
+        task = asyncio.ensure_future(factory())
+        self._calls[key] = task
+        task.add_done_callback(lambda done: self._finished(key, done))
+        return await asyncio.shield(task)
+
+    def _finished(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here, so no waiter is fine
+
+
+receipt_validations = AsyncSingleFlight()
+_apple_client = None
+
+
+def get_apple_client():
+    """
+    The worker's pooled async client, created on lifespan startup.
+    """
+    global _apple_client
+
+    if _apple_client is None:
+        _apple_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=ASYNC_APPLE_MAX_CONNECTIONS,
+                max_keepalive_connections=ASYNC_APPLE_MAX_KEEPALIVE
+            ),
+            timeout=httpx.Timeout(
+                connect=rv.APPLE_CONNECT_TIMEOUT,
+                read=rv.APPLE_READ_TIMEOUT,
+                write=rv.APPLE_READ_TIMEOUT,
+                pool=rv.APPLE_CONNECT_TIMEOUT
+            )
+        )
+    return _apple_client
+
+
+async def _post_to_apple(client, url, environment, payload, read_timeout):
+    stage = 'apple_' + environment
+    started = time.perf_counter()
+    timeout = httpx.Timeout(rv.APPLE_CONNECT_TIMEOUT, read=read_timeout)
+    try:
+        with rv.metrics.timer('receipt_stage_duration_seconds', {'stage': stage}):
+            response = await client.post(
+                url,
+                content=payload.aiter(),
+                headers=dict(rv.APPLE_REQUEST_HEADERS, **{'Content-Length': str(len(payload))}),
+                timeout=timeout
+            )
+            apple_response = json_codec.loads(response.content)
+    except httpx.TimeoutException:
+        rv.metrics.inc('receipt_apple_status_total', {'environment': environment, 'status': 'timeout'})
+        raise
+    except Exception:
+        rv.metrics.inc('receipt_apple_status_total', {'environment': environment, 'status': 'error'})
+        raise
+
+    rv.apple_hedge_policies[environment].record(time.perf_counter() - started)
+    rv.record_apple_status(environment, apple_response)
+    return apple_response
+
+
+async def _hedged_post_to_apple(client, url, environment, payload, read_timeout):
+    """
+    Async rv._hedged_post_to_apple; the losing request is cancelled.
+    """
+    policy = rv.apple_hedge_policies[environment]
+    hedge_delay = policy.delay() if rv.APPLE_HEDGE_ENABLED else None
+    if hedge_delay is None or hedge_delay >= read_timeout:
+        return await _post_to_apple(client, url, environment, payload, read_timeout)
+
+    primary = asyncio.ensure_future(_post_to_apple(client, url, environment, payload, read_timeout))
+    done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+    if done or not policy.try_acquire():
+        return await primary
+
+    hedge = asyncio.ensure_future(
+        _post_to_apple(client, url, environment, payload, read_timeout - hedge_delay)
+    )
+    pending = {primary, hedge}
+    winner = None
+    try:
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                winner = succeeded[0]
+        if winner is None:
+            winner = primary
+    finally:
+        for task in pending:
+            task.cancel()
+
+    rv.metrics.inc('receipt_apple_hedged_requests_total', {
+        'environment': environment,
+        'winner': 'hedge' if winner is hedge else 'primary'
+    })
+    return winner.result()
+
+
+async def _call_apple(client, url, environment, payload, deadline):
+    """
+    Async rv._call_apple: same breaker, hedging and backoff policy.
+    """
+    breaker = rv.apple_breakers[environment]
+    attempt = 0
+    while True:
+        rv.check_apple_breaker(environment)
+        read_timeout = rv.apple_read_timeout(deadline)
+        if read_timeout <= 0:
+            breaker.record_failure()
+            raise asyncio.TimeoutError("Apple verification deadline exceeded")
+
+        error = None
+        try:
+            apple_response = await _hedged_post_to_apple(client, url, environment, payload, read_timeout)
+        except httpx.TimeoutException:
+            breaker.record_failure()
+            raise
+        except (httpx.HTTPError, ValueError) as e:
+            breaker.record_failure()
+            error = e
+            reason = 'error'
+        else:
+            reason = apple_response.get('status')
+            if reason not in rv.RETRYABLE_APPLE_STATUSES:
+                breaker.record_success()
+                return apple_response
+            breaker.record_failure()
+
+        delay = rv.apple_retry_delay(attempt, deadline, environment, reason)
+        if delay is None:
+            raise rv.AppleUnavailableError(
+                f"Apple {environment} failed {attempt + 1} attempts ({reason})"
+            ) from error
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def verify_with_apple(receipt_data, user_id=None, original_transaction_id=None):
+    """
+    Async rv.verify_with_apple: same routing, 21007/21008 fallback and parsing.
+    """
+    payload = rv.apple_payload(receipt_data)
+    client = get_apple_client()
+    deadline = time.monotonic() + rv.APPLE_REQUEST_DEADLINE
+    first, fallback, redirect_status = rv.apple_verification_plan(user_id, original_transaction_id)
+
+    logger.debug("Verifying with Apple", extra={'environment': first[0]})
+    try:
+        apple_response = await _call_apple(client, first[1], first[0], payload, deadline)
+
+        if apple_response.get('status') == redirect_status:
+            rv.note_apple_redirect(fallback[0], user_id)
+            apple_response = await _call_apple(client, fallback[1], fallback[0], payload, deadline)
+
+        return rv.apple_verification_result(apple_response, user_id, original_transaction_id)
+
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        logger.warning("Request to Apple timed out")
+        raise
+
+    except rv.AppleUnavailableError as e:
+        logger.warning("Apple unavailable", extra={'reason': str(e)})
+        raise
+
+    except Exception as e:
+        logger.error("Error calling Apple API", extra={'error': str(e)})
+        raise
+
+
+async def validate_receipt(receipt_data, user_id=None):
+    """
+    Async rv.validate_receipt: verdict cache, coalescing, Apple, persistence.
+    """
+    receipt = rv.receipt_buffer(receipt_data)
+    receipt_hash, result = rv.lookup_verdict(receipt, user_id)
+    cached = result is not None
+
+    if not cached:
+        original_transaction_id, rejection = rv.prevalidate_receipt(receipt)
+        if rejection is not None:
+            rv.verdict_cache.put(receipt_hash, rejection)
+            return rejection
+
+        async def validate():
+            verdict = await verify_with_apple(
+                receipt, user_id=user_id, original_transaction_id=original_transaction_id
+            )
+            rv.verdict_cache.put(receipt_hash, verdict, user_id=user_id)
+            return verdict
+
+        try:
+            result = await receipt_validations.do(receipt_hash, validate)
+        except rv.AppleUnavailableError:
+            # Store reads and writes block; keep them off the event loop
+            result = await asyncio.to_thread(rv.last_known_verdict, receipt_hash, user_id)
+            if result is None:
+                raise
+            return result
+
+    if rv.verdict_needs_recording(user_id, cached):
+        await asyncio.to_thread(rv.record_verdict, result, receipt, user_id)
+    return result
+
+
+async def authenticate(headers):
+    """
+    Returns (uid, None) or (None, (status, body)) for the async routes.
+    """
+    claims, auth_error = await authenticate_claims(headers)
+    return (claims['uid'] if claims else None), auth_error
+
+
+async def authenticate_claims(headers):
+    """
+    Returns (ID token claims, None) or (None, (status, body)). The claims
+    are None when auth is disabled.
+    """
+    auth_header = headers.get('authorization')
+    if not auth_header:
+        return None, (401, {'success': False, 'isPremium': False, 'message': 'Missing authorization header'})
+
+    if not rv.FIREBASE_AUTH_ENABLED:
+        return None, None
+
+    token = rv.bearer_token(auth_header)
+    try:
+        with rv.metrics.timer('receipt_stage_duration_seconds', {'stage': 'auth'}):
+            claims = rv.firebase_verifier.cached(token)
+            if claims is None:
+                # May fetch signing keys; keep it off the event loop
+                claims = await asyncio.to_thread(rv.firebase_verifier.verify, token)
+    except InvalidTokenError as e:
+        logger.warning("Invalid auth token", extra={'reason': str(e)})
+        return None, (401, {'success': False, 'isPremium': False, 'message': 'Invalid authorization token'})
+    except SigningKeysUnavailable as e:
+        logger.error("Firebase signing keys unavailable", extra={'reason': str(e)})
+        return None, (503, {'success': False, 'isPremium': False,
+                            'message': 'Authentication temporarily unavailable'})
+
+    return claims, None
+
+
+async def verify_receipt(headers, body, query=None):
+    uid, auth_error = await authenticate(headers)
+    if auth_error:
+        return auth_error
+
+    try:
+        data = json_codec.loads(body) if body else None
+    except ValueError:
+        data = None
+
+    try:
+        error_message = rv.verification_request_error(data)
+        if error_message:
+            return 400, {'success': False, 'isPremium': False, 'message': error_message}
+
+        user_id, error_message = rv.verified_user_id(uid, data.get('userId'))
+        if error_message:
+            return 403, {'success': False, 'isPremium': False, 'message': error_message}
+
+        receipt = rv.receipt_buffer(data.pop('receiptData'))
+        result = await validate_receipt(receipt, user_id=user_id)
+        return (200 if result['success'] else 400), result
+
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        logger.warning("Request to Apple timed out")
+        return 504, {'success': False, 'isPremium': False, 'message': 'Request timed out'}
+
+    except rv.AppleUnavailableError:
+        return 503, {'success': False, 'isPremium': False,
+                     'message': 'Receipt verification temporarily unavailable'}
+
+    except Exception:
+        logger.exception("Receipt validation error")
+        return 500, {'success': False, 'isPremium': False, 'message': 'Internal server error'}
+
+
+_batch_slots = asyncio.Semaphore(rv.BATCH_MAX_WORKERS)
+
+
+async def verify_receipts(headers, body, query=None):
+    """
+    rv.verify_receipts: admin-only batch validation. Results are returned
+    in completion order, each with the "index" of its item.
+    """
+    claims, auth_error = await authenticate_claims(headers)
+    if auth_error:
+        return auth_error
+    if rv.FIREBASE_AUTH_ENABLED and not rv.is_admin(claims):
+        logger.warning("Admin route refused", extra={'user_id': claims['uid']})
+        return 403, {'success': False, 'message': 'Admin access required'}
+
+    try:
+        data = json_codec.loads(body) if body else None
+    except ValueError:
+        data = None
+    items, error_message = rv.batch_request_items(data)
+    if error_message:
+        return 400, {'success': False, 'message': error_message}
+
+    results = []
+    for finished in asyncio.as_completed([_validate_batch_item(index, item) for index, item in enumerate(items)]):
+        results.append(await finished)
+    return 200, {'success': True, 'count': len(results), 'results': results}
+
+
+async def _validate_batch_item(index, item):
+    user_id = item.get('userId')
+
+    result = rv.batch_item_error(item)
+    if result is None:
+        try:
+            # One pool of slots per process, like the Flask batch executor
+            async with _batch_slots:
+                result = await validate_receipt(item['receiptData'], user_id=user_id or None)
+        except (httpx.TimeoutException, asyncio.TimeoutError):
+            result = {'success': False, 'isPremium': False, 'message': 'Request timed out'}
+        except rv.AppleUnavailableError:
+            result = {'success': False, 'isPremium': False,
+                      'message': 'Receipt verification temporarily unavailable'}
+        except Exception:
+            logger.exception("Batch item error", extra={'index': index})
+            result = {'success': False, 'isPremium': False, 'message': 'Internal server error'}
+
+    return dict(result, index=index, userId=user_id)
+
+
+async def apple_webhook(headers, body, query=None):
+    """
+    rv.apple_webhook: queue the notification and acknowledge it.
+    """
+    # Unauthenticated: bound what anyone can make us store
+    if len(body) > rv.WEBHOOK_MAX_BODY_BYTES:
+        return rv.webhook_body_too_large()
+    try:
+        data = json_codec.loads(body) if body else None
+    except ValueError:
+        data = None
+    # SQLite insert; keep it off the event loop
+    return await asyncio.to_thread(rv.enqueue_notification, data)
+
+
+async def webhook_test(headers, body, query=None):
+    return 200, {'status': 'ok', 'endpoint': '/api/webhooks/apple'}
+
+
+async def entitlement(headers, body, query=None):
+    uid, auth_error = await authenticate(headers)
+    if auth_error:
+        return auth_error
+    # userId is only honoured when auth is disabled (local runs, benchmarks)
+    user_id = uid if rv.FIREBASE_AUTH_ENABLED else (query or {}).get('userId')
+    # The first call in a process may load the index from the store
+    return await asyncio.to_thread(rv.entitlement_status, user_id)
+
+
+async def health(headers, body, query=None):
+    return 200, {'status': 'ok'}
+
+
+async def prometheus_metrics(headers, body, query=None):
+    return 200, rv.metrics.render_prometheus()
+
+
+ROUTES = {
+    ('POST', '/api/verify-receipt'): ('verify_receipt', verify_receipt),
+    ('POST', '/api/verify-receipts'): ('verify_receipts', verify_receipts),
+    ('POST', '/api/webhooks/apple'): ('apple_webhook', apple_webhook),
+    ('GET', '/api/webhooks/test'): ('webhook_test', webhook_test),
+    ('GET', '/api/health'): ('health', health),
+    ('GET', '/api/entitlement'): ('entitlement', entitlement),
+    ('GET', '/api/metrics'): ('prometheus_metrics', prometheus_metrics),
+}
+
+
+async def _read_body(receive):
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_REQUEST_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def _send_response(send, status, payload, request_id):
+    if isinstance(payload, str):
+        data = payload.encode()
+        content_type = b'text/plain; version=0.0.4'
+    else:
+        data = json_codec.dumps(payload)
+        content_type = b'application/json'
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'content-length', str(len(data)).encode()),
+            (b'x-request-id', request_id.encode()),
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': data})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            rv.create_app()
+            get_apple_client()
+            await asyncio.to_thread(rv.start_background_services)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            global _apple_client
+            if _apple_client is not None:
+                await _apple_client.aclose()
+                _apple_client = None
+            await asyncio.to_thread(rv.stop_background_services)
+            try:
+                await asyncio.to_thread(rv.metrics.flush)
+            except OSError as e:
+                logger.warning("Could not write metrics snapshot", extra={'error': str(e)})
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point.
+    """
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+               for name, value in scope.get('headers', [])}
+    request_id = (headers.get('x-request-id') or uuid.uuid4().hex)[:64]
+    request_id_var.set(request_id)
+    started = time.perf_counter()
+
+    route = ROUTES.get((scope['method'], scope['path']))
+    if route is None:
+        endpoint = 'unknown'
+        status, payload = 404, {'success': False, 'message': 'Not found'}
+    else:
+        endpoint, handler = route
+        body = await _read_body(receive)
+        if body is None:
+            status, payload = 413, {'success': False, 'isPremium': False, 'message': 'Request body too large'}
+        else:
+            query = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+            status, payload = await handler(headers, body, query)
+
+    await _send_response(send, status, payload, request_id)
+
+    rv.metrics.observe(
+        'receipt_http_request_duration_seconds',
+        time.perf_counter() - started,
+        {'endpoint': endpoint}
+    )
+    rv.metrics.inc('receipt_http_requests_total', {'endpoint': endpoint, 'code': status})
@@ -5,14 +5,62 @@ For Braindumpster iOS App
 This is a complete working example for server-side receipt validation.
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 import requests
+from requests.adapters import HTTPAdapter
+import atexit
+import contextvars
+import fcntl
 import hashlib
-from datetime import datetime
+import heapq
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
 from functools import wraps
 
+import json_codec
+from apple_receipt import InvalidReceiptError, decode_receipt
+from apple_notifications import APPLE_ROOT_CA_G3_SHA256, AppleNotificationVerifier, InvalidNotificationError
+from entitlement_index import EntitlementIndex, EntitlementIndexUnavailable
+from metrics import MetricsRegistry
+from resilience import CircuitBreaker, HedgePolicy, backoff_delay
+from firebase_auth import FirebaseTokenVerifier, InvalidTokenError, SigningKeysUnavailable
+from structured_logging import configure_logging, request_id_var
+from subscription_store import SQLiteSubscriptionStore, SubscriptionWriteError, WriteBehindSubscriptionStore
+from webhook_queue import WebhookQueue, WebhookQueueWorker
+
+
+
+class CodecJSONProvider(DefaultJSONProvider):
+    """
+    request.json and jsonify() through json_codec (orjson when installed).
+    Flask's default still handles dates, Decimals, UUIDs and dataclasses;
+    other json.dumps options are ignored in favour of compact output.
+    """
+
+    def dumps(self, obj, **kwargs):
+        kwargs.setdefault('default', self.default)
+        return json_codec.dumps(obj, default=kwargs['default']).decode()
+
+    def loads(self, s, **kwargs):
+        return json_codec.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(json_codec.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = CodecJSONProvider(app)
+logger = logging.getLogger('receipt_validation')
 
 # Configuration
 APPLE_PRODUCTION_URL = "https://buy.itunes.apple.com/verifyReceipt"
@@ -20,12 +68,58 @@ APPLE_SANDBOX_URL = "https://sandbox.itunes.apple.com/verifyReceipt"
 APP_SHARED_SECRET = "your_app_specific_shared_secret_here"  # Get from App Store Connect
 EXPECTED_BUNDLE_ID = "com.braindumpster.app"
 
+# Logging
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.1'))   # For per-request INFO lines
+
+# Metrics (/api/metrics). Set METRICS_DIR when running several worker processes
+# so every worker can report the totals of all of them.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+
+# Firebase ID token verification (require_auth)
+FIREBASE_PROJECT_ID = os.environ.get('FIREBASE_PROJECT_ID', 'voicereminder-e1c91')
+FIREBASE_AUTH_ENABLED = os.environ.get('FIREBASE_AUTH_ENABLED', '1') == '1'
+FIREBASE_TOKEN_CACHE_SIZE = 10000     # Already-verified tokens kept until their exp
+
+# Outbound HTTP pool for Apple verifyReceipt
+APPLE_POOL_CONNECTIONS = 2            # One pool per Apple host (production + sandbox)
+APPLE_POOL_MAXSIZE = 20               # Keep-alive connections per host
+# All attempts of one verification (retries, 21007 redirect) share
+# APPLE_REQUEST_DEADLINE; keep deadline + connect under nginx's
+# proxy_read_timeout (60s in nginx_braindumpster.conf).
+APPLE_CONNECT_TIMEOUT = 5             # Seconds to establish TCP + TLS
+APPLE_READ_TIMEOUT = 20               # Seconds to wait for Apple's response
+APPLE_REQUEST_DEADLINE = 25           # Seconds for all attempts of one verification
+
+# Resilience of Apple calls (see resilience.py)
+APPLE_MAX_RETRIES = 2                 # Extra attempts on 21005/21009 and connection errors
+APPLE_BACKOFF_BASE_SECONDS = 0.25
+APPLE_BACKOFF_MAX_SECONDS = 2.0
+APPLE_BREAKER_FAILURE_RATE = 0.5      # Open when half the recent calls time out or fail
+APPLE_BREAKER_MINIMUM_CALLS = 20
+APPLE_BREAKER_WINDOW_SECONDS = 30
+APPLE_BREAKER_OPEN_SECONDS = 15       # Then let APPLE_BREAKER_HALF_OPEN_CALLS probes through
+APPLE_BREAKER_HALF_OPEN_CALLS = 3
+APPLE_HEDGE_ENABLED = True
+APPLE_HEDGE_PERCENTILE = 0.95         # Hedge calls slower than this percentile of recent ones
+APPLE_HEDGE_MIN_DELAY_SECONDS = 0.5
+APPLE_HEDGE_MAX_RATIO = 0.1           # Hedge at most ~10% of calls
+APPLE_HEDGE_MAX_WORKERS = 64
+
+# Subscription persistence
+SUBSCRIPTION_DB_PATH = os.environ.get('SUBSCRIPTION_DB_PATH', 'subscriptions.db')
+SUBSCRIPTION_WRITE_BEHIND = True      # Commit writes in batches off the request thread
+SUBSCRIPTION_WRITE_BATCH_SIZE = 200
+ENTITLEMENT_REFRESH_SECONDS = 1.0     # How stale another worker's writes can be in /api/entitlement
+
 # Premium product IDs
 PREMIUM_PRODUCTS = [
     "brain_dumpster_monthly_premium",
     "brain_dumpster_yearly_premium",
     "brain_dumpster_lifetime_premium"
 ]
+PREMIUM_PRODUCT_IDS = frozenset(PREMIUM_PRODUCTS)
+LIFETIME_PRODUCT_ID = "brain_dumpster_lifetime_premium"
 
 # Apple status codes
 APPLE_STATUS_CODES = {
@@ -42,11 +136,124 @@ APPLE_STATUS_CODES = {
     21010: "The user account cannot be found or has been deleted"
 }
 
+# Apple statuses that mean "try again later" rather than a verdict on the receipt
+RETRYABLE_APPLE_STATUSES = {21005, 21009}
+
+# Offline receipt decoding (apple_receipt.py): malformed or wrong-bundle
+# receipts are rejected without an Apple round trip
+RECEIPT_PREVALIDATION_ENABLED = os.environ.get('RECEIPT_PREVALIDATION_ENABLED', '1') == '1'
+
+# Verdict cache (repeat validations of the same receipt skip Apple)
+VERDICT_CACHE_MAX_ENTRIES = 10000
+VERDICT_CACHE_TTL_SECONDS = 6 * 60 * 60          # Upper bound for premium verdicts
+VERDICT_CACHE_NEGATIVE_TTL_SECONDS = 5 * 60      # Non-premium / rejected receipts
+VERDICT_CACHE_STALE_SECONDS = 60 * 60            # Past-TTL verdicts served while Apple is unavailable
+
+# Concurrent identical validations wait on one Apple call
+SINGLE_FLIGHT_WAIT_TIMEOUT = APPLE_REQUEST_DEADLINE + APPLE_CONNECT_TIMEOUT
+
+# Batch verification (/api/verify-receipts), for admin / reconciliation callers:
+# ID tokens with the ADMIN_CLAIM custom claim set to true, or uids in ADMIN_UIDS
+BATCH_MAX_ITEMS = 500
+BATCH_MAX_WORKERS = 16
+ADMIN_CLAIM = 'admin'
+ADMIN_UIDS = frozenset(uid for uid in os.environ.get('ADMIN_UIDS', '').split(',') if uid)
+
+# Background re-validation of stored subscriptions ahead of expiry
+REVALIDATION_LEAD_SECONDS = 10 * 60          # Re-validate this long before expires_date
+REVALIDATION_JITTER_SECONDS = 5 * 60         # Spread renewals that share an expiry
+REVALIDATION_RETRY_SECONDS = 15 * 60         # Renewal not visible yet -> check again
+REVALIDATION_RATE_PER_SECOND = 5             # Apple calls per second from the scheduler
+REVALIDATION_BATCH_SIZE = 20
+REVALIDATION_MAX_TRACKED = 100000
+REVALIDATION_SEED_INTERVAL_SECONDS = 5 * 60  # Reload due subscriptions from the store this often
+REVALIDATION_SEED_LOOKBACK_SECONDS = 24 * 60 * 60   # Also re-check ones that expired this recently
+# One worker per host runs the scheduler: the one holding this lock
+REVALIDATION_LOCK_PATH = os.environ.get(
+    'REVALIDATION_LOCK_PATH',
+    None if SUBSCRIPTION_DB_PATH == ':memory:' else SUBSCRIPTION_DB_PATH + '.revalidation.lock'
+)
+
+# Remembered receipt environments (skip the 21007 production -> sandbox retry)
+ENVIRONMENT_MEMORY_MAX_ENTRIES = 50000
+
+# App Store Server Notifications V2 (/api/webhooks/apple)
+APPLE_ROOT_CA_FINGERPRINTS = os.environ.get('APPLE_ROOT_CA_SHA256', APPLE_ROOT_CA_G3_SHA256).split(',')
+# Notifications that end the entitlement regardless of expiresDate
+REVOKING_NOTIFICATION_TYPES = frozenset({'EXPIRED', 'GRACE_PERIOD_EXPIRED', 'REFUND', 'REVOKE'})
+WEBHOOK_QUEUE_PATH = os.environ.get('WEBHOOK_QUEUE_PATH', 'webhook_queue.db')
+WEBHOOK_QUEUE_BATCH_SIZE = 100
+WEBHOOK_QUEUE_POLL_SECONDS = 1.0                     # Pick up notifications received by other workers
+WEBHOOK_QUEUE_LEASE_SECONDS = 60                     # Re-claim batches of workers that died mid-batch
+WEBHOOK_QUEUE_MAX_ATTEMPTS = 10                      # With backoff, retries span about 4 hours
+WEBHOOK_QUEUE_RETRY_BASE_SECONDS = 30
+WEBHOOK_QUEUE_RETRY_MAX_SECONDS = 2 * 60 * 60
+WEBHOOK_QUEUE_RETENTION_SECONDS = 7 * 24 * 60 * 60   # Dedup window; Apple retries for about 3 days
+WEBHOOK_MAX_BODY_BYTES = 128 * 1024                  # Signed payloads with their x5c chains are ~20 KB
+
+
+configure_logging(LOG_LEVEL)
+
+metrics = MetricsRegistry(METRICS_DIR)
+metrics.histogram('receipt_http_request_duration_seconds', 'End-to-end request latency by endpoint')
+metrics.counter('receipt_http_requests_total', 'Requests by endpoint and HTTP status code')
+metrics.histogram('receipt_stage_duration_seconds', 'Latency of each validation stage')
+metrics.counter('receipt_apple_status_total', 'Apple verifyReceipt status codes by environment')
+metrics.counter('receipt_apple_redirects_total', 'Retries on the other Apple environment (21007/21008)')
+metrics.counter('receipt_verdict_cache_total', 'Verdict cache lookups by result')
+metrics.counter('receipt_prevalidation_rejections_total', 'Receipts rejected offline, before any Apple call')
+metrics.counter('receipt_coalesced_requests_total', 'Requests that waited on an identical in-flight validation')
+metrics.counter('receipt_apple_retries_total', 'Apple calls retried after backoff, by environment and reason')
+metrics.counter('receipt_apple_hedged_requests_total', 'Hedged Apple calls by environment and which request won')
+metrics.counter('receipt_apple_circuit_transitions_total', 'Apple circuit breaker state changes')
+metrics.counter('receipt_apple_circuit_rejections_total', 'Apple calls skipped because the circuit was open')
+metrics.counter('receipt_degraded_responses_total', 'Verdicts served without Apple, by source')
+metrics.counter('receipt_webhook_notifications_total', 'App Store Server Notifications by type and outcome')
+metrics.counter('receipt_webhook_received_total', 'App Store Server Notifications received, by queue result')
+
+
+@app.before_request
+def assign_request_id():
+    """
+    Tag everything logged while handling this request with one correlation ID.
+    """
+    request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    request_id_var.set(request_id[:64])
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def echo_request_id(response):
+    request_id = request_id_var.get()
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+
+    endpoint = request.endpoint or 'unknown'
+    started = g.get('request_started')
+    if started is not None:
+        metrics.observe(
+            'receipt_http_request_duration_seconds',
+            time.perf_counter() - started,
+            {'endpoint': endpoint}
+        )
+    metrics.inc('receipt_http_requests_total', {'endpoint': endpoint, 'code': response.status_code})
+    return response
+
+
+firebase_verifier = FirebaseTokenVerifier(
+    FIREBASE_PROJECT_ID,
+    token_cache_size=FIREBASE_TOKEN_CACHE_SIZE
+)
+
+
+def bearer_token(auth_header):
+    return auth_header.replace('Bearer ', '', 1).strip()
+
 
 def require_auth(f):
     """
     Decorator to require Firebase authentication.
-    Replace with your actual Firebase auth verification.
+    Verifies the bearer ID token locally and sets request.user_id to its uid.
     """
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -59,23 +266,365 @@ def require_auth(f):
                 'message': 'Missing authorization header'
             }), 401
 
-        # TODO: Verify Firebase token
-        # try:
-        #     token = auth_header.replace('Bearer ', '')
-        #     decoded_token = firebase_admin.auth.verify_id_token(token)
-        #     request.user_id = decoded_token['uid']
-        # except Exception as e:
-        #     return jsonify({
-        #         'success': False,
-        #         'isPremium': False,
-        #         'message': 'Invalid authorization token'
-        #     }), 401
+        if FIREBASE_AUTH_ENABLED:
+            try:
+                token = bearer_token(auth_header)
+                with metrics.timer('receipt_stage_duration_seconds', {'stage': 'auth'}):
+                    decoded_token = firebase_verifier.verify(token)
+                request.user_id = decoded_token['uid']
+                request.auth_claims = decoded_token
+            except InvalidTokenError as e:
+                logger.warning("Invalid auth token", extra={'reason': str(e)})
+                return jsonify({
+                    'success': False,
+                    'isPremium': False,
+                    'message': 'Invalid authorization token'
+                }), 401
+            except SigningKeysUnavailable as e:
+                logger.error("Firebase signing keys unavailable", extra={'reason': str(e)})
+                return jsonify({
+                    'success': False,
+                    'isPremium': False,
+                    'message': 'Authentication temporarily unavailable'
+                }), 503
+
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def require_admin(f):
+    """
+    Decorator (inside require_auth) limiting a route to admin callers: the
+    ID token carries the ADMIN_CLAIM custom claim, or its uid is in
+    ADMIN_UIDS. Everyone passes when auth is disabled (local runs).
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if FIREBASE_AUTH_ENABLED and not is_admin(getattr(request, 'auth_claims', None)):
+            logger.warning("Admin route refused", extra={'user_id': getattr(request, 'user_id', None)})
+            return jsonify({
+                'success': False,
+                'message': 'Admin access required'
+            }), 403
 
         return f(*args, **kwargs)
 
     return decorated_function
 
 
+def is_admin(claims):
+    if not claims:
+        return False
+    return claims.get(ADMIN_CLAIM) is True or claims.get('uid') in ADMIN_UIDS
+
+
+class ReceiptVerdictCache:
+    """
+    Thread-safe LRU cache of verification results keyed by receipt SHA-256.
+
+    Premium verdicts never outlive the subscription's expirationDate, negative
+    verdicts use a shorter TTL, and transient Apple failures are not cached.
+    Expired verdicts are kept for another stale_seconds so get_stale() can
+    still answer while Apple is unavailable. Entries are also indexed by
+    original transaction ID and user, so invalidate_subscription() can drop
+    every verdict of a refunded or revoked subscription.
+    """
+
+    def __init__(self, max_entries=VERDICT_CACHE_MAX_ENTRIES,
+                 ttl_seconds=VERDICT_CACHE_TTL_SECONDS,
+                 negative_ttl_seconds=VERDICT_CACHE_NEGATIVE_TTL_SECONDS,
+                 stale_seconds=VERDICT_CACHE_STALE_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.stale_seconds = stale_seconds
+        self._entries = OrderedDict()  # receipt_hash -> (expires_at_monotonic, result, owner keys)
+        self._owners = {}              # ('txn' | 'user', id) -> {receipt_hash}
+        self._lock = threading.Lock()
+
+    def get(self, receipt_hash):
+        return self._get(receipt_hash, 0)
+
+    def get_stale(self, receipt_hash):
+        """
+        Like get(), but also returns verdicts up to stale_seconds past their TTL.
+        """
+        return self._get(receipt_hash, self.stale_seconds)
+
+    def _get(self, receipt_hash, stale_seconds):
+        with self._lock:
+            entry = self._entries.get(receipt_hash)
+            if entry is None:
+                return None
+
+            expires_at, result, _ = entry
+            now = time.monotonic()
+            if expires_at + self.stale_seconds <= now:
+                self._drop(receipt_hash)
+                return None
+            if expires_at + stale_seconds <= now:
+                return None
+
+            self._entries.move_to_end(receipt_hash)
+            return dict(result)
+
+    def put(self, receipt_hash, result, user_id=None):
+        ttl = self._ttl_for(result)
+        if ttl <= 0:
+            return
+
+        owners = tuple(
+            (kind, str(owner)) for kind, owner in
+            (('txn', result.get('originalTransactionId')), ('user', user_id)) if owner
+        )
+        with self._lock:
+            self._drop(receipt_hash)
+            self._entries[receipt_hash] = (time.monotonic() + ttl, dict(result), owners)
+            for owner in owners:
+                self._owners.setdefault(owner, set()).add(receipt_hash)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, receipt_hash):
+        with self._lock:
+            self._drop(receipt_hash)
+
+    def invalidate_subscription(self, original_transaction_id=None, user_id=None):
+        """
+        Drop every verdict for the subscription or the user.
+        Returns how many were dropped.
+        """
+        owners = [(kind, str(owner)) for kind, owner in
+                  (('txn', original_transaction_id), ('user', user_id)) if owner]
+        with self._lock:
+            receipt_hashes = set()
+            for owner in owners:
+                receipt_hashes.update(self._owners.get(owner, ()))
+            for receipt_hash in receipt_hashes:
+                self._drop(receipt_hash)
+        return len(receipt_hashes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+
+    def _drop(self, receipt_hash):
+        # Caller holds self._lock
+        entry = self._entries.pop(receipt_hash, None)
+        if entry is None:
+            return
+        for owner in entry[2]:
+            receipt_hashes = self._owners.get(owner)
+            if receipt_hashes is not None:
+                receipt_hashes.discard(receipt_hash)
+                if not receipt_hashes:
+                    del self._owners[owner]
+
+    def _ttl_for(self, result):
+        if not result.get('success'):
+            if result.get('status') in RETRYABLE_APPLE_STATUSES:
+                return 0
+            return self.negative_ttl_seconds
+
+        if not result.get('isPremium'):
+            return self.negative_ttl_seconds
+
+        expiration = result.get('expirationDate')
+        if not expiration:
+            # Lifetime purchase
+            return self.ttl_seconds
+
+        try:
+            expires_date = datetime.fromisoformat(expiration.rstrip('Z'))
+        except ValueError:
+            return 0
+
+        remaining = (expires_date - datetime.utcnow()).total_seconds()
+        return min(self.ttl_seconds, remaining)
+
+
+verdict_cache = ReceiptVerdictCache()
+
+
+class ReceiptEnvironmentMemory:
+    """
+    Remembers whether a user's receipts come from sandbox or production, keyed
+    by user ID and by original transaction ID, so verify_with_apple can call
+    the right Apple host first.
+    """
+
+    def __init__(self, max_entries=ENVIRONMENT_MEMORY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._environments = OrderedDict()  # ('user' | 'txn', id) -> 'production' | 'sandbox'
+        self._lock = threading.Lock()
+
+    def lookup(self, user_id=None, original_transaction_id=None):
+        keys = []
+        if original_transaction_id:
+            keys.append(('txn', str(original_transaction_id)))
+        if user_id:
+            keys.append(('user', user_id))
+
+        with self._lock:
+            for key in keys:
+                environment = self._environments.get(key)
+                if environment is not None:
+                    self._environments.move_to_end(key)
+                    return environment
+        return None
+
+    def remember(self, environment, user_id=None, original_transaction_id=None):
+        if environment not in ('production', 'sandbox'):
+            return
+
+        with self._lock:
+            for key in (('txn', original_transaction_id), ('user', user_id)):
+                if not key[1]:
+                    continue
+                key = (key[0], str(key[1]))
+                self._environments[key] = environment
+                self._environments.move_to_end(key)
+            while len(self._environments) > self.max_entries:
+                self._environments.popitem(last=False)
+
+
+receipt_environments = ReceiptEnvironmentMemory()
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key: the first caller runs the
+    function, later callers block until it finishes and get the same result
+    (or the same exception).
+    """
+
+    def __init__(self, wait_timeout=SINGLE_FLIGHT_WAIT_TIMEOUT):
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+
+        if not leader:
+            logger.info("Waiting on in-flight validation for same receipt")
+            metrics.inc('receipt_coalesced_requests_total')
+            if not call.done.wait(self.wait_timeout):
+                raise requests.Timeout("Timed out waiting for in-flight validation")
+            if call.error is not None:
+                raise call.error
+            return dict(call.result)
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+receipt_validations = SingleFlight()
+
+
+class AppleUnavailableError(Exception):
+    """Apple can't give a verdict right now (circuit open or retries exhausted)."""
+
+
+def _on_breaker_state_change(environment, state):
+    log = logger.warning if state == CircuitBreaker.OPEN else logger.info
+    log("Apple circuit breaker changed state", extra={'environment': environment, 'state': state})
+    metrics.inc('receipt_apple_circuit_transitions_total', {'environment': environment, 'state': state})
+
+
+apple_breakers = {
+    environment: CircuitBreaker(
+        environment,
+        failure_rate_threshold=APPLE_BREAKER_FAILURE_RATE,
+        minimum_calls=APPLE_BREAKER_MINIMUM_CALLS,
+        window_seconds=APPLE_BREAKER_WINDOW_SECONDS,
+        open_seconds=APPLE_BREAKER_OPEN_SECONDS,
+        half_open_calls=APPLE_BREAKER_HALF_OPEN_CALLS,
+        on_state_change=_on_breaker_state_change
+    )
+    for environment in ('production', 'sandbox')
+}
+
+apple_hedge_policies = {
+    environment: HedgePolicy(
+        percentile=APPLE_HEDGE_PERCENTILE,
+        min_delay_seconds=APPLE_HEDGE_MIN_DELAY_SECONDS,
+        max_ratio=APPLE_HEDGE_MAX_RATIO
+    )
+    for environment in ('production', 'sandbox')
+}
+
+
+_apple_session = None
+_apple_session_pid = None
+_apple_session_lock = threading.Lock()
+
+
+def get_apple_session():
+    """
+    Return the shared keep-alive session used for all Apple calls.
+
+    The session is created lazily per process so forked workers never share
+    sockets with their parent.
+    """
+    global _apple_session, _apple_session_pid
+
+    if _apple_session is not None and _apple_session_pid == os.getpid():
+        return _apple_session
+
+    with _apple_session_lock:
+        if _apple_session is None or _apple_session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=APPLE_POOL_CONNECTIONS,
+                pool_maxsize=APPLE_POOL_MAXSIZE,
+                pool_block=False
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)     # Local stand-ins (benchmarks/fake_apple_server.py)
+            session.headers.update({'Connection': 'keep-alive'})
+            _apple_session = session
+            _apple_session_pid = os.getpid()
+
+    return _apple_session
+
+
+def warm_apple_pool():
+    """
+    Open a keep-alive connection to each Apple host so the first real
+    validation doesn't pay the TCP + TLS handshake.
+    """
+    session = get_apple_session()
+    for url in (APPLE_PRODUCTION_URL, APPLE_SANDBOX_URL):
+        try:
+            session.head(url, timeout=(APPLE_CONNECT_TIMEOUT, APPLE_CONNECT_TIMEOUT))
+            logger.info("Warmed connection pool", extra={'url': url})
+        except requests.RequestException as e:
+            logger.warning("Pool warm-up failed", extra={'url': url, 'error': str(e)})
+
+
 @app.route('/api/verify-receipt', methods=['POST'])
 @require_auth
 def verify_receipt():
@@ -83,71 +632,48 @@ def verify_receipt():
     Main endpoint for receipt verification.
     """
     try:
-        # Parse request body
-        data = request.json
-        if not data:
+        # Parse request body. The raw body isn't cached on the request, and the
+        # receipt string is dropped once it's in its bytes buffer, so a large
+        # receipt is held only once while Apple is called.
+        data = request.get_json(cache=False)
+        error_message = verification_request_error(data)
+        if error_message:
             return jsonify({
                 'success': False,
                 'isPremium': False,
-                'message': 'Missing request body'
-            }), 400
-
-        receipt_data = data.get('receiptData')
-        user_id = data.get('userId')
-        device_info = data.get('deviceInfo', {})
-        app_version = data.get('appVersion')
-        bundle_id = data.get('bundleId')
-
-        # Validate required fields
-        if not receipt_data:
-            return jsonify({
-                'success': False,
-                'isPremium': False,
-                'message': 'Missing receipt data'
+                'message': error_message
             }), 400
 
-        # Security: Log only hash (NEVER log full receipt!)
-        receipt_hash = hashlib.sha256(receipt_data.encode()).hexdigest()[:8]
-        print(f"[ReceiptValidation] Receipt hash: {receipt_hash}")
-        print(f"[ReceiptValidation] User: {user_id}")
-        print(f"[ReceiptValidation] Device: {device_info.get('model')} - {device_info.get('osVersion')}")
-        print(f"[ReceiptValidation] App version: {app_version}")
-
-        # Verify bundle ID
-        if bundle_id and bundle_id != EXPECTED_BUNDLE_ID:
-            print(f"[ReceiptValidation] Bundle ID mismatch: {bundle_id}")
+        user_id, error_message = verified_user_id(getattr(request, 'user_id', None), data.get('userId'))
+        if error_message:
             return jsonify({
                 'success': False,
                 'isPremium': False,
-                'message': 'Invalid bundle ID'
-            }), 400
-
-        # Verify with Apple
-        result = verify_with_apple(receipt_data)
+                'message': error_message
+            }), 403
 
-        # Save to database if successful
-        if result['success'] and result['isPremium'] and user_id:
-            save_subscription_status(
-                user_id=user_id,
-                product_id=result.get('productId'),
-                expires_date=result.get('expirationDate'),
-                environment=result.get('environment')
-            )
+        receipt = receipt_buffer(data.pop('receiptData'))
+        result = validate_receipt(receipt, user_id=user_id)
 
         return jsonify(result), 200 if result['success'] else 400
 
     except requests.Timeout:
-        print("[ReceiptValidation] Request to Apple timed out")
+        logger.warning("Request to Apple timed out")
         return jsonify({
             'success': False,
             'isPremium': False,
             'message': 'Request timed out'
         }), 504
 
+    except AppleUnavailableError:
+        return jsonify({
+            'success': False,
+            'isPremium': False,
+            'message': 'Receipt verification temporarily unavailable'
+        }), 503
+
     except Exception as e:
-        print(f"[ReceiptValidation] Error: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Receipt validation error")
 
         return jsonify({
             'success': False,
@@ -156,51 +682,677 @@ def verify_receipt():
         }), 500
 
 
-def verify_with_apple(receipt_data):
+def verification_request_error(data):
     """
-    Verify receipt with Apple's servers.
-    Tries production first, falls back to sandbox if needed.
+    Check a /api/verify-receipt body (sync and async paths).
+    Returns the client-facing error message, or None if the body is usable.
     """
-    payload = {
-        "receipt-data": receipt_data,
-        "password": APP_SHARED_SECRET,
-        "exclude-old-transactions": True
-    }
+    if not data or not isinstance(data, dict):
+        return 'Missing request body'
+
+    # Validate required fields
+    if not data.get('receiptData'):
+        return 'Missing receipt data'
+    if not isinstance(data['receiptData'], str):
+        return 'Invalid receipt data'
+
+    device_info = data.get('deviceInfo') or {}
+    logger.info("Receipt validation request", extra={
+        'user_id': data.get('userId'),
+        'device_model': device_info.get('model'),
+        'os_version': device_info.get('osVersion'),
+        'app_version': data.get('appVersion')
+    })
+
+    # Verify bundle ID
+    bundle_id = data.get('bundleId')
+    if bundle_id and bundle_id != EXPECTED_BUNDLE_ID:
+        logger.warning("Bundle ID mismatch", extra={'bundle_id': bundle_id})
+        return 'Invalid bundle ID'
+
+    return None
+
+
+def verified_user_id(token_user_id, body_user_id):
+    """
+    The user a verdict is stored under (sync and async paths): the uid of
+    the verified ID token. A body userId naming anyone else is refused;
+    it is only honoured when auth is disabled (local runs, benchmarks).
+    Returns (user_id, client-facing error message or None).
+    """
+    if not FIREBASE_AUTH_ENABLED:
+        return body_user_id, None
+    if body_user_id and body_user_id != token_user_id:
+        logger.warning("userId does not match the ID token", extra={'user_id': token_user_id})
+        return None, 'User ID does not match the signed-in user'
+    return token_user_id, None
+
+
+def receipt_buffer(receipt_data):
+    """
+    The receipt as the one bytes buffer the pipeline hashes, keys on and
+    splices into the Apple request body. Base64 is ASCII, so encoding a str
+    receipt is the only copy made of it.
+    """
+    if isinstance(receipt_data, str):
+        return receipt_data.encode()
+    return receipt_data
+
+
+def receipt_digest(receipt):
+    return hashlib.sha256(receipt).hexdigest()
+
+
+def lookup_verdict(receipt, user_id=None):
+    """
+    Hash the receipt buffer and check the verdict cache.
+    Returns (receipt_hash, cached result or None).
+    """
+    # Security: Log only hash (NEVER log full receipt!)
+    receipt_hash = receipt_digest(receipt)
+    logger.info("Validating receipt", extra={
+        'receipt_hash': receipt_hash[:8],
+        'sample_rate': LOG_SAMPLE_RATE
+    })
+
+    result = verdict_cache.get(receipt_hash)
+    if result is not None and _revoked_since_cached(result, user_id):
+        verdict_cache.invalidate(receipt_hash)
+        result = None
+    if result is not None:
+        logger.info("Verdict cache hit", extra={'sample_rate': LOG_SAMPLE_RATE})
+        metrics.inc('receipt_verdict_cache_total', {'result': 'hit'})
+    else:
+        metrics.inc('receipt_verdict_cache_total', {'result': 'miss'})
+    return receipt_hash, result
+
+
+def validate_receipt(receipt_data, user_id=None):
+    """
+    Validation pipeline shared by the single and batch endpoints:
+    verdict cache, in-flight coalescing, Apple verification and persistence.
+    receipt_data is the base64 receipt as str or bytes.
+    """
+    receipt = receipt_buffer(receipt_data)
+    receipt_hash, result = lookup_verdict(receipt, user_id)
+    cached = result is not None
+
+    # Verify with Apple (repeat receipts are served from the verdict cache)
+    if not cached:
+        original_transaction_id, rejection = prevalidate_receipt(receipt)
+        if rejection is not None:
+            verdict_cache.put(receipt_hash, rejection)
+            return rejection
+
+        def validate():
+            verdict = verify_with_apple(
+                receipt, user_id=user_id, original_transaction_id=original_transaction_id
+            )
+            verdict_cache.put(receipt_hash, verdict, user_id=user_id)
+            return verdict
+
+        try:
+            result = receipt_validations.do(receipt_hash, validate)
+        except AppleUnavailableError:
+            result = last_known_verdict(receipt_hash, user_id)
+            if result is None:
+                raise
+            return result
+
+    if verdict_needs_recording(user_id, cached):
+        record_verdict(result, receipt, user_id)
+    return result
+
+
+def prevalidate_receipt(receipt):
+    """
+    Decode the receipt locally before it goes to Apple.
+    Returns (original_transaction_id or None, rejection result or None);
+    the rejection mirrors what Apple / parse_apple_response would answer.
+    """
+    if not RECEIPT_PREVALIDATION_ENABLED:
+        return None, None
 
-    # Try production first
-    print("[ReceiptValidation] Verifying with Apple production")
     try:
-        response = requests.post(APPLE_PRODUCTION_URL, json=payload, timeout=30)
-        apple_response = response.json()
-        status = apple_response.get('status')
-
-        # Status 21007 = Sandbox receipt sent to production
-        if status == 21007:
-            print("[ReceiptValidation] Sandbox receipt detected, trying sandbox")
-            response = requests.post(APPLE_SANDBOX_URL, json=payload, timeout=30)
-            apple_response = response.json()
-            status = apple_response.get('status')
-
-        # Status 0 = Success
-        if status == 0:
-            print("[ReceiptValidation] Apple verification successful")
-            return parse_apple_response(apple_response)
-        else:
-            error_message = APPLE_STATUS_CODES.get(status, f"Unknown error (status {status})")
-            print(f"[ReceiptValidation] Apple verification failed: {error_message}")
-            return {
-                'success': False,
-                'isPremium': False,
-                'message': error_message
+        with metrics.timer('receipt_stage_duration_seconds', {'stage': 'prevalidate'}):
+            info = decode_receipt(receipt)
+    except InvalidReceiptError as e:
+        logger.warning("Malformed receipt rejected before Apple", extra={'reason': str(e)})
+        metrics.inc('receipt_prevalidation_rejections_total', {'reason': 'malformed'})
+        return None, {
+            'success': False,
+            'isPremium': False,
+            'status': 21002,
+            'message': APPLE_STATUS_CODES[21002]
+        }
+
+    if info.bundle_id != EXPECTED_BUNDLE_ID:
+        logger.warning("Bundle ID mismatch in receipt", extra={'bundle_id': info.bundle_id})
+        metrics.inc('receipt_prevalidation_rejections_total', {'reason': 'bundle_id'})
+        return None, {
+            'success': False,
+            'isPremium': False,
+            'message': 'Bundle ID mismatch'
+        }
+
+    return info.original_transaction_id, None
+
+
+def last_known_verdict(receipt_hash, user_id=None):
+    """
+    Best answer while Apple is unavailable: the verdict cached for this
+    receipt (even past its TTL), else the signed-in user's own stored
+    subscription if it hasn't expired. Returns None if there is neither.
+
+    Nothing read from the receipt itself is trusted here: its signature is
+    never checked locally, so a transaction ID decoded from it could name
+    anyone's subscription.
+    """
+    result = verdict_cache.get_stale(receipt_hash)
+    if result is not None and _revoked_since_cached(result, user_id):
+        result = None
+    source = 'verdict_cache'
+
+    if result is None and user_id:
+        record = subscription_store.get(user_id)
+        if record and record['is_premium'] and _not_expired(record['expires_date']):
+            result = {
+                'success': True,
+                'isPremium': True,
+                'productId': record['product_id'],
+                'originalTransactionId': record['original_transaction_id'],
+                'expirationDate': record['expires_date'],
+                'environment': record['environment'],
+                'message': 'Subscription verified previously'
             }
+            source = 'subscription_store'
+
+    if result is None:
+        return None
+
+    logger.warning("Apple unavailable, serving last known verdict", extra={'source': source})
+    metrics.inc('receipt_degraded_responses_total', {'source': source})
+    result['stale'] = True
+    return result
+
+
+def _revoked_since_cached(result, user_id):
+    """
+    Whether a cached premium verdict has been overtaken by a refund,
+    revocation or expiry stored since (possibly by another worker, which
+    reaches this process through the entitlement index).
+    """
+    return bool(result.get('isPremium') and user_id and entitlement_index.revoked(user_id))
+
+
+def _not_expired(expires_date):
+    if not expires_date:
+        # Lifetime purchase
+        return True
+    try:
+        return datetime.fromisoformat(expires_date.rstrip('Z')) > datetime.utcnow()
+    except ValueError:
+        return False
+
+
+def verdict_needs_recording(user_id, cached):
+    """
+    Fresh verdicts from Apple are always persisted. A cached one was stored
+    when Apple gave it, so it is only written for a user with no stored
+    subscription yet (e.g. another account on the same device).
+    """
+    return not cached or (user_id is not None and user_id not in entitlement_index)
+
+
+def record_verdict(result, receipt_data, user_id):
+    """
+    Persist a verdict (with its receipt, for background re-validation) and
+    (re)schedule its re-validation.
+    """
+    # Save to database if successful
+    if result['success'] and result['isPremium'] and user_id:
+        save_subscription_status(
+            user_id=user_id,
+            product_id=result.get('productId'),
+            expires_date=result.get('expirationDate'),
+            environment=result.get('environment'),
+            original_transaction_id=result.get('originalTransactionId'),
+            receipt=receipt_data
+        )
+        revalidation_scheduler.schedule(user_id, result.get('expirationDate'))
+    elif result['success'] and user_id:
+        revalidation_scheduler.cancel(user_id)
+
+
+_batch_executor = None
+_batch_executor_pid = None
+_batch_executor_lock = threading.Lock()
+
+
+def get_batch_executor():
+    """
+    Return the worker pool shared by all batch requests, so total batch
+    concurrency against Apple stays bounded by BATCH_MAX_WORKERS.
+    """
+    global _batch_executor, _batch_executor_pid
+
+    if _batch_executor is not None and _batch_executor_pid == os.getpid():
+        return _batch_executor
+
+    with _batch_executor_lock:
+        if _batch_executor is None or _batch_executor_pid != os.getpid():
+            _batch_executor = ThreadPoolExecutor(
+                max_workers=BATCH_MAX_WORKERS,
+                thread_name_prefix='receipt-batch'
+            )
+            _batch_executor_pid = os.getpid()
+
+    return _batch_executor
+
+
+def batch_request_items(data):
+    """
+    Check a /api/verify-receipts body (sync and async paths).
+    Returns (items, None) or (None, client-facing error message).
+    """
+    items = data.get('items') if isinstance(data, dict) else None
+
+    if not isinstance(items, list) or not items:
+        return None, 'Missing items'
+    if len(items) > BATCH_MAX_ITEMS:
+        return None, f'Too many items (max {BATCH_MAX_ITEMS})'
+    if not all(isinstance(item, dict) for item in items):
+        return None, 'Each item must be an object'
+
+    logger.info("Batch verification", extra={'items': len(items)})
+    return items, None
+
+
+def batch_item_error(item):
+    """
+    The error result for a batch item that can't be validated, or None.
+    """
+    receipt_data = item.get('receiptData')
+    user_id = item.get('userId')
+    if not receipt_data:
+        return {'success': False, 'isPremium': False, 'message': 'Missing receipt data'}
+    if not isinstance(receipt_data, str):
+        return {'success': False, 'isPremium': False, 'message': 'Invalid receipt data'}
+    if user_id is not None and not isinstance(user_id, str):
+        return {'success': False, 'isPremium': False, 'message': 'Invalid user ID'}
+    return None
+
+
+def _validate_batch_item(index, item):
+    user_id = item.get('userId')
+    receipt_data = item.get('receiptData')
+
+    result = batch_item_error(item)
+    if result is None:
+        try:
+            # Admin callers name the user each verdict is stored for
+            result = validate_receipt(receipt_data, user_id=user_id or None)
+        except requests.Timeout:
+            result = {'success': False, 'isPremium': False, 'message': 'Request timed out'}
+        except AppleUnavailableError:
+            result = {'success': False, 'isPremium': False,
+                      'message': 'Receipt verification temporarily unavailable'}
+        except Exception as e:
+            logger.exception("Batch item error", extra={'index': index})
+            result = {'success': False, 'isPremium': False, 'message': 'Internal server error'}
+
+    return dict(result, index=index, userId=user_id)
+
+
+@app.route('/api/verify-receipts', methods=['POST'])
+@require_auth
+@require_admin
+def verify_receipts():
+    """
+    Batch endpoint for admin and reconciliation jobs.
+
+    Body: {"items": [{"userId": "...", "receiptData": "..."}, ...]}
+    Items are validated concurrently on a bounded pool and streamed back
+    as {"success": true, "count": N, "results": [...]} in completion order;
+    each result carries the "index" of its item. Verdicts are stored for
+    the userId of their item (items without one are only checked).
+    """
+    items, error_message = batch_request_items(request.get_json(silent=True))
+    if error_message:
+        return jsonify({
+            'success': False,
+            'message': error_message
+        }), 400
+
+    executor = get_batch_executor()
+    futures = [
+        executor.submit(contextvars.copy_context().run, _validate_batch_item, index, item)
+        for index, item in enumerate(items)
+    ]
+
+    def generate():
+        yield f'{{"success": true, "count": {len(futures)}, "results": ['.encode()
+        for position, future in enumerate(as_completed(futures)):
+            yield (b',' if position else b'') + json_codec.dumps(future.result())
+        yield b']}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+APPLE_REQUEST_HEADERS = {'Content-Type': 'application/json'}
+_BASE64_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+
+
+class AppleRequestBody:
+    """
+    verifyReceipt request body for a receipt buffer.
+
+    A base64 receipt needs no JSON escaping, so instead of serializing it
+    into a new document the buffer is sent as-is between a pre-encoded
+    prefix and suffix: iterating yields the three chunks, which the HTTP
+    client writes to the socket one after another, and len() is the
+    Content-Length. Anything that isn't plain base64 (Apple will reject it
+    with 21002) is encoded the ordinary way. The body can be sent any
+    number of times, for retries, redirects and hedged requests.
+    """
+
+    CHECK_CHUNK_BYTES = 64 * 1024
+
+    def __init__(self, receipt):
+        if not self._is_base64(receipt):
+            self.chunks = (json_codec.dumps({
+                "receipt-data": receipt.decode(errors='replace'),
+                "password": APP_SHARED_SECRET,
+                "exclude-old-transactions": True
+            }),)
+        else:
+            suffix = json_codec.dumps({
+                "password": APP_SHARED_SECRET,
+                "exclude-old-transactions": True
+            })
+            self.chunks = (b'{"receipt-data":"', receipt, b'",' + suffix[1:])
+        self._length = sum(len(chunk) for chunk in self.chunks)
+
+    @classmethod
+    def _is_base64(cls, receipt):
+        # A chunk at a time, so the check never allocates a receipt-sized temporary
+        for start in range(0, len(receipt), cls.CHECK_CHUNK_BYTES):
+            if receipt[start:start + cls.CHECK_CHUNK_BYTES].translate(None, _BASE64_ALPHABET):
+                return False
+        return True
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    async def aiter(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def apple_payload(receipt):
+    return AppleRequestBody(receipt_buffer(receipt))
+
+
+def apple_verification_plan(user_id=None, original_transaction_id=None):
+    """
+    Decide which Apple host to call first: the environment remembered for
+    this user / transaction, production when unknown.
+    Returns (first, fallback, redirect_status) with first/fallback as
+    (environment, url) pairs.
+    """
+    environment = receipt_environments.lookup(
+        user_id=user_id,
+        original_transaction_id=original_transaction_id
+    )
+    if environment == 'sandbox':
+        # Status 21008 = Production receipt sent to sandbox
+        return ('sandbox', APPLE_SANDBOX_URL), ('production', APPLE_PRODUCTION_URL), 21008
+
+    # Status 21007 = Sandbox receipt sent to production
+    return ('production', APPLE_PRODUCTION_URL), ('sandbox', APPLE_SANDBOX_URL), 21007
+
+
+def note_apple_redirect(fallback_environment, user_id):
+    logger.info("Receipt belongs to other environment, retrying", extra={
+        'environment': fallback_environment
+    })
+    receipt_environments.remember(fallback_environment, user_id=user_id)
+    metrics.inc('receipt_apple_redirects_total', {'to': fallback_environment})
+
+
+def record_apple_status(environment, apple_response):
+    metrics.inc('receipt_apple_status_total', {
+        'environment': environment,
+        'status': apple_response.get('status')
+    })
+
+
+def apple_verification_result(apple_response, user_id=None, original_transaction_id=None):
+    """
+    Turn Apple's final verifyReceipt response into our result dict and
+    remember the receipt's environment on success.
+    """
+    status = apple_response.get('status')
+
+    # Status 0 = Success
+    if status == 0:
+        logger.debug("Apple verification successful")
+        with metrics.timer('receipt_stage_duration_seconds', {'stage': 'parse'}):
+            result = parse_apple_response(apple_response)
+        receipt_environments.remember(
+            apple_response.get('environment', 'Production').lower(),
+            user_id=user_id,
+            original_transaction_id=result.get('originalTransactionId') or original_transaction_id
+        )
+        return result
+
+    error_message = APPLE_STATUS_CODES.get(status, f"Unknown error (status {status})")
+    logger.warning("Apple verification failed", extra={'status': status, 'reason': error_message})
+    return {
+        'success': False,
+        'isPremium': False,
+        'status': status,
+        'message': error_message
+    }
+
+
+def verify_with_apple(receipt_data, user_id=None, original_transaction_id=None):
+    """
+    Verify receipt (str or bytes) with Apple's servers.
+    Calls the environment remembered for this user / transaction first
+    (production when unknown) and falls back to the other host on 21007/21008.
+    """
+    payload = apple_payload(receipt_data)
+    session = get_apple_session()
+    deadline = time.monotonic() + APPLE_REQUEST_DEADLINE
+    first, fallback, redirect_status = apple_verification_plan(user_id, original_transaction_id)
+
+    logger.debug("Verifying with Apple", extra={'environment': first[0]})
+    try:
+        apple_response = _call_apple(session, first[1], first[0], payload, deadline)
+
+        if apple_response.get('status') == redirect_status:
+            note_apple_redirect(fallback[0], user_id)
+            apple_response = _call_apple(session, fallback[1], fallback[0], payload, deadline)
+
+        return apple_verification_result(apple_response, user_id, original_transaction_id)
 
     except requests.Timeout:
-        print("[ReceiptValidation] Request to Apple timed out")
+        logger.warning("Request to Apple timed out")
+        raise
+
+    except AppleUnavailableError as e:
+        logger.warning("Apple unavailable", extra={'reason': str(e)})
         raise
 
     except Exception as e:
-        print(f"[ReceiptValidation] Error calling Apple API: {str(e)}")
+        logger.error("Error calling Apple API", extra={'error': str(e)})
+        raise
+
+
+def check_apple_breaker(environment):
+    """
+    Raise AppleUnavailableError instead of calling a host whose circuit is open.
+    """
+    if not apple_breakers[environment].allow():
+        metrics.inc('receipt_apple_circuit_rejections_total', {'environment': environment})
+        raise AppleUnavailableError(f"Circuit open for Apple {environment}")
+
+
+def apple_read_timeout(deadline):
+    """
+    Read timeout for the next attempt: what's left of the deadline, capped
+    at APPLE_READ_TIMEOUT. Zero or less means the deadline has passed.
+    """
+    return min(APPLE_READ_TIMEOUT, deadline - time.monotonic())
+
+
+def apple_retry_delay(attempt, deadline, environment, reason):
+    """
+    Jittered backoff before retrying a failed attempt, or None when the
+    call should give up (out of retries, or the wait would pass the deadline).
+    """
+    if attempt >= APPLE_MAX_RETRIES:
+        return None
+    delay = backoff_delay(attempt, APPLE_BACKOFF_BASE_SECONDS, APPLE_BACKOFF_MAX_SECONDS)
+    if time.monotonic() + delay >= deadline:
+        return None
+    metrics.inc('receipt_apple_retries_total', {'environment': environment, 'reason': reason})
+    return delay
+
+
+def _call_apple(session, url, environment, payload, deadline):
+    """
+    One verifyReceipt call under the resilience policy: skipped while the
+    host's circuit is open, hedged when slow, and retried with backoff on
+    21005/21009 and connection errors. Timeouts are not retried; the
+    attempt already used up most of the deadline.
+    """
+    breaker = apple_breakers[environment]
+    attempt = 0
+    while True:
+        check_apple_breaker(environment)
+        read_timeout = apple_read_timeout(deadline)
+        if read_timeout <= 0:
+            breaker.record_failure()
+            raise requests.Timeout("Apple verification deadline exceeded")
+
+        error = None
+        try:
+            apple_response = _hedged_post_to_apple(
+                session, url, environment, payload, (APPLE_CONNECT_TIMEOUT, read_timeout)
+            )
+        except requests.Timeout:
+            breaker.record_failure()
+            raise
+        except (requests.RequestException, ValueError) as e:
+            breaker.record_failure()
+            error = e
+            reason = 'error'
+        else:
+            reason = apple_response.get('status')
+            if reason not in RETRYABLE_APPLE_STATUSES:
+                breaker.record_success()
+                return apple_response
+            breaker.record_failure()
+
+        delay = apple_retry_delay(attempt, deadline, environment, reason)
+        if delay is None:
+            raise AppleUnavailableError(
+                f"Apple {environment} failed {attempt + 1} attempts ({reason})"
+            ) from error
+        time.sleep(delay)
+        attempt += 1
+
+
+_apple_executor = None
+_apple_executor_pid = None
+_apple_executor_lock = threading.Lock()
+
+
+def get_apple_executor():
+    """
+    Threads that run hedged Apple calls, so the request thread can wait on
+    whichever of the two responses arrives first.
+    """
+    global _apple_executor, _apple_executor_pid
+
+    if _apple_executor is not None and _apple_executor_pid == os.getpid():
+        return _apple_executor
+
+    with _apple_executor_lock:
+        if _apple_executor is None or _apple_executor_pid != os.getpid():
+            _apple_executor = ThreadPoolExecutor(
+                max_workers=APPLE_HEDGE_MAX_WORKERS,
+                thread_name_prefix='apple-hedge'
+            )
+            _apple_executor_pid = os.getpid()
+
+    return _apple_executor
+
+
+def _hedged_post_to_apple(session, url, environment, payload, timeout):
+    """
+    _post_to_apple, plus a second identical request if the first is slower
+    than the recent latency percentile (verifyReceipt is read-only, so
+    duplicates are harmless). Returns the first successful response.
+    """
+    policy = apple_hedge_policies[environment]
+    hedge_delay = policy.delay() if APPLE_HEDGE_ENABLED else None
+    if hedge_delay is None or hedge_delay >= timeout[1]:
+        return _post_to_apple(session, url, environment, payload, timeout)
+
+    executor = get_apple_executor()
+    primary = executor.submit(
+        contextvars.copy_context().run, _post_to_apple, session, url, environment, payload, timeout
+    )
+    done, _ = wait([primary], timeout=hedge_delay)
+    if done or not policy.try_acquire():
+        return primary.result()
+
+    hedge_timeout = (timeout[0], timeout[1] - hedge_delay)
+    hedge = executor.submit(
+        contextvars.copy_context().run, _post_to_apple, session, url, environment, payload, hedge_timeout
+    )
+    done, pending = wait([primary, hedge], return_when=FIRST_COMPLETED)
+    succeeded = [future for future in done if future.exception() is None]
+    if succeeded:
+        winner = succeeded[0]
+    elif pending:
+        winner = pending.pop()
+    else:
+        winner = primary
+
+    metrics.inc('receipt_apple_hedged_requests_total', {
+        'environment': environment,
+        'winner': 'hedge' if winner is hedge else 'primary'
+    })
+    return winner.result()
+
+
+def _post_to_apple(session, url, environment, payload, timeout):
+    """
+    POST one verifyReceipt call, recording its latency and status code.
+    """
+    stage = 'apple_' + environment
+    started = time.perf_counter()
+    try:
+        with metrics.timer('receipt_stage_duration_seconds', {'stage': stage}):
+            response = session.post(url, data=payload, headers=APPLE_REQUEST_HEADERS, timeout=timeout)
+            apple_response = json_codec.loads(response.content)
+    except requests.Timeout:
+        metrics.inc('receipt_apple_status_total', {'environment': environment, 'status': 'timeout'})
         raise
+    except Exception:
+        metrics.inc('receipt_apple_status_total', {'environment': environment, 'status': 'error'})
+        raise
+
+    apple_hedge_policies[environment].record(time.perf_counter() - started)
+    record_apple_status(environment, apple_response)
+    return apple_response
 
 
 def parse_apple_response(apple_response):
@@ -211,26 +1363,24 @@ def parse_apple_response(apple_response):
     bundle_id = receipt.get('bundle_id')
     environment = apple_response.get('environment', 'Production')
 
-    print(f"[ReceiptValidation] Bundle ID: {bundle_id}")
-    print(f"[ReceiptValidation] Environment: {environment}")
+    logger.debug("Parsing Apple response", extra={'bundle_id': bundle_id, 'environment': environment})
 
     # Validate bundle ID
     if bundle_id != EXPECTED_BUNDLE_ID:
-        print(f"[ReceiptValidation] Bundle ID mismatch")
+        logger.warning("Bundle ID mismatch in receipt", extra={'bundle_id': bundle_id})
         return {
             'success': False,
             'isPremium': False,
             'message': 'Bundle ID mismatch'
         }
 
-    # Get in-app purchases
-    in_app_purchases = receipt.get('in_app', [])
-    latest_receipts = apple_response.get('latest_receipt_info', [])
-    all_purchases = in_app_purchases + latest_receipts
+    # Get in-app purchases (scanned in place, never concatenated)
+    in_app_purchases = receipt.get('in_app') or []
+    latest_receipts = apple_response.get('latest_receipt_info') or []
 
-    print(f"[ReceiptValidation] Found {len(all_purchases)} purchases")
+    logger.debug("Found purchases", extra={'purchases': len(in_app_purchases) + len(latest_receipts)})
 
-    if not all_purchases:
+    if not in_app_purchases and not latest_receipts:
         return {
             'success': True,
             'isPremium': False,
@@ -238,13 +1388,14 @@ def parse_apple_response(apple_response):
         }
 
     # Find active premium subscription
-    active_product = find_active_premium(all_purchases)
+    active_product = find_active_premium(in_app_purchases, latest_receipts)
 
     if active_product:
         return {
             'success': True,
             'isPremium': True,
             'productId': active_product['product_id'],
+            'originalTransactionId': active_product.get('original_transaction_id'),
             'expirationDate': active_product.get('expires_date'),
             'environment': environment.lower(),
             'message': 'Receipt verified successfully'
@@ -257,88 +1408,621 @@ def parse_apple_response(apple_response):
         }
 
 
-def find_active_premium(purchases):
+def find_active_premium(*purchase_lists):
     """
     Check if user has an active premium subscription or lifetime purchase.
+
+    Streams over every purchase list in a single pass and returns the
+    entitlement that lasts longest: a lifetime purchase wins outright,
+    otherwise the active subscription with the latest expires_date_ms.
+    """
+    now_ms = int(time.time() * 1000)
+    best_purchase = None
+    best_expires_ms = now_ms
+
+    for purchases in purchase_lists:
+        for purchase in purchases:
+            product_id = purchase.get('product_id')
+
+            # Check if it's a premium product
+            if product_id not in PREMIUM_PRODUCT_IDS:
+                continue
+
+            # Lifetime purchase (no expiration)
+            if product_id == LIFETIME_PRODUCT_ID:
+                logger.debug("Found active lifetime purchase")
+                return {
+                    'product_id': product_id,
+                    'original_transaction_id': purchase.get('original_transaction_id'),
+                    'expires_date': None
+                }
+
+            # Subscription (keep the one expiring last)
+            expires_date_ms = purchase.get('expires_date_ms')
+            if not expires_date_ms:
+                continue
+            try:
+                expires_ms = int(expires_date_ms)
+            except (TypeError, ValueError):
+                continue
+            if expires_ms > best_expires_ms:
+                best_expires_ms = expires_ms
+                best_purchase = purchase
+
+    if best_purchase is None:
+        logger.debug("No active subscriptions found")
+        return None
+
+    expires_date = datetime.utcfromtimestamp(best_expires_ms / 1000)
+    logger.debug("Found active subscription", extra={
+        'product_id': best_purchase.get('product_id'),
+        'expires_date': expires_date.isoformat()
+    })
+    return {
+        'product_id': best_purchase.get('product_id'),
+        'original_transaction_id': best_purchase.get('original_transaction_id'),
+        'expires_date': expires_date.isoformat() + 'Z'
+    }
+
+
+def create_subscription_store():
+    """
+    Build the configured subscription store (SQLite, optionally write-behind).
     """
-    now = datetime.utcnow()
+    store = SQLiteSubscriptionStore(SUBSCRIPTION_DB_PATH)
+    if SUBSCRIPTION_WRITE_BEHIND:
+        store = WriteBehindSubscriptionStore(store, batch_size=SUBSCRIPTION_WRITE_BATCH_SIZE)
+    return store
+
+
+subscription_store = create_subscription_store()
+atexit.register(subscription_store.close)
+entitlement_index = EntitlementIndex(subscription_store, refresh_interval=ENTITLEMENT_REFRESH_SECONDS)
 
-    for purchase in purchases:
-        product_id = purchase.get('product_id')
 
-        # Check if it's a premium product
-        if product_id not in PREMIUM_PRODUCTS:
+def save_subscription_status(user_id, product_id, expires_date, environment,
+                             original_transaction_id=None, is_premium=True, receipt=None):
+    """
+    Save subscription status to the subscription store (upsert by user_id).
+    """
+    logger.debug("Saving subscription", extra={
+        'user_id': user_id,
+        'product_id': product_id,
+        'expires_date': expires_date,
+        'environment': environment
+    })
+
+    record = {
+        'user_id': user_id,
+        'product_id': product_id,
+        'original_transaction_id': original_transaction_id,
+        'expires_date': expires_date,
+        'environment': environment,
+        'is_premium': is_premium,
+        'updated_at': datetime.utcnow().isoformat(timespec='microseconds') + 'Z'
+    }
+    if receipt is not None:
+        record['receipt'] = receipt
+    with metrics.timer('receipt_stage_duration_seconds', {'stage': 'persist'}):
+        subscription_store.upsert(record)
+    entitlement_index.update(record)
+
+
+class RevalidationScheduler:
+    """
+    Re-validates stored subscriptions shortly before they expire so premium
+    status is refreshed off the request path.
+
+    Subscriptions sit in a min-heap keyed on their due time
+    (expires_date - REVALIDATION_LEAD_SECONDS - jitter). The heap is seeded
+    from the subscription store (expiring_before) every seed_interval, so it
+    survives restarts and covers subscriptions validated by other workers;
+    validations and notifications handled by this process add to it in
+    between. Receipts are read back from the store when an entry is due.
+
+    Only one process per host runs the loop: the one holding an exclusive
+    lock on lock_path. The others keep their heaps and take over (re-seeding
+    first) if the holder exits. A single background thread pops due entries
+    in batches, paces Apple calls with a token bucket and runs them on the
+    batch executor. Each re-validation goes through validate_receipt, which
+    reschedules renewed subscriptions.
+    """
+
+    def __init__(self, lead_seconds=REVALIDATION_LEAD_SECONDS,
+                 jitter_seconds=REVALIDATION_JITTER_SECONDS,
+                 retry_seconds=REVALIDATION_RETRY_SECONDS,
+                 rate_per_second=REVALIDATION_RATE_PER_SECOND,
+                 batch_size=REVALIDATION_BATCH_SIZE,
+                 max_tracked=REVALIDATION_MAX_TRACKED,
+                 seed_interval=REVALIDATION_SEED_INTERVAL_SECONDS,
+                 seed_lookback=REVALIDATION_SEED_LOOKBACK_SECONDS,
+                 lock_path=None):
+        self.lead_seconds = lead_seconds
+        self.jitter_seconds = jitter_seconds
+        self.retry_seconds = retry_seconds
+        self.rate_per_second = rate_per_second
+        self.batch_size = batch_size
+        self.max_tracked = max_tracked
+        self.seed_interval = seed_interval
+        self.seed_lookback = seed_lookback
+        self.lock_path = lock_path
+
+        self._heap = []       # (due_at, user_id)
+        self._entries = {}    # user_id -> due_at
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._lock_file = None
+        self._next_seed = 0.0
+        self._tokens = float(rate_per_second)
+        self._tokens_updated = time.monotonic()
+
+    def schedule(self, user_id, expires_date, replace=True):
+        """
+        Track a subscription for re-validation. Lifetime purchases
+        (no expires_date) never need it. With replace=False an already
+        tracked subscription keeps its due time.
+        """
+        if not user_id or not expires_date:
+            self.cancel(user_id)
+            return
+
+        try:
+            expires_at = datetime.fromisoformat(expires_date.rstrip('Z'))
+        except ValueError:
+            return
+
+        now = time.time()
+        seconds_left = (expires_at - datetime.utcnow()).total_seconds()
+        due_at = now + seconds_left - self.lead_seconds - random.uniform(0, self.jitter_seconds)
+        # Apple hasn't shown the renewal yet: look again a bit later instead of spinning
+        due_at = max(due_at, now + self.retry_seconds)
+
+        with self._condition:
+            if user_id in self._entries and not replace:
+                return
+            if user_id not in self._entries and len(self._entries) >= self.max_tracked:
+                logger.warning("Re-validation queue full, not tracking user", extra={'user_id': user_id})
+                return
+
+            self._entries[user_id] = due_at
+            heapq.heappush(self._heap, (due_at, user_id))
+            if self._heap[0][0] == due_at:
+                self._condition.notify()
+
+    def reschedule(self, user_id, expires_date):
+        """
+        Move an already tracked subscription to a new expiry (e.g. a renewal
+        reported by App Store Server Notifications) without an Apple call.
+        """
+        with self._condition:
+            tracked = user_id in self._entries
+        if tracked:
+            self.schedule(user_id, expires_date)
+
+    def cancel(self, user_id):
+        # Stale heap entries are skipped when popped
+        with self._condition:
+            self._entries.pop(user_id, None)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._entries)
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run,
+                name='receipt-revalidation',
+                daemon=True
+            )
+            self._thread.start()
+        logger.info("Re-validation scheduler started")
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._lock_file is not None:
+            # Closing the file releases the lock for another worker
+            self._lock_file.close()
+            self._lock_file = None
+
+    def seed(self):
+        """
+        Track every stored premium subscription that expires before the
+        next seed is due (or expired less than seed_lookback ago).
+        """
+        now = datetime.utcnow()
+        horizon = now + timedelta(seconds=self.lead_seconds + self.jitter_seconds + 2 * self.seed_interval)
+        try:
+            records = subscription_store.expiring_before(
+                horizon.isoformat() + 'Z',
+                limit=self.max_tracked,
+                expires_after=(now - timedelta(seconds=self.seed_lookback)).isoformat() + 'Z'
+            )
+        except Exception as e:
+            logger.warning("Could not seed re-validation from the store", extra={'error': str(e)})
+            return
+
+        for record in records:
+            self.schedule(record['user_id'], record['expires_date'], replace=False)
+        logger.info("Seeded re-validation from the store", extra={'subscriptions': len(records)})
+
+    def _is_leader(self):
+        """
+        Take (or keep) the host-wide scheduler lock. Without a lock_path
+        every process is its own leader.
+        """
+        if self.lock_path is None or self._lock_file is not None:
+            return True
+        try:
+            lock_file = open(self.lock_path, 'a')
+        except OSError as e:
+            logger.warning("Could not open re-validation lock", extra={'error': str(e)})
+            return False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        self._next_seed = 0.0
+        logger.info("Re-validation scheduler running in this process")
+        return True
+
+    def _pop_due_batch(self, timeout):
+        """
+        Block until at least one entry is due, then pop up to batch_size of
+        them. Returns [] once timeout seconds have passed or on stop.
+        """
+        give_up_at = time.time() + timeout
+        with self._condition:
+            while not self._stopping:
+                # Drop heap entries superseded by a reschedule or cancel
+                while self._heap:
+                    due_at, user_id = self._heap[0]
+                    if self._entries.get(user_id) == due_at:
+                        break
+                    heapq.heappop(self._heap)
+
+                now = time.time()
+                if now >= give_up_at:
+                    return []
+                if not self._heap or self._heap[0][0] > now:
+                    next_due = self._heap[0][0] if self._heap else give_up_at
+                    self._condition.wait(min(next_due, give_up_at) - now)
+                    continue
+
+                batch = []
+                while self._heap and len(batch) < self.batch_size and self._heap[0][0] <= now:
+                    due_at, user_id = heapq.heappop(self._heap)
+                    if self._entries.get(user_id) != due_at:
+                        continue
+                    del self._entries[user_id]
+                    batch.append(user_id)
+                if batch:
+                    return batch
+        return []
+
+    def _acquire_tokens(self, count):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                float(self.rate_per_second),
+                self._tokens + (now - self._tokens_updated) * self.rate_per_second
+            )
+            self._tokens_updated = now
+            if self._tokens >= count:
+                self._tokens -= count
+                return
+            time.sleep((count - self._tokens) / self.rate_per_second)
+
+    def _revalidate(self, user_id):
+        request_id_var.set('revalidate-' + uuid.uuid4().hex[:12])
+        try:
+            receipt = subscription_store.get_receipt(user_id)
+            if receipt is None:
+                logger.info("No stored receipt to re-validate", extra={'user_id': user_id})
+                return
+
+            # Skip the verdict cache: it still holds the pre-renewal answer
+            verdict_cache.invalidate(receipt_digest(receipt))
+            result = validate_receipt(receipt, user_id=user_id)
+            if result.get('stale'):
+                raise AppleUnavailableError("Only a stale verdict was available")
+            if result['success'] and not result['isPremium']:
+                # Lapsed: stop counting (and seeding) the stored subscription
+                record = subscription_store.get(user_id)
+                if record is not None and record['is_premium']:
+                    save_subscription_status(
+                        user_id=user_id,
+                        product_id=record['product_id'],
+                        expires_date=record['expires_date'],
+                        environment=record['environment'],
+                        original_transaction_id=record['original_transaction_id'],
+                        is_premium=False
+                    )
+            logger.info("Re-validated subscription", extra={
+                'user_id': user_id,
+                'is_premium': result.get('isPremium')
+            })
+        except Exception as e:
+            logger.warning("Re-validation failed", extra={'user_id': user_id, 'error': str(e)})
+            with self._condition:
+                if user_id not in self._entries:
+                    due_at = time.time() + self.retry_seconds
+                    self._entries[user_id] = due_at
+                    heapq.heappush(self._heap, (due_at, user_id))
+
+    def _run(self):
+        executor = get_batch_executor()
+        while not self._stopping:
+            if not self._is_leader():
+                with self._condition:
+                    if not self._stopping:
+                        self._condition.wait(self.seed_interval)
+                continue
+
+            if time.monotonic() >= self._next_seed:
+                self._next_seed = time.monotonic() + self.seed_interval
+                self.seed()
+
+            batch = self._pop_due_batch(max(0.0, self._next_seed - time.monotonic()))
+            if not batch:
+                continue
+
+            logger.info("Re-validating subscriptions", extra={'batch': len(batch)})
+            futures = []
+            for user_id in batch:
+                self._acquire_tokens(1)
+                futures.append(executor.submit(
+                    contextvars.copy_context().run, self._revalidate, user_id
+                ))
+            for future in futures:
+                future.result()
+
+
+revalidation_scheduler = RevalidationScheduler(lock_path=REVALIDATION_LOCK_PATH)
+
+
+apple_notification_verifier = AppleNotificationVerifier(
+    EXPECTED_BUNDLE_ID,
+    trusted_root_fingerprints=APPLE_ROOT_CA_FINGERPRINTS
+)
+
+
+webhook_queue = WebhookQueue(
+    WEBHOOK_QUEUE_PATH,
+    lease_seconds=WEBHOOK_QUEUE_LEASE_SECONDS,
+    max_attempts=WEBHOOK_QUEUE_MAX_ATTEMPTS,
+    retention_seconds=WEBHOOK_QUEUE_RETENTION_SECONDS,
+    retry_base_seconds=WEBHOOK_QUEUE_RETRY_BASE_SECONDS,
+    retry_max_seconds=WEBHOOK_QUEUE_RETRY_MAX_SECONDS
+)
+atexit.register(webhook_queue.close)
+
+
+# App Store Server Notifications V2 endpoint
+@app.route('/api/webhooks/apple', methods=['POST'])
+def apple_webhook():
+    """
+    Receives signed subscription events from Apple.
+
+    Only stores the raw payload and acknowledges it; the webhook queue
+    worker verifies and applies notifications in batches, so Apple gets
+    its 200 quickly even during mass renewals. Byte-identical retries are
+    acknowledged without being queued again; other duplicates are dropped
+    by notificationUUID once their signature has been verified.
+    """
+    # Unauthenticated: bound what anyone can make us store
+    if (request.content_length or 0) > WEBHOOK_MAX_BODY_BYTES:
+        status, payload = webhook_body_too_large()
+        return jsonify(payload), status
+    request.max_content_length = WEBHOOK_MAX_BODY_BYTES   # Also caps chunked bodies
+
+    status, payload = enqueue_notification(request.get_json(silent=True))
+    return jsonify(payload), status
+
+
+def webhook_body_too_large():
+    metrics.inc('receipt_webhook_received_total', {'result': 'too_large'})
+    return 413, {'success': False, 'message': 'Request body too large'}
+
+
+def enqueue_notification(data):
+    """
+    Queue the signedPayload of a webhook body (sync and async paths).
+    Returns (HTTP status, response body).
+    """
+    signed_payload = data.get('signedPayload') if isinstance(data, dict) else None
+    if not isinstance(signed_payload, str) or not signed_payload:
+        return 400, {'success': False, 'message': 'Missing signedPayload'}
+
+    if signed_payload.count('.') != 2:
+        logger.warning("Rejected App Store notification", extra={'reason': "JWS must have three segments"})
+        metrics.inc('receipt_webhook_received_total', {'result': 'invalid'})
+        return 400, {'success': False, 'message': 'Invalid signedPayload'}
+
+    with metrics.timer('receipt_stage_duration_seconds', {'stage': 'webhook_enqueue'}):
+        queued = webhook_queue.enqueue(signed_payload)
+
+    if queued:
+        webhook_worker.notify()
+    metrics.inc('receipt_webhook_received_total', {'result': 'queued' if queued else 'duplicate'})
+    return 200, {'success': True}
+
+
+@app.route('/api/webhooks/test', methods=['GET'])
+def webhook_test():
+    return jsonify({'status': 'ok', 'endpoint': '/api/webhooks/apple'}), 200
+
+
+def process_notification_batch(items):
+    """
+    Verify and apply one batch drained from the webhook queue.
+    Returns the queue IDs to retry later.
+
+    Notifications already processed (by their verified notificationUUID,
+    in this batch or an earlier one) are dropped as duplicates.
+    """
+    verified = []
+    retry = []
+    for item_id, signed_payload in items:
+        try:
+            with metrics.timer('receipt_stage_duration_seconds', {'stage': 'webhook_verify'}):
+                notification = apple_notification_verifier.decode_notification(signed_payload)
+        except InvalidNotificationError as e:
+            logger.warning("Rejected App Store notification", extra={'reason': str(e)})
+            metrics.inc('receipt_webhook_notifications_total', {'type': 'unknown', 'result': 'invalid'})
+            continue
+        except Exception:
+            logger.exception("App Store notification verification error")
+            retry.append(item_id)
             continue
+        verified.append((notification.get('signedDate') or 0, item_id, notification))
 
-        print(f"[ReceiptValidation] Checking product: {product_id}")
+    seen = webhook_queue.processed_uuids(
+        notification['notificationUUID'] for _, _, notification in verified
+        if notification.get('notificationUUID')
+    )
+    processed = []
 
-        # Lifetime purchase (no expiration)
-        if product_id == "brain_dumpster_lifetime_premium":
-            print(f"[ReceiptValidation] ✅ Found active lifetime purchase")
-            return {
-                'product_id': product_id,
-                'expires_date': None
-            }
+    # Apply in Apple's signing order so a batch's renewals and expiries don't race
+    verified.sort(key=lambda entry: entry[:2])
+    for _, item_id, notification in verified:
+        notification_type = notification.get('notificationType', 'unknown')
+        key = notification.get('notificationUUID')
+        if key in seen:
+            metrics.inc('receipt_webhook_notifications_total', {'type': notification_type, 'result': 'duplicate'})
+            continue
+        try:
+            outcome = apply_notification(notification)
+        except Exception:
+            logger.exception("Applying App Store notification failed", extra={
+                'notification_uuid': notification.get('notificationUUID')
+            })
+            retry.append(item_id)
+            continue
 
-        # Subscription (check expiration)
-        expires_date_ms = purchase.get('expires_date_ms')
-        if expires_date_ms:
-            expires_date = datetime.utcfromtimestamp(int(expires_date_ms) / 1000)
+        logger.info("Processed App Store notification", extra={
+            'notification_type': notification_type,
+            'subtype': notification.get('subtype'),
+            'notification_uuid': notification.get('notificationUUID'),
+            'outcome': outcome
+        })
+        metrics.inc('receipt_webhook_notifications_total', {'type': notification_type, 'result': outcome})
+        if key:
+            seen.add(key)
+            processed.append(key)
 
-            # Check if still active
-            if expires_date > now:
-                print(f"[ReceiptValidation] ✅ Found active subscription: {product_id}")
-                print(f"[ReceiptValidation]    Expires: {expires_date.isoformat()}")
-                return {
-                    'product_id': product_id,
-                    'expires_date': expires_date.isoformat() + 'Z'
-                }
-            else:
-                print(f"[ReceiptValidation] ❌ Subscription expired: {product_id}")
+    webhook_queue.mark_processed(processed)
+    return retry
 
-    print("[ReceiptValidation] No active subscriptions found")
-    return None
 
+webhook_worker = WebhookQueueWorker(
+    webhook_queue,
+    process_notification_batch,
+    batch_size=WEBHOOK_QUEUE_BATCH_SIZE,
+    poll_interval=WEBHOOK_QUEUE_POLL_SECONDS
+)
+
+
+def apply_notification(notification):
+    """
+    Update the subscriber's stored status from a verified notification.
+    Returns the outcome: updated, stale, unknown_subscription or ignored.
+    """
+    data = notification.get('data') or {}
+    transaction = data.get('transactionInfo') or {}
+    renewal = data.get('renewalInfo') or {}
+    original_transaction_id = transaction.get('originalTransactionId')
+    product_id = transaction.get('productId')
+    if not original_transaction_id or product_id not in PREMIUM_PRODUCT_IDS:
+        return 'ignored'
+
+    # Subscriptions are keyed by Firebase uid; Apple only knows the transaction
+    record = subscription_store.get_by_original_transaction_id(original_transaction_id)
+    if record is None:
+        # The app's first verify-receipt call will store it
+        return 'unknown_subscription'
+    user_id = record['user_id']
+
+    expires_ms = transaction.get('expiresDate')
+    grace_ms = renewal.get('gracePeriodExpiresDate')
+    if expires_ms and grace_ms and grace_ms > expires_ms:
+        expires_ms = grace_ms
+    expires_date = _iso_from_ms(expires_ms) if expires_ms else None
+
+    is_premium = (
+        notification.get('notificationType') not in REVOKING_NOTIFICATION_TYPES
+        and not transaction.get('revocationDate')
+        and (expires_ms is None or expires_ms > time.time() * 1000)
+    )
+
+    # Notifications can arrive out of order; never let an older one win
+    if _older_than_record(notification, record, expires_ms, is_premium):
+        return 'stale'
 
-def save_subscription_status(user_id, product_id, expires_date, environment):
-    """
-    Save subscription status to database.
-    Replace with your actual database implementation.
-    """
-    print(f"[ReceiptValidation] Saving subscription for user: {user_id}")
-    print(f"[ReceiptValidation]    Product: {product_id}")
-    print(f"[ReceiptValidation]    Expires: {expires_date}")
-    print(f"[ReceiptValidation]    Environment: {environment}")
-
-    # TODO: Save to your database
-    # Example with MongoDB:
-    # db.subscriptions.update_one(
-    #     {'user_id': user_id},
-    #     {
-    #         '$set': {
-    #             'product_id': product_id,
-    #             'expires_date': expires_date,
-    #             'environment': environment,
-    #             'is_premium': True,
-    #             'updated_at': datetime.utcnow()
-    #         }
-    #     },
-    #     upsert=True
-    # )
-
-    # Example with PostgreSQL:
-    # cursor.execute("""
-    #     INSERT INTO subscriptions (user_id, product_id, expires_date, environment, is_premium)
-    #     VALUES (%s, %s, %s, %s, %s)
-    #     ON CONFLICT (user_id) DO UPDATE SET
-    #         product_id = EXCLUDED.product_id,
-    #         expires_date = EXCLUDED.expires_date,
-    #         environment = EXCLUDED.environment,
-    #         is_premium = EXCLUDED.is_premium,
-    #         updated_at = NOW()
-    # """, (user_id, product_id, expires_date, environment, True))
-
-    pass
+    environment = (data.get('environment') or record['environment'] or 'production').lower()
+    save_subscription_status(
+        user_id=user_id,
+        product_id=product_id,
+        expires_date=expires_date,
+        environment=environment,
+        original_transaction_id=original_transaction_id,
+        is_premium=is_premium
+    )
+    receipt_environments.remember(environment, user_id=user_id, original_transaction_id=original_transaction_id)
+
+    if is_premium:
+        revalidation_scheduler.reschedule(user_id, expires_date)
+    else:
+        # Cached premium verdicts would otherwise keep answering (and storing) premium
+        verdict_cache.invalidate_subscription(original_transaction_id, user_id)
+        revalidation_scheduler.cancel(user_id)
+    return 'updated'
+
+
+def _older_than_record(notification, record, expires_ms, is_premium):
+    """
+    Whether a notification describes an older state than the stored record:
+    a transaction that expires before the stored one (an earlier period,
+    whatever the notification type), or, for the same period, a grant
+    signed before a stored revocation was written.
+    """
+    stored_expiry = _parse_iso(record['expires_date'])
+    if expires_ms and stored_expiry:
+        notification_expiry = datetime.utcfromtimestamp(expires_ms / 1000)
+        if notification_expiry < stored_expiry:
+            return True
+        if notification_expiry > stored_expiry:
+            return False
+
+    if is_premium and not record['is_premium']:
+        signed_ms = notification.get('signedDate')
+        stored_at = _parse_iso(record.get('updated_at'))
+        if signed_ms and stored_at:
+            return datetime.utcfromtimestamp(signed_ms / 1000) < stored_at
+    return False
+
+
+def _parse_iso(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.rstrip('Z'))
+    except ValueError:
+        return None
+
+
+def _iso_from_ms(milliseconds):
+    return datetime.utcfromtimestamp(milliseconds / 1000).isoformat() + 'Z'
 
 
 # Health check endpoint
@@ -347,13 +2031,102 @@ def health():
     return jsonify({'status': 'ok'}), 200
 
 
+# Entitlement endpoint
+@app.route('/api/entitlement', methods=['GET'])
+@require_auth
+def entitlement():
+    """
+    Whether the signed-in user is premium, answered from the in-memory
+    entitlement index (never calls Apple). Validations and App Store
+    notifications keep the index current.
+    """
+    # userId is only honoured when auth is disabled (local runs, benchmarks)
+    user_id = request.user_id if FIREBASE_AUTH_ENABLED else request.args.get('userId')
+    status, payload = entitlement_status(user_id)
+    return jsonify(payload), status
+
+
+def entitlement_status(user_id):
+    """
+    /api/entitlement answer for a user (sync and async paths).
+    Returns (HTTP status, response body).
+    """
+    if not user_id:
+        return 400, {'success': False, 'isPremium': False, 'message': 'Missing user ID'}
+
+    try:
+        result = entitlement_index.get(user_id)
+    except EntitlementIndexUnavailable as e:
+        logger.error("Entitlement index unavailable", extra={'error': str(e)})
+        return 503, {
+            'success': False,
+            'isPremium': False,
+            'message': 'Entitlements temporarily unavailable'
+        }
+
+    return 200, dict(result, success=True, userId=user_id)
+
+
+# Prometheus scrape endpoint
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def start_background_services():
+    """
+    Per-process startup: open Apple connections, load the entitlement index
+    and start the re-validation scheduler and the webhook queue worker.
+    Threads and sockets don't survive fork, so multi-worker servers call
+    this in each worker (see gunicorn.conf.py post_fork).
+    """
+    warm_apple_pool()
+    # /api/entitlement also retries the load if this one fails
+    entitlement_index.start()
+    revalidation_scheduler.start()
+    webhook_worker.start()
+
+
+def stop_background_services(timeout=5):
+    """
+    Per-process shutdown: stop scheduling new Apple calls, stop draining
+    webhooks and commit any queued subscription writes.
+    """
+    revalidation_scheduler.stop(timeout)
+    webhook_worker.stop(timeout)
+    entitlement_index.stop(timeout)
+    try:
+        subscription_store.flush(timeout)
+    except SubscriptionWriteError as e:
+        logger.error("Subscription writes not committed at shutdown", extra={'error': str(e)})
+
+
+def create_app():
+    """
+    App factory for WSGI servers (wsgi.py).
+
+    Runs in the gunicorn master when preload_app is on, so it only loads
+    configuration and builds shared objects; workers inherit them
+    copy-on-write and start their own threads and sockets on fork.
+    """
+    if APP_SHARED_SECRET == "your_app_specific_shared_secret_here":
+        logger.warning("APP_SHARED_SECRET is not set")
+    get_apple_session()
+    return app
+
+
 if __name__ == '__main__':
-    print("🚀 Starting Receipt Validation Server")
+    print("🚀 Starting Receipt Validation Server (development server)")
     print(f"   Backend URL: http://57.129.81.193:5001/api")
     print(f"   Endpoint: POST /api/verify-receipt")
     print(f"   Bundle ID: {EXPECTED_BUNDLE_ID}")
     print()
     print("⚠️  IMPORTANT: Set APP_SHARED_SECRET before deploying!")
+    print("   Production: gunicorn -c gunicorn.conf.py wsgi:app")
     print()
 
-    app.run(host='0.0.0.0', port=5001, debug=True)
+    create_app()
+    start_background_services()
+
+    app.run(host='0.0.0.0', port=5001, debug=os.environ.get('FLASK_DEBUG') == '1',
+            use_reloader=False, threaded=True)
@@ -3,30 +3,23 @@
 Remove PDFGenerator.swift references from Xcode project file
 """
 
-import re
+from pbxproj import PBXProject
 
 project_file = 'Braindumpster.xcodeproj/project.pbxproj'
 
 print("🔍 Reading project file...")
-with open(project_file, 'r', encoding='utf-8') as f:
-    content = f.read()
+project = PBXProject.load(project_file)
 
 print("🗑️  Removing PDFGenerator.swift references...")
 
-# Remove lines containing PDFGenerator.swift
-lines = content.split('\n')
-filtered_lines = []
-
-for line in lines:
-    if 'PDFGenerator.swift' not in line:
-        filtered_lines.append(line)
-    else:
-        print(f"  Removing: {line.strip()[:80]}...")
-
-content = '\n'.join(filtered_lines)
+# The file reference, its build files and its group/phase entries go together
+for path in ('Utilities/PDFGenerator.swift', 'PDFGenerator.swift'):
+    file_ref_id = project.file_ref(path)
+    if file_ref_id:
+        print(f"  Removing: {file_ref_id} /* {path} */")
+        project.remove_file(path)
 
 print("💾 Writing cleaned project file...")
-with open(project_file, 'w', encoding='utf-8') as f:
-    f.write(content)
+project.save()
 
 print("✅ Successfully removed all PDFGenerator.swift references from Xcode project")
@@ -0,0 +1,214 @@
+"""
+Failure handling for calls to a flaky upstream (Apple's verifyReceipt).
+
+- CircuitBreaker stops calling a host whose recent calls mostly fail and
+  lets a few probes through after a cool-down.
+- HedgePolicy tracks recent latencies and says when a slow call deserves a
+  second, hedged request, within a budget.
+- backoff_delay is exponential backoff with full jitter.
+
+All three are thread-safe and hold no I/O, so the threaded and asyncio
+paths share the same instances.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+
+def backoff_delay(attempt, base_seconds, max_seconds):
+    """
+    Seconds to sleep before retry number attempt + 1 ("full jitter").
+    """
+    return random.uniform(0, min(max_seconds, base_seconds * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    Closed: calls flow and outcomes are recorded over window_seconds. Once
+    at least minimum_calls have been seen and the failure rate reaches
+    failure_rate_threshold, the breaker opens.
+
+    Open: allow() is False for open_seconds, then the breaker goes half-open.
+
+    Half-open: up to half_open_calls probes are let through. If they all
+    succeed the breaker closes; any failure opens it again.
+
+    on_state_change(name, state) is called outside the lock on transitions.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_rate_threshold=0.5, minimum_calls=20,
+                 window_seconds=30, open_seconds=15, half_open_calls=3,
+                 on_state_change=None):
+        self.name = name
+        self.failure_rate_threshold = failure_rate_threshold
+        self.minimum_calls = minimum_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.on_state_change = on_state_change
+
+        self._state = self.CLOSED
+        self._outcomes = deque()     # (monotonic time, failed)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            state, changed = self._current_state(time.monotonic())
+        if changed:
+            self._notify(state)
+        return state
+
+    def allow(self):
+        """
+        Whether a call may go out now. In half-open state this reserves a
+        probe slot, so every allowed call must report back with
+        record_success() or record_failure().
+        """
+        now = time.monotonic()
+        with self._lock:
+            state, changed = self._current_state(now)
+            if state == self.CLOSED:
+                allowed = True
+            elif state == self.HALF_OPEN and self._probes < self.half_open_calls:
+                self._probes += 1
+                allowed = True
+            else:
+                allowed = False
+        if changed:
+            self._notify(state)
+        return allowed
+
+    def record_success(self):
+        self._record(False)
+
+    def record_failure(self):
+        self._record(True)
+
+    def _record(self, failed):
+        now = time.monotonic()
+        new_state = None
+        with self._lock:
+            state, changed = self._current_state(now)
+            if changed:
+                new_state = state
+            if state == self.HALF_OPEN:
+                if failed:
+                    new_state = self._open(now)
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        new_state = self._close()
+            elif state == self.CLOSED:
+                self._outcomes.append((now, failed))
+                self._failures += failed
+                self._trim(now)
+                total = len(self._outcomes)
+                if (total >= self.minimum_calls
+                        and self._failures >= total * self.failure_rate_threshold):
+                    new_state = self._open(now)
+            # Outcomes of calls that started before the breaker opened are ignored
+        if new_state is not None:
+            self._notify(new_state)
+
+    def _current_state(self, now):
+        """
+        (state, changed): moves open -> half-open once the cool-down is over.
+        """
+        if self._state == self.OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+            return self._state, True
+        return self._state, False
+
+    def _open(self, now):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        self._failures = 0
+        return self.OPEN
+
+    def _close(self):
+        self._state = self.CLOSED
+        self._outcomes.clear()
+        self._failures = 0
+        return self.CLOSED
+
+    def _trim(self, now):
+        cutoff = now - self.window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._failures -= self._outcomes.popleft()[1]
+
+    def _notify(self, state):
+        if self.on_state_change is not None:
+            self.on_state_change(self.name, state)
+
+
+class HedgePolicy:
+    """
+    Decides when to send a hedged duplicate of a slow idempotent call.
+
+    delay() is the given percentile of the last `window` successful call
+    latencies (never below min_delay_seconds), or None until
+    minimum_samples have been recorded. Hedges are paid for by a budget
+    that grows by max_ratio per call, so at most about max_ratio of all
+    calls are hedged even when the upstream is slow across the board.
+    """
+
+    def __init__(self, percentile=0.95, window=500, minimum_samples=50,
+                 min_delay_seconds=0.25, max_ratio=0.1, max_burst=10):
+        self.percentile = percentile
+        self.min_delay_seconds = min_delay_seconds
+        self.minimum_samples = minimum_samples
+        self.max_ratio = max_ratio
+        self.max_burst = max_burst
+
+        self._samples = deque(maxlen=window)
+        self._delay = None
+        self._since_recompute = 0
+        self._budget = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+            self._since_recompute += 1
+            # Sorting the window on every call would cost more than it's worth
+            if self._delay is None or self._since_recompute >= 20:
+                self._recompute()
+
+    def delay(self):
+        """
+        Seconds to wait for the first response before hedging, or None.
+        Also earns this call's share of the hedge budget.
+        """
+        with self._lock:
+            self._budget = min(float(self.max_burst), self._budget + self.max_ratio)
+            return self._delay
+
+    def try_acquire(self):
+        with self._lock:
+            if self._budget >= 1.0:
+                self._budget -= 1.0
+                return True
+            return False
+
+    def _recompute(self):
+        self._since_recompute = 0
+        if len(self._samples) < self.minimum_samples:
+            self._delay = None
+            return
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(self.percentile * len(ordered)))
+        self._delay = max(self.min_delay_seconds, ordered[index])
@@ -0,0 +1,176 @@
+"""
+Non-blocking structured logging for the receipt validation backend.
+
+Request threads only put records on an in-memory queue; a background
+listener thread formats them as one JSON object per line and writes them
+out, so workers never serialize on stdout.
+
+- Every record carries the current request's correlation ID (request_id).
+- Extra fields passed with `extra={...}` become top-level JSON keys.
+- Records logged with `extra={'sample_rate': 0.01}` are kept with that
+  probability, for high-volume lines.
+"""
+
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+# Attributes every LogRecord has; anything else came from `extra`
+_STANDARD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'request_id', 'sample_rate'
+}
+
+_LOG_QUEUE_MAX_SIZE = 10000
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Stamps each record with the correlation ID of the request that emitted it.
+    """
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drops records that set a `sample_rate` below 1 with probability 1 - rate.
+    Warnings and errors are never sampled.
+    """
+
+    def filter(self, record):
+        rate = getattr(record, 'sample_rate', None)
+        if rate is None or rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'pid': record.process,
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry['request_id'] = request_id
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class ForkSafeQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that (re)starts its listener thread in whichever process
+    emits, so logging keeps working in workers forked after import.
+    """
+
+    def __init__(self, target_handler):
+        super().__init__(queue.Queue(_LOG_QUEUE_MAX_SIZE))
+        self.target_handler = target_handler
+        self._listener = None
+        self._listener_pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._listener_pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._listener_pid != os.getpid():
+                # A forked child inherits the parent's queue contents but not its thread
+                self.queue = queue.Queue(_LOG_QUEUE_MAX_SIZE)
+                self._listener = logging.handlers.QueueListener(
+                    self.queue, self.target_handler, respect_handler_level=True
+                )
+                self._listener.start()
+                self._listener_pid = os.getpid()
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block a request on logging; drop instead
+            pass
+
+    def prepare(self, record):
+        # Resolve everything that can't safely cross to the listener thread,
+        # but leave the JSON formatting itself to the listener.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def close(self):
+        with self._lock:
+            if self._listener is not None and self._listener_pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._listener_pid = None
+        super().close()
+
+
+_exception_formatter = logging.Formatter()
+_configured_handler = None
+
+
+def configure_logging(level=logging.INFO, stream=None):
+    """
+    Route the root logger through a single queue-backed JSON handler.
+    Safe to call more than once; later calls only change the level.
+    """
+    global _configured_handler
+
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    if _configured_handler is not None:
+        return _configured_handler
+
+    target = logging.StreamHandler(stream or sys.stdout)
+    target.setFormatter(JsonFormatter())
+
+    handler = ForkSafeQueueHandler(target)
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(SamplingFilter())
+
+    root.addHandler(handler)
+    _configured_handler = handler
+    atexit.register(shutdown_logging)
+    return handler
+
+
+def shutdown_logging():
+    """
+    Flush queued records and stop the listener thread.
+    """
+    global _configured_handler
+
+    if _configured_handler is not None:
+        logging.getLogger().removeHandler(_configured_handler)
+        _configured_handler.close()
+        _configured_handler = None
@@ -0,0 +1,518 @@
+"""
+Subscription persistence for the receipt validation backend.
+
+SubscriptionStore defines the interface; SQLiteSubscriptionStore is the
+embedded default (one file, no server, safe to point tests at ':memory:').
+WriteBehindSubscriptionStore wraps any backend and moves writes off the
+request thread, grouping them into batched transactions.
+
+Stores also keep a change log (snapshot / changes_since) so in-memory
+views such as entitlement_index.EntitlementIndex can follow writes made by
+other processes.
+"""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger('subscription_store')
+
+
+class SubscriptionWriteError(Exception):
+    """Queued subscription writes could not be committed (yet)."""
+
+
+class SubscriptionStore:
+    """
+    Interface for subscription backends.
+
+    Records are dicts with: user_id, product_id, original_transaction_id,
+    expires_date (ISO 8601 UTC string, None for lifetime), environment,
+    is_premium and updated_at. A record may also carry the receipt (bytes)
+    it was validated from; it is stored apart from the record, kept when a
+    later write has none, and read back with get_receipt().
+    """
+
+    def upsert(self, record):
+        self.upsert_many([record])
+
+    def upsert_many(self, records):
+        raise NotImplementedError
+
+    def get(self, user_id):
+        raise NotImplementedError
+
+    def get_by_original_transaction_id(self, original_transaction_id):
+        """
+        The most recently updated record for an App Store subscription, or None.
+        """
+        raise NotImplementedError
+
+    def get_receipt(self, user_id):
+        """
+        The receipt last stored for the user, or None.
+        """
+        raise NotImplementedError
+
+    def expiring_before(self, expires_date, limit=1000, expires_after=None):
+        """
+        Premium subscriptions whose expires_date is earlier than the given
+        ISO 8601 timestamp (and not earlier than expires_after), soonest first.
+        """
+        raise NotImplementedError
+
+    def snapshot(self):
+        """
+        (change_seq, records): every record, and the change log position
+        they are current as of.
+        """
+        raise NotImplementedError
+
+    def changes_since(self, change_seq, limit=1000):
+        """
+        (change_seq, records) for users whose record changed after the given
+        position, oldest change first, or None when the change log no longer
+        reaches back that far (take a new snapshot).
+        """
+        raise NotImplementedError
+
+    def prune_changes(self, before):
+        """
+        Drop change log entries older than the given Unix time.
+        """
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteSubscriptionStore(SubscriptionStore):
+    """
+    Embedded SQLite backend.
+
+    user_id is the primary key (so lookups and upserts are indexed) and
+    expires_date / original_transaction_id have secondary indexes. One
+    connection is opened per process and shared between threads behind a
+    lock; WAL mode lets other processes read while a batch is committing.
+
+    Triggers append every insert / update to subscription_changes. SQLite
+    has one writer at a time, so seq order is commit order and a reader
+    that remembers the last seq it saw never misses a change.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id TEXT PRIMARY KEY,
+            product_id TEXT,
+            original_transaction_id TEXT,
+            expires_date TEXT,
+            environment TEXT,
+            is_premium INTEGER NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_date
+            ON subscriptions (expires_date);
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_original_transaction_id
+            ON subscriptions (original_transaction_id);
+        CREATE TABLE IF NOT EXISTS subscription_receipts (
+            user_id TEXT PRIMARY KEY,
+            receipt BLOB NOT NULL,
+            updated_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS subscription_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            changed_at REAL NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS subscriptions_log_insert AFTER INSERT ON subscriptions
+        BEGIN
+            INSERT INTO subscription_changes (user_id, changed_at)
+            VALUES (NEW.user_id, (julianday('now') - 2440587.5) * 86400.0);
+        END;
+        CREATE TRIGGER IF NOT EXISTS subscriptions_log_update AFTER UPDATE ON subscriptions
+        BEGIN
+            INSERT INTO subscription_changes (user_id, changed_at)
+            VALUES (NEW.user_id, (julianday('now') - 2440587.5) * 86400.0);
+        END;
+    """
+
+    UPSERT = """
+        INSERT INTO subscriptions (
+            user_id, product_id, original_transaction_id, expires_date,
+            environment, is_premium, updated_at
+        )
+        VALUES (
+            :user_id, :product_id, :original_transaction_id, :expires_date,
+            :environment, :is_premium, :updated_at
+        )
+        ON CONFLICT (user_id) DO UPDATE SET
+            product_id = excluded.product_id,
+            original_transaction_id = excluded.original_transaction_id,
+            expires_date = excluded.expires_date,
+            environment = excluded.environment,
+            is_premium = excluded.is_premium,
+            updated_at = excluded.updated_at
+    """
+
+    UPSERT_RECEIPT = """
+        INSERT INTO subscription_receipts (user_id, receipt, updated_at)
+        VALUES (:user_id, :receipt, :updated_at)
+        ON CONFLICT (user_id) DO UPDATE SET
+            receipt = excluded.receipt,
+            updated_at = excluded.updated_at
+    """
+
+    COLUMNS = (
+        'user_id', 'product_id', 'original_transaction_id', 'expires_date',
+        'environment', 'is_premium', 'updated_at'
+    )
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is not None and self._connection_pid == os.getpid():
+            return self._connection
+
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        if self.path != ':memory:':
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(self.SCHEMA)
+        self._connection = connection
+        self._connection_pid = os.getpid()
+        return connection
+
+    def upsert_many(self, records):
+        if not records:
+            return
+
+        rows = [_normalize(record) for record in records]
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN')
+            try:
+                connection.executemany(self.UPSERT, rows)
+                connection.executemany(self.UPSERT_RECEIPT, [row for row in rows if row['receipt']])
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def get(self, user_id):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT * FROM subscriptions WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        return _row_to_record(row)
+
+    def get_by_original_transaction_id(self, original_transaction_id):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT * FROM subscriptions WHERE original_transaction_id = ? '
+                'ORDER BY updated_at DESC LIMIT 1',
+                (str(original_transaction_id),)
+            ).fetchone()
+        return _row_to_record(row)
+
+    def get_receipt(self, user_id):
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT receipt FROM subscription_receipts WHERE user_id = ?', (user_id,)
+            ).fetchone()
+        return None if row is None else bytes(row['receipt'])
+
+    def expiring_before(self, expires_date, limit=1000, expires_after=None):
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT * FROM subscriptions '
+                'WHERE is_premium = 1 AND expires_date IS NOT NULL AND expires_date < ? '
+                'AND expires_date >= ? ORDER BY expires_date LIMIT ?',
+                (expires_date, expires_after or '', limit)
+            ).fetchall()
+        return [_row_to_record(row) for row in rows]
+
+    def snapshot(self):
+        with self._lock:
+            connection = self._connect()
+            # One read transaction, so the position matches the rows
+            connection.execute('BEGIN')
+            try:
+                change_seq = connection.execute(
+                    'SELECT COALESCE(MAX(seq), 0) FROM subscription_changes'
+                ).fetchone()[0]
+                rows = connection.execute('SELECT * FROM subscriptions').fetchall()
+            finally:
+                connection.execute('COMMIT')
+        return change_seq, [_row_to_record(row) for row in rows]
+
+    def changes_since(self, change_seq, limit=1000):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN')
+            try:
+                oldest = connection.execute('SELECT MIN(seq) FROM subscription_changes').fetchone()[0]
+                if oldest is not None and oldest > change_seq + 1:
+                    return None
+                rows = connection.execute(
+                    'SELECT c.seq AS change_seq, s.* FROM subscription_changes c '
+                    'JOIN subscriptions s ON s.user_id = c.user_id '
+                    'WHERE c.seq > ? ORDER BY c.seq LIMIT ?',
+                    (change_seq, limit)
+                ).fetchall()
+            finally:
+                connection.execute('COMMIT')
+        if rows:
+            change_seq = rows[-1]['change_seq']
+        return change_seq, [_row_to_record(row) for row in rows]
+
+    def prune_changes(self, before):
+        with self._lock:
+            cursor = self._connect().execute(
+                # The newest entry stays, so readers can tell they are current
+                'DELETE FROM subscription_changes WHERE changed_at < ? '
+                'AND seq < (SELECT MAX(seq) FROM subscription_changes)',
+                (before,)
+            )
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._connection_pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+            self._connection_pid = None
+
+
+class WriteBehindSubscriptionStore(SubscriptionStore):
+    """
+    Queues writes and commits them from a background thread.
+
+    Writes for the same user that are still pending collapse into the newest
+    one, and every flush commits up to batch_size users in one transaction.
+    Reads check pending writes first, so callers always see their own
+    updates. A batch the backend rejects stays pending and is retried with
+    exponential backoff (picking up newer writes for the same users);
+    flush() raises SubscriptionWriteError while that is happening.
+    """
+
+    def __init__(self, backend, batch_size=200, flush_interval=0.05, max_pending=100000,
+                 retry_base_seconds=0.1, retry_max_seconds=30.0, close_timeout=5.0):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.close_timeout = close_timeout
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Queued writes not yet committed, and the failed attempts so far
+        self._state = threading.Condition()
+        self._unfinished = 0
+        self._failures = 0
+        self._last_error = None
+        self._thread = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread_pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name='subscription-write-behind',
+                    daemon=True
+                )
+                self._thread.start()
+                self._thread_pid = os.getpid()
+
+    def upsert_many(self, records):
+        self._ensure_started()
+        for record in records:
+            record = _normalize(record)
+            with self._pending_lock:
+                pending = self._pending.get(record['user_id'])
+                if record['receipt'] is None and pending is not None:
+                    record['receipt'] = pending['receipt']
+                self._pending[record['user_id']] = record
+            with self._state:
+                self._unfinished += 1
+            # Blocks (backpressure) only if the writer falls max_pending behind
+            self._queue.put(record['user_id'])
+
+    def get(self, user_id):
+        with self._pending_lock:
+            record = self._pending.get(user_id)
+        if record is not None:
+            return _row_to_record(record)
+        return self.backend.get(user_id)
+
+    def get_by_original_transaction_id(self, original_transaction_id):
+        original_transaction_id = str(original_transaction_id)
+        with self._pending_lock:
+            pending = [record for record in self._pending.values()
+                       if record['original_transaction_id'] == original_transaction_id]
+        if pending:
+            return _row_to_record(max(pending, key=lambda record: record['updated_at']))
+        return self.backend.get_by_original_transaction_id(original_transaction_id)
+
+    def get_receipt(self, user_id):
+        with self._pending_lock:
+            record = self._pending.get(user_id)
+        if record is not None and record['receipt'] is not None:
+            return record['receipt']
+        return self.backend.get_receipt(user_id)
+
+    def expiring_before(self, expires_date, limit=1000, expires_after=None):
+        self.flush()
+        return self.backend.expiring_before(expires_date, limit, expires_after)
+
+    def snapshot(self):
+        change_seq, records = self.backend.snapshot()
+        with self._pending_lock:
+            pending = [_row_to_record(record) for record in self._pending.values()]
+        # Pending writes are newer than anything committed for the same user
+        return change_seq, records + pending
+
+    def changes_since(self, change_seq, limit=1000):
+        changes = self.backend.changes_since(change_seq, limit)
+        if changes is None:
+            return None
+        change_seq, records = changes
+        with self._pending_lock:
+            records = [
+                _row_to_record(self._pending[record['user_id']])
+                if record['user_id'] in self._pending else record
+                for record in records
+            ]
+        return change_seq, records
+
+    def prune_changes(self, before):
+        return self.backend.prune_changes(before)
+
+    def flush(self, timeout=None):
+        """
+        Block until every queued write has been committed. Raises
+        SubscriptionWriteError if a commit fails while waiting (the writes
+        stay queued and are retried) or timeout seconds pass first.
+        """
+        if self._thread is None or self._thread_pid != os.getpid():
+            return
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._state:
+            failures = self._failures
+            while self._unfinished:
+                if self._failures != failures:
+                    raise SubscriptionWriteError(
+                        f"{self._unfinished} subscription write(s) not committed: {self._last_error}"
+                    ) from self._last_error
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise SubscriptionWriteError(
+                        f"{self._unfinished} subscription write(s) not committed after {timeout}s"
+                    )
+                self._state.wait(remaining)
+
+    def close(self):
+        try:
+            self.flush(self.close_timeout)
+        except SubscriptionWriteError as e:
+            logger.error("Closing with uncommitted subscription writes", extra={'error': str(e)})
+        self.backend.close()
+
+    def _run(self):
+        while True:
+            user_ids = [self._queue.get()]
+            try:
+                while len(user_ids) < self.batch_size:
+                    user_ids.append(self._queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+
+            attempt = 0
+            while not self._commit(user_ids):
+                delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** attempt)
+                attempt += 1
+                logger.warning("Retrying subscription batch write", extra={
+                    'attempt': attempt,
+                    'delay': round(delay, 3)
+                })
+                time.sleep(delay)
+
+            with self._state:
+                self._unfinished -= len(user_ids)
+                self._state.notify_all()
+
+    def _commit(self, user_ids):
+        """
+        Commit the newest pending record of each user. Returns False (the
+        records stay pending) if the backend rejected the batch.
+        """
+        with self._pending_lock:
+            batch = {}
+            for user_id in user_ids:
+                record = self._pending.get(user_id)
+                if record is not None:
+                    batch[user_id] = record
+
+        try:
+            self.backend.upsert_many(list(batch.values()))
+        except Exception as e:
+            logger.exception("Batch write failed", extra={'records': len(batch)})
+            with self._state:
+                self._failures += 1
+                self._last_error = e
+                self._state.notify_all()
+            return False
+
+        with self._pending_lock:
+            for user_id, record in batch.items():
+                if self._pending.get(user_id) is record:
+                    del self._pending[user_id]
+        return True
+
+
+def _normalize(record):
+    return {
+        'user_id': record['user_id'],
+        'product_id': record.get('product_id'),
+        'original_transaction_id': _optional_str(record.get('original_transaction_id')),
+        'expires_date': record.get('expires_date'),
+        'environment': record.get('environment'),
+        'is_premium': 1 if record.get('is_premium', True) else 0,
+        'updated_at': record.get('updated_at') or datetime.utcnow().isoformat(timespec='microseconds') + 'Z',
+        'receipt': _optional_bytes(record.get('receipt'))
+    }
+
+
+def _optional_str(value):
+    return None if value is None else str(value)
+
+
+def _optional_bytes(value):
+    if value is None:
+        return None
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+def _row_to_record(row):
+    if row is None:
+        return None
+    record = {column: row[column] for column in SQLiteSubscriptionStore.COLUMNS}
+    record['is_premium'] = bool(record['is_premium'])
+    return record
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Sync source files on disk into Braindumpster.xcodeproj in one pass.
+
+Walks the source directories (Views/, Utilities/, Models/, Resources/ by
+default), compares them with the project's file references and build
+phases, and in a single load-and-save:
+
+- adds a reference (and group, and build file) for every new file
+- removes references and build files for files that no longer exist, and
+  the groups of directories that are gone
+- puts existing references that are missing from their build phase into it
+- drops build files whose file reference is gone
+
+Files outside the synced directories are left alone. Object IDs are derived
+from file paths, so the same tree always produces the same project file.
+
+    python sync_xcode_project.py              # update the project
+    python sync_xcode_project.py --dry-run    # print the diff, exit 1 if out of sync
+    python sync_xcode_project.py --dirs Views,Models
+"""
+import argparse
+import difflib
+import os
+import sys
+import time
+
+from pbxproj import FILE_TYPES, PBXProject, default_phase
+
+SOURCE_DIRECTORIES = ('Views', 'Utilities', 'Models', 'Resources')
+
+_SKIPPED_DIRECTORIES = ('__pycache__', 'build', 'DerivedData')
+
+
+def scan_sources(root, directories):
+    """
+    Project-relative paths of the files Xcode would track under
+    directories: known file types only, with bundles such as .xcassets
+    counted as one file.
+    """
+    found = set()
+    for directory in directories:
+        stack = [directory]
+        while stack:
+            relative = stack.pop()
+            try:
+                entries = list(os.scandir(os.path.join(root, relative)))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                path = f'{relative}/{entry.name}'
+                extension = os.path.splitext(entry.name)[1].lower()
+                if entry.is_dir():
+                    if extension in FILE_TYPES:
+                        found.add(path)
+                    elif entry.name not in _SKIPPED_DIRECTORIES:
+                        stack.append(path)
+                elif extension in FILE_TYPES:
+                    found.add(path)
+    return found
+
+
+def sync_project(project, root, directories=SOURCE_DIRECTORIES, target=None):
+    """
+    Bring the project in line with the files under directories. Returns
+    the changes as a list of (action, path) tuples.
+    """
+    prefixes = tuple(directory.strip('/') + '/' for directory in directories)
+    on_disk = scan_sources(root, directories)
+    in_project = {path: file_ref_id for path, file_ref_id in project.file_paths().items()
+                  if path.startswith(prefixes)}
+    changes = []
+
+    for path in sorted(in_project.keys() - on_disk):
+        project.remove_file(path)
+        changes.append(('remove', path))
+
+    # Empty groups of directories that are gone, deepest first
+    stale_groups = [
+        path for path in map(project.group_path, project.ids_of('PBXGroup'))
+        if path and path.startswith(prefixes) and not os.path.isdir(os.path.join(root, path))
+    ]
+    for path in sorted(stale_groups, key=lambda p: -p.count('/')):
+        if not project.children(project.group(path)):
+            project.remove_group(path)
+            changes.append(('remove group', path))
+
+    phases = {}
+    for path in sorted(on_disk):
+        phase = default_phase(path)
+        file_ref_id = in_project.get(path)
+        if file_ref_id is not None:
+            if not phase:
+                continue
+            if phase not in phases:
+                phases[phase] = project.phase(phase, target)
+            if phases[phase] is None or project.in_phase(file_ref_id, phases[phase]):
+                continue
+            changes.append(('build', path))
+        else:
+            changes.append(('add', path))
+        project.add_file(path, phase=phase, target=target)
+
+    for phase_id in project.ids_of('PBXSourcesBuildPhase') + project.ids_of('PBXResourcesBuildPhase'):
+        for build_file_id in project.phase_files(phase_id):
+            build_file = project.get(build_file_id)
+            file_ref_id = build_file.get('fileRef') if build_file is not None else None
+            if file_ref_id is None or file_ref_id in project.objects:
+                continue
+            changes.append(('unlink', project.comments.get(build_file_id, build_file_id)))
+            project.remove_build_file(build_file_id)
+    return changes
+
+
+_ACTION_LABELS = {
+    'add': '+ add      ',
+    'remove': '- remove   ',
+    'build': '+ build    ',
+    'unlink': '- dangling ',
+    'remove group': '- group    ',
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sync source files into the Xcode project")
+    parser.add_argument('--project', default='Braindumpster.xcodeproj')
+    parser.add_argument('--root', default=None,
+                        help="directory the project's paths are relative to (default: the project's parent)")
+    parser.add_argument('--dirs', default=','.join(SOURCE_DIRECTORIES),
+                        help="comma-separated source directories to sync")
+    parser.add_argument('--target', default=None, help="native target name (default: the only one)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the project diff instead of saving; exit 1 if out of sync")
+    args = parser.parse_args()
+
+    root = args.root or os.path.dirname(os.path.abspath(args.project.rstrip('/')))
+    directories = [directory for directory in args.dirs.split(',') if directory]
+
+    started = time.perf_counter()
+    project = PBXProject.load(args.project)
+    before = project.dumps() if args.dry_run else None
+    changes = sync_project(project, root, directories, args.target)
+
+    for action, path in changes:
+        print(f"{_ACTION_LABELS[action]}{path}")
+
+    if not changes:
+        print(f"✅ Xcode project is in sync ({time.perf_counter() - started:.3f}s)")
+        return 0
+
+    if args.dry_run:
+        after = project.dumps()
+        sys.stdout.writelines(difflib.unified_diff(
+            before.splitlines(True), after.splitlines(True),
+            fromfile=project.path, tofile=project.path
+        ))
+        print(f"⚠️  {len(changes)} change(s) pending ({time.perf_counter() - started:.3f}s)")
+        return 1
+
+    project.save()
+    print(f"✅ Applied {len(changes)} change(s) to {project.path} ({time.perf_counter() - started:.3f}s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
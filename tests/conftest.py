@@ -0,0 +1,8 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# receipt_validation_endpoint opens its SQLite files on import
+os.environ.setdefault('SUBSCRIPTION_DB_PATH', ':memory:')
+os.environ.setdefault('WEBHOOK_QUEUE_PATH', ':memory:')
@@ -0,0 +1,141 @@
+import base64
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.x509.oid import NameOID
+
+from apple_notifications import AppleNotificationVerifier, InvalidNotificationError
+
+BUNDLE_ID = 'com.braindumpster.app'
+LEAF_MARKER = x509.ObjectIdentifier('1.2.840.113635.100.6.11.1')
+INTERMEDIATE_MARKER = x509.ObjectIdentifier('1.2.840.113635.100.6.2.1')
+NOW = datetime.now(timezone.utc)
+
+
+def certificate(name, key, issuer_name=None, issuer_key=None, ca=False, marker=None,
+                not_before=NOW - timedelta(days=1), not_after=NOW + timedelta(days=365)):
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, name)])
+    issuer = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer_name)]) if issuer_name else subject
+    builder = (x509.CertificateBuilder()
+               .subject_name(subject)
+               .issuer_name(issuer)
+               .public_key(key.public_key())
+               .serial_number(x509.random_serial_number())
+               .not_valid_before(not_before)
+               .not_valid_after(not_after)
+               .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True))
+    if marker is not None:
+        builder = builder.add_extension(x509.UnrecognizedExtension(marker, b'\x05\x00'), critical=False)
+    return builder.sign(issuer_key or key, hashes.SHA384() if ca else hashes.SHA256())
+
+
+class Chain:
+    """A root -> intermediate -> leaf chain shaped like Apple's."""
+
+    def __init__(self, leaf_marker=LEAF_MARKER, leaf_not_after=NOW + timedelta(days=365)):
+        self.root_key = ec.generate_private_key(ec.SECP384R1())
+        self.intermediate_key = ec.generate_private_key(ec.SECP384R1())
+        self.leaf_key = ec.generate_private_key(ec.SECP256R1())
+        self.root = certificate('Test Root CA', self.root_key, ca=True)
+        self.intermediate = certificate('Test WWDR CA', self.intermediate_key, 'Test Root CA', self.root_key,
+                                        ca=True, marker=INTERMEDIATE_MARKER)
+        self.leaf = certificate('Test App Store signer', self.leaf_key, 'Test WWDR CA', self.intermediate_key,
+                                marker=leaf_marker, not_after=leaf_not_after)
+
+    @property
+    def root_fingerprint(self):
+        return self.root.fingerprint(hashes.SHA256()).hex()
+
+    def x5c(self):
+        return [base64.b64encode(cert.public_bytes(serialization.Encoding.DER)).decode()
+                for cert in (self.leaf, self.intermediate, self.root)]
+
+    def sign(self, payload):
+        encode = lambda value: base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b'=').decode()
+        signing_input = f"{encode({'alg': 'ES256', 'x5c': self.x5c()})}.{encode(payload)}"
+        r, s = decode_dss_signature(self.leaf_key.sign(signing_input.encode(), ec.ECDSA(hashes.SHA256())))
+        signature = base64.urlsafe_b64encode(r.to_bytes(32, 'big') + s.to_bytes(32, 'big')).rstrip(b'=').decode()
+        return f'{signing_input}.{signature}'
+
+
+@pytest.fixture(scope='module')
+def chain():
+    return Chain()
+
+
+def verifier_for(chain):
+    return AppleNotificationVerifier(BUNDLE_ID, trusted_root_fingerprints=(chain.root_fingerprint,))
+
+
+def notification(chain):
+    transaction = chain.sign({'bundleId': BUNDLE_ID, 'originalTransactionId': '1000', 'expiresDate': 1893456000000})
+    return chain.sign({
+        'notificationType': 'DID_RENEW',
+        'notificationUUID': 'uuid-1',
+        'data': {'bundleId': BUNDLE_ID, 'environment': 'Sandbox', 'signedTransactionInfo': transaction}
+    })
+
+
+def test_valid_notification_is_decoded(chain):
+    payload = verifier_for(chain).decode_notification(notification(chain))
+
+    assert payload['notificationType'] == 'DID_RENEW'
+    assert payload['data']['transactionInfo']['originalTransactionId'] == '1000'
+
+
+def test_cached_chain_still_checks_each_signature(chain):
+    verifier = verifier_for(chain)
+    verifier.verify_jws(chain.sign({'n': 1}))
+
+    header, _, signature = chain.sign({'n': 2}).split('.')
+    with pytest.raises(InvalidNotificationError, match='signature'):
+        verifier.verify_jws(f"{header}.{chain.sign({'n': 3}).split('.')[1]}.{signature}")
+
+
+def test_tampered_signature_is_rejected(chain):
+    header, payload, signature = chain.sign({'notificationType': 'TEST'}).split('.')
+    raw = bytearray(base64.urlsafe_b64decode(signature + '=='))
+    raw[-1] ^= 1
+    tampered = base64.urlsafe_b64encode(bytes(raw)).rstrip(b'=').decode()
+
+    with pytest.raises(InvalidNotificationError, match='signature'):
+        verifier_for(chain).verify_jws(f'{header}.{payload}.{tampered}')
+
+
+def test_chain_to_another_root_is_rejected(chain):
+    with pytest.raises(InvalidNotificationError, match='Untrusted root'):
+        AppleNotificationVerifier(BUNDLE_ID).verify_jws(chain.sign({'notificationType': 'TEST'}))
+
+
+def test_intermediate_signed_by_another_root_is_rejected(chain):
+    impostor = Chain()
+    impostor.root = chain.root      # Trusted root, but it didn't sign this intermediate
+
+    with pytest.raises(InvalidNotificationError, match='not signed by root'):
+        verifier_for(chain).verify_jws(impostor.sign({'notificationType': 'TEST'}))
+
+
+def test_expired_certificate_is_rejected():
+    expired = Chain(leaf_not_after=NOW - timedelta(hours=1))
+
+    with pytest.raises(InvalidNotificationError, match='expired'):
+        verifier_for(expired).verify_jws(expired.sign({'notificationType': 'TEST'}))
+
+
+def test_leaf_without_the_apple_marker_is_rejected():
+    unmarked = Chain(leaf_marker=None)
+
+    with pytest.raises(InvalidNotificationError, match='App Store signing'):
+        verifier_for(unmarked).verify_jws(unmarked.sign({'notificationType': 'TEST'}))
+
+
+def test_notification_for_another_app_is_rejected(chain):
+    signed = chain.sign({'notificationType': 'DID_RENEW', 'data': {'bundleId': 'com.example.other'}})
+
+    with pytest.raises(InvalidNotificationError, match='bundle ID'):
+        verifier_for(chain).decode_notification(signed)
@@ -0,0 +1,139 @@
+import base64
+
+import pytest
+
+import receipt_validation_endpoint as rv
+from apple_receipt import InvalidReceiptError, decode_receipt
+from benchmarks.fake_apple_server import encode_receipt
+
+BUNDLE_ID = 'com.braindumpster.app'
+SIGNED_DATA_OID = bytes.fromhex('2a864886f70d010702')
+DATA_OID = bytes.fromhex('2a864886f70d010701')
+
+
+def der(tag, content):
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    size = (length.bit_length() + 7) // 8
+    return bytes([tag, 0x80 | size]) + length.to_bytes(size, 'big') + content
+
+
+def ber(tag, content):
+    """Constructed element with an indefinite length, as in current receipts."""
+    return bytes([tag, 0x80]) + content + b'\x00\x00'
+
+
+def integer(number):
+    return der(0x02, number.to_bytes((number.bit_length() + 8) // 8, 'big', signed=True))
+
+
+def attribute(attribute_type, value, version=1):
+    return der(0x30, integer(attribute_type) + integer(version) + der(0x04, value))
+
+
+def utf8(text):
+    return der(0x0c, text.encode())
+
+
+def in_app(original_transaction_id, *extra):
+    return der(0x31, b''.join(extra) + attribute(1705, utf8(original_transaction_id)))
+
+
+def payload(*attributes):
+    return der(0x31, b''.join(attributes))
+
+
+def pkcs7(content, indefinite=False):
+    """ContentInfo(signedData) around the payload, with or without BER indefinite lengths."""
+    wrap = ber if indefinite else der
+    if indefinite:
+        # Current receipts split the payload into a constructed OCTET STRING
+        octets = ber(0x24, der(0x04, content[:10]) + der(0x04, content[10:]))
+    else:
+        octets = der(0x04, content)
+    encapsulated = wrap(0x30, der(0x06, DATA_OID) + wrap(0xa0, octets))
+    signed_data = wrap(0x30, integer(1) + der(0x31, b'') + encapsulated
+                       + der(0xa0, b'cert') + der(0x31, b''))
+    return base64.b64encode(wrap(0x30, der(0x06, SIGNED_DATA_OID) + wrap(0xa0, signed_data)))
+
+
+def test_der_receipt():
+    info = decode_receipt(encode_receipt(BUNDLE_ID, '1000000001'))
+
+    assert info.bundle_id == BUNDLE_ID
+    assert info.original_transaction_id == '1000000001'
+
+
+def test_indefinite_length_ber_receipt():
+    receipt = pkcs7(payload(attribute(2, utf8(BUNDLE_ID)), attribute(17, in_app('1000000002'))),
+                    indefinite=True)
+
+    assert decode_receipt(receipt) == (BUNDLE_ID, '1000000002')
+    assert decode_receipt(receipt.decode()) == (BUNDLE_ID, '1000000002')
+
+
+def test_line_wrapped_base64():
+    receipt = encode_receipt(BUNDLE_ID, '1000000003', padding=b'x' * 200)
+    wrapped = '\n'.join(receipt[i:i + 76] for i in range(0, len(receipt), 76))
+
+    assert decode_receipt(wrapped).original_transaction_id == '1000000003'
+
+
+def test_unknown_and_extra_attributes_are_skipped():
+    receipt = pkcs7(payload(
+        attribute(0, utf8('opaque')),
+        attribute(-1, b'\xff\xff'),
+        attribute(4, b'\x00' * 300),                          # Long-form length
+        attribute(19, utf8('1.0'), version=2),
+        attribute(2, utf8(BUNDLE_ID)),
+        attribute(17, in_app('1000000004', attribute(1701, integer(1)), attribute(9999, b''))),
+        attribute(17, in_app('1000000005')),
+        attribute(123456, b'future attribute'),
+    ))
+
+    assert decode_receipt(receipt) == (BUNDLE_ID, '1000000004')
+
+
+def test_receipt_without_purchases():
+    receipt = pkcs7(payload(attribute(2, utf8(BUNDLE_ID))))
+
+    assert decode_receipt(receipt) == (BUNDLE_ID, None)
+
+
+@pytest.mark.parametrize('receipt', [
+    '', 'not base64!', base64.b64encode(b'plain text'),
+    base64.b64encode(b'\x30\x80\x06\x09' + SIGNED_DATA_OID),             # No end-of-contents
+    pkcs7(payload(attribute(17, in_app('1')))),                          # No bundle ID
+])
+def test_malformed_receipts_raise(receipt):
+    with pytest.raises(InvalidReceiptError):
+        decode_receipt(receipt)
+
+
+@pytest.mark.parametrize('cut', [1, 2, 10, 40, 80])
+def test_truncated_receipts_raise(cut):
+    data = base64.b64decode(encode_receipt(BUNDLE_ID, '1000000006'))
+
+    with pytest.raises(InvalidReceiptError):
+        decode_receipt(base64.b64encode(data[:-cut]))
+
+
+def test_deeply_nested_indefinite_lengths_are_bounded():
+    nested = b'\x30\x80' * 100 + b'\x00\x00' * 100
+
+    with pytest.raises(InvalidReceiptError):
+        decode_receipt(base64.b64encode(nested))
+
+
+def test_prevalidation_rejects_another_apps_receipt(monkeypatch):
+    monkeypatch.setattr(rv, 'RECEIPT_PREVALIDATION_ENABLED', True)
+
+    original_transaction_id, rejection = rv.prevalidate_receipt(
+        encode_receipt('com.example.other', '1000000007').encode())
+    assert original_transaction_id is None
+    assert rejection['message'] == 'Bundle ID mismatch'
+
+    original_transaction_id, rejection = rv.prevalidate_receipt(
+        encode_receipt(BUNDLE_ID, '1000000007').encode())
+    assert (original_transaction_id, rejection) == ('1000000007', None)
@@ -0,0 +1,51 @@
+import sys
+
+import pytest
+
+import deploy_firestore_rules
+from benchmarks.fake_rules_api import FakeRulesServer, FakeRulesState
+
+
+@pytest.fixture
+def server():
+    with FakeRulesServer(FakeRulesState(latency_ms=0)) as server:
+        yield server
+
+
+def deploy(monkeypatch, server, *args):
+    monkeypatch.setattr(sys, 'argv', ['deploy_firestore_rules.py', '--api-url', server.api_url,
+                                      '--access-token', 'local', '--projects', 'staging,production',
+                                      *args])
+    assert deploy_firestore_rules.main()
+    return dict(server.state.stats)
+
+
+def created(stats):
+    return {key: stats.get(key, 0) for key in ('POST rulesets', 'POST releases', 'PATCH releases')}
+
+
+@pytest.mark.parametrize('cache', ['', 'rules-cache.json'])
+def test_second_deploy_of_unchanged_rules_creates_nothing(monkeypatch, server, tmp_path, capsys, cache):
+    cache = str(tmp_path / cache) if cache else ''
+
+    first = deploy(monkeypatch, server, '--cache', cache)
+    assert created(first) == {'POST rulesets': 2, 'POST releases': 2, 'PATCH releases': 0}
+
+    second = deploy(monkeypatch, server, '--cache', cache)
+    assert created(second) == created(first)
+    assert second['GET releases'] == first['GET releases'] + 2
+    # Without a cache file the second run reads each current ruleset once
+    assert second.get('GET rulesets', 0) == (2 if not cache else 0)
+    assert capsys.readouterr().out.count('rules unchanged') == 2
+
+
+def test_changed_rules_patch_the_release(monkeypatch, server, tmp_path):
+    rules = tmp_path / 'firestore.rules'
+    rules.write_text("rules_version = '2';\n")
+    deploy(monkeypatch, server, '--cache', '', '--rules', str(rules))
+
+    rules.write_text("rules_version = '2';\n// changed\n")
+    stats = deploy(monkeypatch, server, '--cache', '', '--rules', str(rules))
+
+    assert created(stats) == {'POST rulesets': 4, 'POST releases': 2, 'PATCH releases': 2}
+    assert len(server.state.releases) == 2
@@ -0,0 +1,71 @@
+import time
+
+from entitlement_index import EntitlementIndex
+from subscription_store import SQLiteSubscriptionStore
+
+
+class CountingStore(SQLiteSubscriptionStore):
+    def __init__(self):
+        super().__init__(':memory:')
+        self.change_reads = 0
+
+    def changes_since(self, change_seq, limit=1000):
+        self.change_reads += 1
+        return super().changes_since(change_seq, limit)
+
+
+def record(user_id, is_premium=True, updated_at='2026-01-01T00:00:00Z'):
+    return {
+        'user_id': user_id,
+        'product_id': 'brain_dumpster_monthly_premium',
+        'expires_date': '2099-01-01T00:00:00Z',
+        'environment': 'sandbox',
+        'is_premium': is_premium,
+        'updated_at': updated_at
+    }
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_reads_stay_in_memory_while_the_poller_follows_changes():
+    store = CountingStore()
+    store.upsert(record('u1'))
+    index = EntitlementIndex(store, refresh_interval=0.02)
+    index.start()
+    try:
+        assert index.get('u1')['isPremium'] is True
+
+        # Written by "another worker": only the poller sees it
+        store.upsert(record('u2'))
+        wait_for(lambda: 'u2' in index)
+
+        reads = store.change_reads
+        for _ in range(1000):
+            index.get('u1')
+        assert store.change_reads - reads <= 5
+
+        store.upsert(record('u1', is_premium=False, updated_at='2026-02-01T00:00:00Z'))
+        wait_for(lambda: index.revoked('u1'))
+        assert index.get('u1')['isPremium'] is False
+    finally:
+        index.stop(1)
+
+
+def test_updated_at_is_compared_as_a_time():
+    # isoformat() drops zero microseconds, so as strings the older time sorts last
+    older, newer = '2026-01-01T00:00:00Z', '2026-01-01T00:00:00.500000Z'
+    store = SQLiteSubscriptionStore(':memory:')
+    store.upsert(record('u1', is_premium=False, updated_at=newer))
+    index = EntitlementIndex(store)
+    index.refresh()
+
+    index.update(record('u1', is_premium=True, updated_at=older))
+    assert index.revoked('u1')
+
+    index.update(record('u1', is_premium=True, updated_at='2026-01-01T00:00:01Z'))
+    assert index.get('u1')['isPremium'] is True
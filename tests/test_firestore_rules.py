@@ -0,0 +1,170 @@
+import os
+
+import pytest
+
+from firestore_rules import FirestoreRulesError, OPERATIONS, compile_rules, load_rules
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'firestore.rules')
+
+OWNER = 'u1'
+OTHER = 'u2'
+
+OWN_DOCUMENTS = [
+    f'users/{OWNER}',
+    f'users/{OWNER}/recordings/r1',
+    f'users/{OWNER}/tasks/t1',
+    f'users/{OWNER}/tasks/t1/notes/n1',
+    f'users/{OWNER}/recordings/r1/segments/s1/words/w1',
+]
+
+OWN_COLLECTIONS = [
+    f'users/{OWNER}/recordings',
+    f'users/{OWNER}/tasks',
+    f'users/{OWNER}/tasks/t1/notes',
+]
+
+
+@pytest.fixture(scope='module')
+def engine():
+    return load_rules(RULES_PATH)
+
+
+@pytest.mark.parametrize('path', OWN_DOCUMENTS)
+@pytest.mark.parametrize('operation', ['get', 'create', 'update', 'delete'])
+def test_owner_can_read_and_write_own_documents(engine, path, operation):
+    assert engine.check(OWNER, path, operation)
+
+
+@pytest.mark.parametrize('path', OWN_DOCUMENTS)
+@pytest.mark.parametrize('operation', ['get', 'create', 'update', 'delete'])
+def test_other_user_is_denied(engine, path, operation):
+    assert not engine.check(OTHER, path, operation)
+
+
+@pytest.mark.parametrize('path', OWN_DOCUMENTS + OWN_COLLECTIONS)
+@pytest.mark.parametrize('operation', OPERATIONS)
+def test_unauthenticated_request_is_denied(engine, path, operation):
+    assert not engine.check(None, path, operation)
+
+
+def test_auth_without_uid_is_denied(engine):
+    assert not engine.check(None, f'users/{OWNER}', 'get', auth={'token': {}})
+
+
+@pytest.mark.parametrize('path', OWN_COLLECTIONS)
+def test_owner_can_list_own_collections(engine, path):
+    assert engine.check(OWNER, path, 'list')
+    assert not engine.check(OTHER, path, 'list')
+
+
+def test_listing_all_users_is_denied(engine):
+    assert not engine.check(OWNER, 'users', 'list')
+    assert not engine.check(None, 'users', 'list')
+
+
+def test_list_under_nested_documents_follows_the_owner(engine):
+    assert engine.check(OWNER, f'users/{OWNER}/recordings/r1/segments', 'list')
+    assert not engine.check(OTHER, f'users/{OWNER}/recordings/r1/segments', 'list')
+
+
+@pytest.mark.parametrize('path', ['recordings/r1', 'admin/config', 'public/feed/items/i1'])
+@pytest.mark.parametrize('operation', OPERATIONS)
+def test_unmatched_collections_are_denied(engine, path, operation):
+    assert not engine.check(OWNER, path, operation)
+
+
+def test_user_id_is_compared_exactly(engine):
+    assert not engine.check(OWNER, f'users/{OWNER}x', 'get')
+    assert not engine.check(f'{OWNER}x', f'users/{OWNER}/recordings/r1', 'get')
+
+
+def test_full_database_paths(engine):
+    path = f'/databases/(default)/documents/users/{OWNER}/recordings/r1'
+    assert engine.check(OWNER, path, 'get')
+    assert not engine.check(OTHER, path, 'get')
+
+
+def test_check_batch_matches_check(engine):
+    requests = [(uid, path, operation)
+                for uid in (OWNER, OTHER, None)
+                for path in OWN_DOCUMENTS + OWN_COLLECTIONS + ['users']
+                for operation in OPERATIONS]
+    assert engine.check_batch(requests) == [engine.check(*request) for request in requests]
+
+
+def test_unknown_operation_raises(engine):
+    with pytest.raises(ValueError):
+        engine.check(OWNER, f'users/{OWNER}', 'read')
+
+
+def test_document_reads_are_rejected_at_compile_time():
+    rules = """
+    rules_version = '2';
+    service cloud.firestore {
+      match /databases/{database}/documents {
+        match /posts/{postId} {
+          allow read: if exists(/databases/$(database)/documents/admins/$(request.auth.uid));
+        }
+      }
+    }
+    """
+    with pytest.raises(FirestoreRulesError):
+        compile_rules(rules)
+
+
+TASK_RULES = """
+rules_version = '2';
+service cloud.firestore {
+  match /databases/{database}/documents {
+    match /users/{userId}/tasks/{taskId} {
+      function isOwner() {
+        return request.auth != null && request.auth.uid == userId;
+      }
+      allow create: if isOwner()
+        && request.resource.data.title is string
+        && request.resource.data.keys().hasOnly(['title', 'done']);
+      allow update: if isOwner() && request.resource.data.title == resource.data.title;
+    }
+  }
+}
+"""
+
+
+def test_request_resource_is_the_incoming_document():
+    engine = compile_rules(TASK_RULES)
+    path = f'users/{OWNER}/tasks/t1'
+
+    assert engine.check(OWNER, path, 'create', request_resource={'title': 'Call mum'})
+    assert not engine.check(OWNER, path, 'create', request_resource={'title': 42})
+    assert not engine.check(OWNER, path, 'create', request_resource={'title': 'Call mum', 'owner': OTHER})
+    assert not engine.check(OWNER, path, 'create')
+    assert not engine.check(OTHER, path, 'create', request_resource={'title': 'Call mum'})
+
+
+def test_request_resource_and_resource_together():
+    engine = compile_rules(TASK_RULES)
+    path = f'users/{OWNER}/tasks/t1'
+
+    assert engine.check(OWNER, path, 'update', resource={'title': 'A', 'done': False},
+                        request_resource={'title': 'A', 'done': True})
+    assert not engine.check(OWNER, path, 'update', resource={'title': 'A'}, request_resource={'title': 'B'})
+
+
+@pytest.mark.parametrize('condition', [
+    'request.time < resource.data.deadline',
+    'request.time.toMillis() > 0',
+    'request.time < timestamp.date(2030, 1, 1)',
+])
+def test_request_time_is_rejected_at_compile_time(condition):
+    rules = f"""
+    rules_version = '2';
+    service cloud.firestore {{
+      match /databases/{{database}}/documents {{
+        match /posts/{{postId}} {{
+          allow read: if {condition};
+        }}
+      }}
+    }}
+    """
+    with pytest.raises(FirestoreRulesError, match='request.time|Unsupported method'):
+        compile_rules(rules)
@@ -0,0 +1,57 @@
+import importlib.util
+import sys
+import uuid
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+import json_codec
+import receipt_validation_endpoint as rv
+
+VALUES = {
+    'at': datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+    'price': Decimal('9.99'),
+    'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+    'name': 'Braindumpster Pro',
+}
+EXPECTED = {
+    'at': 'Fri, 02 Jan 2026 03:04:05 GMT',
+    'price': '9.99',
+    'id': '12345678-1234-5678-1234-567812345678',
+    'name': 'Braindumpster Pro',
+}
+
+
+@pytest.fixture
+def stdlib_codec(monkeypatch):
+    """A separate copy of json_codec loaded as if orjson weren't installed."""
+    monkeypatch.setitem(sys.modules, 'orjson', None)
+    spec = importlib.util.spec_from_file_location('json_codec_stdlib', json_codec.__file__)
+    codec = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(codec)
+    assert codec.BACKEND == 'json'
+    return codec
+
+
+def test_stdlib_and_installed_codec_agree(stdlib_codec):
+    default = rv.app.json.default
+
+    for codec in (json_codec, stdlib_codec):
+        assert codec.loads(codec.dumps(VALUES, default=default)) == EXPECTED
+        assert codec.dumps({'a': [1, None]}) == b'{"a":[1,null]}'
+
+
+def test_unknown_types_still_raise_without_a_default(stdlib_codec):
+    with pytest.raises(TypeError):
+        json_codec.dumps({'price': Decimal('1')})
+    with pytest.raises(TypeError):
+        stdlib_codec.dumps({'price': Decimal('1')})
+
+
+def test_flask_provider_uses_the_default():
+    assert json_codec.loads(rv.app.json.dumps(VALUES)) == EXPECTED
+
+    with rv.app.app_context():
+        response = rv.app.json.response(VALUES)
+    assert response.get_json() == EXPECTED
@@ -0,0 +1,88 @@
+import json
+import os
+
+import pytest
+
+from metrics import AGGREGATE_SNAPSHOT, MetricsRegistry, reset_metrics_dir, retire_snapshot
+
+
+def registry(metrics_dir=None):
+    metrics = MetricsRegistry(metrics_dir, flush_interval=3600)
+    metrics.counter('requests_total', 'Requests')
+    metrics.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    return metrics
+
+
+def write_snapshot(metrics_dir, pid, requests, latencies=()):
+    """A snapshot as another worker process would have flushed it."""
+    other = registry()
+    other.inc('requests_total', {'code': 200}, requests)
+    for latency in latencies:
+        other.observe('latency_seconds', latency)
+    with open(os.path.join(metrics_dir, f'{pid}.json'), 'w') as f:
+        json.dump(other._snapshot(), f)
+
+
+def sample(text, series):
+    for line in text.splitlines():
+        if line.startswith(series + ' '):
+            return float(line.split()[-1])
+    return None
+
+
+@pytest.fixture
+def metrics_dir(tmp_path):
+    return str(tmp_path)
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = registry()
+    for latency in (0.05, 0.5, 0.5, 5.0):
+        metrics.observe('latency_seconds', latency)
+
+    text = metrics.render_prometheus()
+    assert sample(text, 'latency_seconds_bucket{le="0.1"}') == 1
+    assert sample(text, 'latency_seconds_bucket{le="1.0"}') == 3
+    assert sample(text, 'latency_seconds_bucket{le="+Inf"}') == 4
+    assert sample(text, 'latency_seconds_sum') == pytest.approx(6.05)
+
+
+def test_scrape_sums_every_process(metrics_dir):
+    metrics = registry(metrics_dir)
+    metrics.inc('requests_total', {'code': 200}, 1)
+    write_snapshot(metrics_dir, 101, 2, [0.05])
+    write_snapshot(metrics_dir, 102, 3, [0.5])
+
+    text = metrics.render_prometheus()
+    assert sample(text, 'requests_total{code="200"}') == 6
+    assert sample(text, 'latency_seconds_count') == 2
+
+
+def test_own_snapshot_is_not_counted_twice(metrics_dir):
+    metrics = registry(metrics_dir)
+    metrics.inc('requests_total', {'code': 200}, 4)
+    metrics.flush()
+
+    assert sample(metrics.render_prometheus(), 'requests_total{code="200"}') == 4
+
+
+def test_retired_snapshots_fold_into_the_aggregate(metrics_dir):
+    write_snapshot(metrics_dir, 101, 2, [0.05])
+    write_snapshot(metrics_dir, 102, 3, [0.5])
+    write_snapshot(metrics_dir, 103, 5)
+    before = registry(metrics_dir).render_prometheus()
+
+    retire_snapshot(metrics_dir, 101)
+    retire_snapshot(metrics_dir, 102)
+    retire_snapshot(metrics_dir, 999)       # Never flushed
+
+    assert sorted(os.listdir(metrics_dir)) == ['103.json', AGGREGATE_SNAPSHOT, AGGREGATE_SNAPSHOT + '.lock']
+    assert registry(metrics_dir).render_prometheus() == before
+
+
+def test_reset_removes_the_aggregate(metrics_dir):
+    write_snapshot(metrics_dir, 101, 2)
+    retire_snapshot(metrics_dir, 101)
+
+    reset_metrics_dir(metrics_dir)
+    assert os.listdir(metrics_dir) == []
@@ -0,0 +1,117 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+import sync_xcode_project
+from pbxproj import PBXProject, PBXProjectError
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'Braindumpster.xcodeproj')
+FIXTURE_FILE = os.path.join(FIXTURE, 'project.pbxproj')
+
+
+@pytest.fixture
+def original():
+    with open(FIXTURE_FILE, encoding='utf-8') as f:
+        return f.read()
+
+
+@pytest.fixture
+def project():
+    return PBXProject.load(FIXTURE)
+
+
+def test_unmodified_project_round_trips_byte_for_byte(project, original):
+    assert project.dumps() == original
+
+
+def test_save_writes_the_same_bytes(project, tmp_path):
+    path = str(tmp_path / 'project.pbxproj')
+    project.save(path)
+
+    with open(path, 'rb') as saved, open(FIXTURE_FILE, 'rb') as fixture:
+        assert saved.read() == fixture.read()
+
+
+@pytest.mark.parametrize('path', ['Utilities/ShareSheet.swift', 'Views/MeetingRecorder/Waveform.swift'])
+def test_add_then_remove_restores_the_original(project, original, path):
+    file_ref_id = project.add_file(path)
+    assert project.dumps() != original
+    assert project.file_ref(path) == file_ref_id
+    assert project.build_files(file_ref_id)
+
+    assert project.remove_file(path)
+    assert project.dumps() == original
+    assert project.file_ref(path) is None
+
+
+def test_added_file_is_in_its_group_and_the_sources_phase(project):
+    file_ref_id = project.add_file('Utilities/ShareSheet.swift')
+
+    assert file_ref_id in project.children(project.group('Utilities'))
+    [build_file_id] = project.build_files(file_ref_id)
+    assert project.phase_of(build_file_id) == project.phase('PBXSourcesBuildPhase')
+    assert project.add_file('Utilities/ShareSheet.swift') == file_ref_id      # Reused, not duplicated
+    assert project.build_files(file_ref_id) == [build_file_id]
+
+
+def test_new_ids_are_stable_across_loads():
+    first, second = PBXProject.load(FIXTURE), PBXProject.load(FIXTURE)
+
+    assert first.new_id('PBXFileReference', 'Models/Task.swift') == second.new_id('PBXFileReference', 'Models/Task.swift')
+    assert first.new_id('PBXFileReference', 'Models/Task.swift') != first.new_id('PBXFileReference', 'Models/Note.swift')
+
+    first.add_file('Models/Task.swift')
+    second.add_file('Models/Task.swift')
+    assert first.dumps() == second.dumps()
+
+
+def test_new_id_skips_ids_in_use(project):
+    object_id = project.new_id('seed')
+    project.add_object(object_id, {'isa': 'PBXGroup', 'children': []})
+
+    assert project.new_id('seed') != object_id
+    with pytest.raises(PBXProjectError):
+        project.add_object(object_id, {'isa': 'PBXGroup'})
+
+
+def test_malformed_project_is_rejected():
+    with pytest.raises(PBXProjectError):
+        PBXProject.parse('// !$*UTF8*$!\n{ archiveVersion = 1; objects = { }; }\n')
+
+
+@pytest.fixture
+def source_tree(tmp_path):
+    """The fixture project next to a Models/ directory with one file the project doesn't list."""
+    shutil.copytree(FIXTURE, tmp_path / 'Braindumpster.xcodeproj')
+    (tmp_path / 'Models').mkdir()
+    (tmp_path / 'Models' / 'Recording.swift').write_text('struct Recording {}\n')
+    return tmp_path
+
+
+def run_sync(monkeypatch, *args):
+    monkeypatch.setattr(sys, 'argv', ['sync_xcode_project.py', *args])
+    return sync_xcode_project.main()
+
+
+def test_dry_run_reports_the_missing_file(source_tree, monkeypatch, capsys, original):
+    project = str(source_tree / 'Braindumpster.xcodeproj')
+
+    assert run_sync(monkeypatch, '--project', project, '--dirs', 'Models', '--dry-run') == 1
+
+    out = capsys.readouterr().out
+    assert '+ add      Models/Recording.swift' in out
+    assert 'Recording.swift in Sources' in out          # The unified diff
+    assert (source_tree / 'Braindumpster.xcodeproj' / 'project.pbxproj').read_text() == original
+
+
+def test_sync_adds_the_file_and_is_then_in_sync(source_tree, monkeypatch, capsys):
+    project = str(source_tree / 'Braindumpster.xcodeproj')
+
+    assert run_sync(monkeypatch, '--project', project, '--dirs', 'Models') == 0
+    assert PBXProject.load(project).file_ref('Models/Recording.swift') is not None
+
+    capsys.readouterr()
+    assert run_sync(monkeypatch, '--project', project, '--dirs', 'Models', '--dry-run') == 0
+    assert 'in sync' in capsys.readouterr().out
@@ -0,0 +1,130 @@
+import asyncio
+import json
+
+import pytest
+
+import receipt_validation_async as rva
+import receipt_validation_endpoint as rv
+from receipt_validation_async import AsyncSingleFlight
+
+
+def test_followers_share_the_leaders_result():
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'isPremium': True}
+
+    async def main():
+        flight = AsyncSingleFlight()
+        return await asyncio.gather(*(flight.do('receipt', factory) for _ in range(5)))
+
+    assert asyncio.run(main()) == [{'isPremium': True}] * 5
+    assert calls == [1]
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    release = None
+
+    async def factory():
+        await release.wait()
+        return {'isPremium': True}
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        flight = AsyncSingleFlight()
+        leader = asyncio.ensure_future(flight.do('receipt', factory))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do('receipt', factory))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        release.set()
+        return await follower
+
+    assert asyncio.run(main()) == {'isPremium': True}
+
+
+def test_errors_reach_every_caller():
+    async def factory():
+        await asyncio.sleep(0.01)
+        raise ValueError("bad receipt")
+
+    async def main():
+        flight = AsyncSingleFlight()
+        return await asyncio.gather(*(flight.do('receipt', factory) for _ in range(3)),
+                                    return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(main()))
+
+
+def flask_routes():
+    return {(method, rule.rule, rule.endpoint)
+            for rule in rv.app.url_map.iter_rules() if rule.endpoint != 'static'
+            for method in rule.methods - {'HEAD', 'OPTIONS'}}
+
+
+def test_asgi_app_serves_every_flask_route():
+    asgi_routes = {(method, path, endpoint) for (method, path), (endpoint, _) in rva.ROUTES.items()}
+    assert asgi_routes == flask_routes()
+
+
+def call(method, path, body=b'', headers=(), query_string=b''):
+    """Run one request through the ASGI app; returns (status, body bytes)."""
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+             'headers': [(name.encode(), value.encode()) for name, value in headers]}
+    asyncio.run(rva.app(scope, receive, send))
+    return sent[0]['status'], sent[1]['body']
+
+
+def test_asgi_entitlement_and_webhook_routes(monkeypatch):
+    monkeypatch.setattr(rv, 'FIREBASE_AUTH_ENABLED', True)
+    monkeypatch.setattr(rv.firebase_verifier, 'cached', lambda token: {'uid': token})
+    rv.save_subscription_status('asgi-1', 'brain_dumpster_monthly_premium', '2030-01-01T00:00:00Z', 'sandbox')
+    rv.subscription_store.flush(timeout=5)
+    monkeypatch.setattr(rv.entitlement_index, '_next_refresh', 0.0)
+    rv.entitlement_index.refresh()
+
+    status, body = call('GET', '/api/entitlement', headers=[('authorization', 'Bearer asgi-1')])
+    assert status == 200 and json.loads(body)['isPremium'] is True
+
+    status, _ = call('POST', '/api/webhooks/apple', body=json.dumps({'signedPayload': 'a.b.asgi'}).encode())
+    assert status == 200
+    assert rv.webhook_queue.pending_count() == 1
+    rv.webhook_worker.drain_once()      # Fails verification and is dropped
+    assert rv.webhook_queue.pending_count() == 0
+    status, _ = call('POST', '/api/webhooks/apple', body=b'{"signedPayload": "' + b'a' * 200000 + b'"}')
+    assert status == 413
+
+
+def test_asgi_batch_requires_an_admin(monkeypatch):
+    async def verify_with_apple(receipt, user_id=None, original_transaction_id=None):
+        return {'success': True, 'isPremium': True, 'productId': 'brain_dumpster_monthly_premium',
+                'expirationDate': '2030-01-01T00:00:00Z', 'environment': 'sandbox'}
+
+    monkeypatch.setattr(rv, 'RECEIPT_PREVALIDATION_ENABLED', False)
+    monkeypatch.setattr(rva, 'verify_with_apple', verify_with_apple)
+    monkeypatch.setattr(rv, 'FIREBASE_AUTH_ENABLED', True)
+    monkeypatch.setattr(rv.firebase_verifier, 'cached', lambda token: {'uid': token, 'admin': token == 'ops'})
+    body = json.dumps({'items': [{'userId': 'asgi-2', 'receiptData': 'YXNnaS0y'}]}).encode()
+
+    status, _ = call('POST', '/api/verify-receipts', body=body, headers=[('authorization', 'Bearer asgi-2')])
+    assert status == 403
+
+    status, response = call('POST', '/api/verify-receipts', body=body, headers=[('authorization', 'Bearer ops')])
+    assert status == 200
+    assert json.loads(response)['results'][0]['isPremium'] is True
+    rv.subscription_store.flush(timeout=5)
+    assert rv.subscription_store.get('asgi-2')['is_premium'] is True
@@ -0,0 +1,560 @@
+import asyncio
+import base64
+import itertools
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import receipt_validation_async as rva
+import receipt_validation_endpoint as rv
+from benchmarks.fake_apple_server import encode_receipt
+
+PREMIUM_EXPIRY = '2030-01-01T00:00:00Z'
+_receipts = itertools.count()
+
+
+def new_receipt():
+    """A receipt no earlier test has validated (the verdict cache is per process)."""
+    return base64.b64encode(f'receipt-{next(_receipts)}'.encode()).decode()
+
+
+def premium_verdict(original_transaction_id='2000'):
+    return {
+        'success': True,
+        'isPremium': True,
+        'productId': 'brain_dumpster_monthly_premium',
+        'originalTransactionId': original_transaction_id,
+        'expirationDate': PREMIUM_EXPIRY,
+        'environment': 'sandbox',
+        'message': 'Active premium subscription'
+    }
+
+
+@pytest.fixture
+def apple(monkeypatch):
+    """Stands in for verify_with_apple; counts calls."""
+    calls = []
+
+    def verify_with_apple(receipt, user_id=None, original_transaction_id=None):
+        calls.append(user_id)
+        return premium_verdict()
+
+    monkeypatch.setattr(rv, 'RECEIPT_PREVALIDATION_ENABLED', False)
+    monkeypatch.setattr(rv, 'verify_with_apple', verify_with_apple)
+    return calls
+
+
+@pytest.fixture
+def signed_in(monkeypatch):
+    """Every bearer token verifies as the uid it names: 'Bearer alice' -> alice."""
+    monkeypatch.setattr(rv, 'FIREBASE_AUTH_ENABLED', True)
+    monkeypatch.setattr(rv.firebase_verifier, 'verify', lambda token: {'uid': token})
+    monkeypatch.setattr(rv.firebase_verifier, 'cached', lambda token: {'uid': token})
+
+
+@pytest.fixture
+def client():
+    return rv.app.test_client()
+
+
+def verify(client, token, receipt, **body):
+    return client.post('/api/verify-receipt', json=dict(body, receiptData=receipt),
+                       headers={'Authorization': f'Bearer {token}'})
+
+
+def test_verdict_is_stored_under_the_token_uid(client, apple, signed_in):
+    response = verify(client, 'alice-1', new_receipt())
+
+    assert response.status_code == 200
+    assert response.json['isPremium'] is True
+    assert rv.subscription_store.get('alice-1')['is_premium'] is True
+
+
+def test_body_user_id_of_another_user_is_refused(client, apple, signed_in):
+    response = verify(client, 'mallory-1', new_receipt(), userId='alice-2')
+
+    assert response.status_code == 403
+    assert apple == []
+    assert rv.subscription_store.get('alice-2') is None
+
+
+def verify_batch(client, token, items):
+    return client.post('/api/verify-receipts', json={'items': items},
+                       headers={'Authorization': f'Bearer {token}'})
+
+
+def test_batch_is_refused_to_app_users(client, apple, signed_in):
+    response = verify_batch(client, 'alice-3', [{'userId': 'alice-3', 'receiptData': new_receipt()}])
+
+    assert response.status_code == 403
+    assert apple == []
+
+
+def test_batch_accepts_the_admin_claim(client, apple, monkeypatch):
+    monkeypatch.setattr(rv, 'FIREBASE_AUTH_ENABLED', True)
+    monkeypatch.setattr(rv.firebase_verifier, 'verify', lambda token: {'uid': token, 'admin': token == 'ops'})
+
+    assert verify_batch(client, 'ops', [{'receiptData': new_receipt()}]).status_code == 200
+    assert verify_batch(client, 'not-ops', [{'receiptData': new_receipt()}]).status_code == 403
+
+
+def test_batch_stores_verdicts_for_the_named_users(client, apple, signed_in, monkeypatch):
+    monkeypatch.setattr(rv, 'ADMIN_UIDS', frozenset({'reconciler'}))
+
+    response = verify_batch(client, 'reconciler', [
+        {'userId': 'alice-3', 'receiptData': new_receipt()},
+        {'userId': 'bob-3', 'receiptData': new_receipt()},
+        {'receiptData': new_receipt()},
+    ])
+
+    assert response.status_code == 200
+    results = json.loads(response.data)['results']
+    assert len(results) == 3 and all(result['isPremium'] for result in results)
+    rv.subscription_store.flush(timeout=5)
+    assert rv.subscription_store.get('alice-3')['is_premium'] is True
+    assert rv.subscription_store.get('bob-3')['is_premium'] is True
+    assert rv.subscription_store.get('reconciler') is None
+
+
+def test_async_path_uses_the_token_uid(monkeypatch, signed_in):
+    async def verify_with_apple(receipt, user_id=None, original_transaction_id=None):
+        return premium_verdict()
+
+    monkeypatch.setattr(rv, 'RECEIPT_PREVALIDATION_ENABLED', False)
+    monkeypatch.setattr(rva, 'verify_with_apple', verify_with_apple)
+    headers = {'authorization': 'Bearer alice-4'}
+
+    status, payload = asyncio.run(rva.verify_receipt(
+        headers, json.dumps({'receiptData': new_receipt(), 'userId': 'bob-4'}).encode()
+    ))
+    assert status == 403
+
+    status, payload = asyncio.run(rva.verify_receipt(
+        headers, json.dumps({'receiptData': new_receipt()}).encode()
+    ))
+    assert status == 200 and payload['isPremium'] is True
+    rv.subscription_store.flush(timeout=5)
+    assert rv.subscription_store.get('alice-4')['is_premium'] is True
+    assert rv.subscription_store.get('bob-4') is None
+
+
+def signed_notification(notification, signature='c2ln'):
+    """A JWS-shaped signedPayload (header.payload.signature) without a real signature."""
+    encode = lambda value: base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b'=').decode()
+    return f"{encode({'alg': 'ES256'})}.{encode(notification)}.{signature}"
+
+
+@pytest.fixture
+def unverified_webhooks(monkeypatch):
+    """Webhook payloads pass verification unless their signature is 'forged'."""
+    def decode_notification(signed_payload):
+        _, payload, signature = signed_payload.split('.')
+        if signature == 'forged':
+            raise rv.InvalidNotificationError("Signature does not verify")
+        return json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+
+    monkeypatch.setattr(rv.apple_notification_verifier, 'decode_notification', decode_notification)
+
+
+def send_notification(client, notification_type, original_transaction_id):
+    notification = {
+        'notificationType': notification_type,
+        'notificationUUID': f'{notification_type}-{original_transaction_id}',
+        'signedDate': 1700000000000,
+        'data': {
+            'environment': 'Sandbox',
+            'transactionInfo': {
+                'originalTransactionId': original_transaction_id,
+                'productId': 'brain_dumpster_monthly_premium',
+                'expiresDate': 1893456000000,
+                'revocationDate': 1700000000000
+            }
+        }
+    }
+    response = client.post('/api/webhooks/apple', json={'signedPayload': signed_notification(notification)})
+    assert response.status_code == 200
+    rv.webhook_worker.drain_once()
+
+
+def test_revocation_drops_cached_verdicts(client, monkeypatch, signed_in, unverified_webhooks):
+    verdicts = [premium_verdict('5005')]
+    apple_calls = []
+
+    def verify_with_apple(receipt, user_id=None, original_transaction_id=None):
+        apple_calls.append(user_id)
+        return dict(verdicts[-1])
+
+    monkeypatch.setattr(rv, 'RECEIPT_PREVALIDATION_ENABLED', False)
+    monkeypatch.setattr(rv, 'verify_with_apple', verify_with_apple)
+    receipt = new_receipt()
+
+    assert verify(client, 'alice-5', receipt).json['isPremium'] is True
+    assert verify(client, 'alice-5', receipt).json['isPremium'] is True
+    assert len(apple_calls) == 1
+
+    # Apple refunds the purchase and tells us
+    verdicts.append({'success': True, 'isPremium': False, 'message': 'No active premium subscription'})
+    send_notification(client, 'REFUND', '5005')
+    assert rv.subscription_store.get('alice-5')['is_premium'] is False
+
+    response = verify(client, 'alice-5', receipt)
+    assert response.json['isPremium'] is False
+    assert len(apple_calls) == 2
+    assert rv.subscription_store.get('alice-5')['is_premium'] is False
+
+
+def test_revocation_by_another_worker_drops_cached_verdict(client, monkeypatch, signed_in):
+    verdicts = [premium_verdict('6006')]
+    monkeypatch.setattr(rv, 'RECEIPT_PREVALIDATION_ENABLED', False)
+    monkeypatch.setattr(rv, 'verify_with_apple', lambda receipt, **kwargs: dict(verdicts[-1]))
+    rv.entitlement_index.refresh()
+    receipt = new_receipt()
+
+    assert verify(client, 'alice-6', receipt).json['isPremium'] is True
+
+    # Another worker stores the refund; this one only sees it through the change log
+    verdicts.append({'success': True, 'isPremium': False, 'message': 'No active premium subscription'})
+    rv.subscription_store.upsert(dict(rv.subscription_store.get('alice-6'), is_premium=False,
+                                      updated_at='2099-01-01T00:00:00Z'))
+    rv.subscription_store.flush(timeout=5)
+    monkeypatch.setattr(rv.entitlement_index, '_next_refresh', 0.0)
+    rv.entitlement_index.refresh()
+
+    assert verify(client, 'alice-6', receipt).json['isPremium'] is False
+
+
+def test_cached_verdicts_are_not_stored_again(client, apple, signed_in, monkeypatch):
+    rv.entitlement_index.refresh()
+    receipt = new_receipt()
+    writes = []
+    upsert = rv.subscription_store.upsert
+    monkeypatch.setattr(rv.subscription_store, 'upsert', lambda record: writes.append(record) or upsert(record))
+
+    for _ in range(3):
+        assert verify(client, 'alice-7', receipt).json['isPremium'] is True
+    assert len(apple) == 1
+    assert [record['user_id'] for record in writes] == ['alice-7']
+
+    # Another account on the same device has nothing stored yet
+    assert verify(client, 'bob-7', receipt).json['isPremium'] is True
+    assert [record['user_id'] for record in writes] == ['alice-7', 'bob-7']
+
+
+def did_renew(original_transaction_id, expires_ms, notification_uuid='renew-uuid'):
+    return {
+        'notificationType': 'DID_RENEW',
+        'notificationUUID': notification_uuid,
+        'signedDate': 1700000000000,
+        'data': {
+            'environment': 'Sandbox',
+            'transactionInfo': {
+                'originalTransactionId': original_transaction_id,
+                'productId': 'brain_dumpster_monthly_premium',
+                'expiresDate': expires_ms
+            }
+        }
+    }
+
+
+def post_webhook(client, notification, signature='c2ln'):
+    return client.post('/api/webhooks/apple',
+                       json={'signedPayload': signed_notification(notification, signature)})
+
+
+def test_webhook_rejects_oversized_bodies(client):
+    response = client.post('/api/webhooks/apple', data=b'{"signedPayload": "' + b'a' * 200000 + b'"}',
+                           content_type='application/json')
+    assert response.status_code == 413
+    assert rv.webhook_queue.pending_count() == 0
+
+
+def test_forged_notification_cannot_claim_a_genuine_uuid(client, apple, signed_in, unverified_webhooks):
+    assert verify(client, 'alice-8', new_receipt()).json['isPremium'] is True
+    rv.subscription_store.upsert(dict(rv.subscription_store.get('alice-8'), original_transaction_id='8008'))
+
+    # A forged delivery arrives first, using the genuine notification's UUID
+    assert post_webhook(client, did_renew('8008', 1924992000000, 'uuid-8'), signature='forged').status_code == 200
+    assert post_webhook(client, did_renew('8008', 1924992000000, 'uuid-8')).status_code == 200
+    while rv.webhook_worker.drain_once():
+        pass
+
+    assert rv.subscription_store.get('alice-8')['expires_date'] == '2031-01-01T00:00:00Z'
+    assert rv.webhook_queue.pending_count() == 0
+
+
+def test_verified_duplicates_are_applied_once(client, apple, signed_in, unverified_webhooks, monkeypatch):
+    applied = []
+    apply_notification = rv.apply_notification
+    monkeypatch.setattr(rv, 'apply_notification',
+                        lambda notification: applied.append(notification['notificationUUID'])
+                        or apply_notification(notification))
+
+    # Identical retries are dropped on receipt; re-signed ones after verification
+    post_webhook(client, did_renew('9009', 1924992000000, 'uuid-9'))
+    post_webhook(client, did_renew('9009', 1924992000000, 'uuid-9'))
+    post_webhook(client, did_renew('9009', 1924992000000, 'uuid-9'), signature='c2lnMg')
+    rv.webhook_worker.drain_once()
+    post_webhook(client, did_renew('9009', 1924992000000, 'uuid-9'), signature='c2lnMw')
+    rv.webhook_worker.drain_once()
+
+    assert applied == ['uuid-9']
+
+
+@pytest.fixture
+def apple_down(monkeypatch):
+    def verify_with_apple(receipt, user_id=None, original_transaction_id=None):
+        raise rv.AppleUnavailableError("Circuit open")
+
+    monkeypatch.setattr(rv, 'RECEIPT_PREVALIDATION_ENABLED', True)
+    monkeypatch.setattr(rv, 'verify_with_apple', verify_with_apple)
+
+
+def test_forged_receipt_cannot_borrow_a_stored_subscription(client, signed_in, apple_down):
+    rv.save_subscription_status('victim-19', 'brain_dumpster_monthly_premium', PREMIUM_EXPIRY,
+                                'production', original_transaction_id='777')
+    rv.subscription_store.flush(timeout=5)
+
+    forged = encode_receipt(rv.EXPECTED_BUNDLE_ID, '777')
+    response = verify(client, 'mallory-19', forged)
+
+    assert response.status_code == 503
+    assert response.json['isPremium'] is False
+    assert rv.subscription_store.get('mallory-19') is None
+
+
+def test_own_stored_subscription_is_served_while_apple_is_down(client, signed_in, apple_down):
+    rv.save_subscription_status('alice-19', 'brain_dumpster_monthly_premium', PREMIUM_EXPIRY,
+                                'production', original_transaction_id='1919')
+    rv.subscription_store.flush(timeout=5)
+
+    response = verify(client, 'alice-19', encode_receipt(rv.EXPECTED_BUNDLE_ID, '1919'))
+
+    assert response.status_code == 200
+    assert response.json['isPremium'] is True
+    assert response.json['stale'] is True
+
+
+def notification(notification_type, original_transaction_id, expires_ms, signed_ms=1700000000000):
+    return {
+        'notificationType': notification_type,
+        'notificationUUID': f'{notification_type}-{original_transaction_id}-{expires_ms}',
+        'signedDate': signed_ms,
+        'data': {
+            'environment': 'Sandbox',
+            'transactionInfo': {
+                'originalTransactionId': original_transaction_id,
+                'productId': 'brain_dumpster_monthly_premium',
+                'expiresDate': expires_ms
+            }
+        }
+    }
+
+
+@pytest.mark.parametrize('notification_type', ['EXPIRED', 'GRACE_PERIOD_EXPIRED', 'REFUND', 'REVOKE'])
+def test_late_revocation_of_an_earlier_period_is_stale(notification_type):
+    user_id = f'alice-15-{notification_type}'
+    rv.save_subscription_status(user_id, 'brain_dumpster_monthly_premium', '2031-01-01T00:00:00Z',
+                                'sandbox', original_transaction_id=user_id)
+
+    # The period that ended on 2030-01-01, delivered after the renewal to 2031
+    assert rv.apply_notification(notification(notification_type, user_id, 1893456000000)) == 'stale'
+
+    record = rv.subscription_store.get(user_id)
+    assert record['is_premium'] is True
+    assert record['expires_date'] == '2031-01-01T00:00:00Z'
+
+
+def test_revocation_of_the_current_period_applies():
+    rv.save_subscription_status('alice-15b', 'brain_dumpster_monthly_premium', '2030-01-01T00:00:00Z',
+                                'sandbox', original_transaction_id='1515')
+
+    assert rv.apply_notification(notification('REFUND', '1515', 1893456000000)) == 'updated'
+    assert rv.subscription_store.get('alice-15b')['is_premium'] is False
+
+
+def test_grant_signed_before_a_stored_revocation_is_stale():
+    rv.save_subscription_status('alice-15c', 'brain_dumpster_monthly_premium', '2030-01-01T00:00:00Z',
+                                'sandbox', original_transaction_id='1516', is_premium=False)
+
+    renewal = notification('DID_RENEW', '1516', 1893456000000, signed_ms=1700000000000)
+    assert rv.apply_notification(renewal) == 'stale'
+    assert rv.subscription_store.get('alice-15c')['is_premium'] is False
+
+    # A later period is newer whenever it was signed
+    assert rv.apply_notification(notification('DID_RENEW', '1516', 1924992000000)) == 'updated'
+    assert rv.subscription_store.get('alice-15c')['is_premium'] is True
+
+
+def in_seconds(seconds):
+    return (datetime.utcnow() + timedelta(seconds=seconds)).isoformat() + 'Z'
+
+
+def test_premium_ttl_is_capped_at_the_expiration_date():
+    cache = rv.ReceiptVerdictCache(ttl_seconds=3600, negative_ttl_seconds=60)
+
+    assert cache._ttl_for(dict(premium_verdict(), expirationDate=in_seconds(120))) == pytest.approx(120, abs=2)
+    assert cache._ttl_for(dict(premium_verdict(), expirationDate=in_seconds(86400))) == 3600
+    assert cache._ttl_for(dict(premium_verdict(), expirationDate=None)) == 3600      # Lifetime
+
+    cache.put('expired', dict(premium_verdict(), expirationDate=in_seconds(-1)))
+    assert cache.get('expired') is None
+
+
+def test_negative_verdicts_use_the_negative_ttl():
+    cache = rv.ReceiptVerdictCache(ttl_seconds=3600, negative_ttl_seconds=60)
+
+    assert cache._ttl_for({'success': True, 'isPremium': False}) == 60
+    assert cache._ttl_for({'success': False, 'isPremium': False, 'status': 21003}) == 60
+
+
+@pytest.mark.parametrize('status', sorted(rv.RETRYABLE_APPLE_STATUSES))
+def test_retryable_statuses_are_never_cached(status):
+    cache = rv.ReceiptVerdictCache()
+    cache.put('receipt', {'success': False, 'isPremium': False, 'status': status})
+
+    assert cache.get('receipt') is None
+    assert cache.get_stale('receipt') is None
+
+
+def test_expired_verdicts_are_served_stale_only():
+    cache = rv.ReceiptVerdictCache(stale_seconds=3600)
+    cache.put('receipt', dict(premium_verdict(), expirationDate=in_seconds(0.2)))
+    assert cache.get('receipt')['isPremium'] is True
+
+    time.sleep(0.3)
+    assert cache.get('receipt') is None
+    assert cache.get_stale('receipt')['isPremium'] is True
+
+
+def sandbox_response(original_transaction_id):
+    return {
+        'status': 0,
+        'environment': 'Sandbox',
+        'receipt': {'bundle_id': rv.EXPECTED_BUNDLE_ID, 'in_app': []},
+        'latest_receipt_info': [{
+            'product_id': 'brain_dumpster_monthly_premium',
+            'original_transaction_id': original_transaction_id,
+            'expires_date_ms': str(int(time.time() * 1000) + 86400000)
+        }]
+    }
+
+
+@pytest.fixture
+def apple_hosts(monkeypatch):
+    """Apple answers 21007 from production and success from sandbox; records the hosts called."""
+    hosts = []
+
+    def call_apple(session, url, environment, payload, deadline):
+        hosts.append(environment)
+        return {'status': 21007} if environment == 'production' else sandbox_response('3003')
+
+    monkeypatch.setattr(rv, 'receipt_environments', rv.ReceiptEnvironmentMemory())
+    monkeypatch.setattr(rv, '_call_apple', call_apple)
+    monkeypatch.setattr(rv, 'get_apple_session', lambda: None)
+    return hosts
+
+
+def test_remembered_sandbox_user_skips_the_21007_retry(apple_hosts):
+    assert rv.verify_with_apple(b'cmVjZWlwdA==', user_id='tester')['isPremium'] is True
+    assert apple_hosts == ['production', 'sandbox']
+
+    assert rv.verify_with_apple(b'cmVjZWlwdA==', user_id='tester')['isPremium'] is True
+    assert apple_hosts == ['production', 'sandbox', 'sandbox']
+
+
+def test_remembered_transaction_skips_the_21007_retry(apple_hosts):
+    rv.verify_with_apple(b'cmVjZWlwdA==', original_transaction_id='3003')
+    apple_hosts.clear()
+
+    rv.verify_with_apple(b'cmVjZWlwdA==', user_id='new-device', original_transaction_id='3003')
+    assert apple_hosts == ['sandbox']
+
+
+def test_single_flight_passes_the_leaders_error_to_followers():
+    flight = rv.SingleFlight(wait_timeout=5)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def validate():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        raise ValueError("Apple said no")
+
+    errors = []
+
+    def run():
+        try:
+            flight.do('receipt', validate)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=run)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=run) for _ in range(3)]
+    for follower in followers:
+        follower.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert calls == [1]
+    assert len(errors) == 4 and len({id(error) for error in errors}) == 1
+
+
+def test_single_flight_follower_times_out():
+    flight = rv.SingleFlight(wait_timeout=0.05)
+    started = threading.Event()
+    release = threading.Event()
+
+    def validate():
+        started.set()
+        release.wait(5)
+        return premium_verdict()
+
+    leader = threading.Thread(target=flight.do, args=('receipt', validate))
+    leader.start()
+    started.wait(5)
+    try:
+        with pytest.raises(rv.requests.Timeout):
+            flight.do('receipt', validate)
+    finally:
+        release.set()
+        leader.join(5)
+
+    # The next call leads a new flight
+    assert flight.do('receipt', premium_verdict)['isPremium'] is True
+
+
+def purchase(product_id, days_left):
+    expires_ms = int(time.time() * 1000) + int(days_left * 86400000)
+    return {'product_id': product_id, 'original_transaction_id': f'{product_id}-{days_left}',
+            'expires_date_ms': str(expires_ms)}
+
+
+def test_find_active_premium_picks_the_latest_expiry():
+    monthly, yearly = 'brain_dumpster_monthly_premium', 'brain_dumpster_yearly_premium'
+    in_app = [purchase(monthly, 20), purchase(monthly, -10), purchase('other_product', 900)]
+    latest = [purchase(yearly, 300), purchase(monthly, 5), {'product_id': monthly, 'expires_date_ms': 'n/a'},
+              purchase(yearly, -400)]
+
+    found = rv.find_active_premium(in_app, latest)
+
+    assert found['product_id'] == yearly
+    assert found['original_transaction_id'] == f'{yearly}-300'
+
+
+def test_find_active_premium_ignores_expired_and_prefers_lifetime():
+    monthly = 'brain_dumpster_monthly_premium'
+    assert rv.find_active_premium([purchase(monthly, -1)], []) is None
+
+    lifetime = {'product_id': rv.LIFETIME_PRODUCT_ID, 'original_transaction_id': 'forever'}
+    found = rv.find_active_premium([purchase(monthly, 30)], [lifetime])
+    assert found == {'product_id': rv.LIFETIME_PRODUCT_ID, 'original_transaction_id': 'forever',
+                     'expires_date': None}
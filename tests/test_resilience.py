@@ -0,0 +1,202 @@
+import asyncio
+import random
+import threading
+import time
+
+import pytest
+
+import receipt_validation_async as rva
+import receipt_validation_endpoint as rv
+import resilience
+from resilience import CircuitBreaker, HedgePolicy, backoff_delay
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(resilience, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def transitions():
+    return []
+
+
+@pytest.fixture
+def breaker(clock, transitions):
+    return CircuitBreaker('apple', failure_rate_threshold=0.5, minimum_calls=4, window_seconds=30,
+                          open_seconds=15, half_open_calls=2,
+                          on_state_change=lambda name, state: transitions.append(state))
+
+
+def trip(breaker):
+    for failed in (False, True, False, True):
+        assert breaker.allow()
+        breaker.record_failure() if failed else breaker.record_success()
+
+
+def test_breaker_opens_once_the_failure_rate_is_reached(breaker, transitions):
+    for _ in range(3):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED     # Fewer than minimum_calls
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert transitions == [CircuitBreaker.OPEN]
+
+
+def test_breaker_forgets_outcomes_outside_its_window(breaker, clock):
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 31
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_recovers_through_half_open(breaker, clock, transitions):
+    trip(breaker)
+    clock.now += 14
+    assert not breaker.allow()
+
+    clock.now += 1
+    assert breaker.allow()
+    assert breaker.allow()
+    assert not breaker.allow()          # Only half_open_calls probes
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert transitions == [CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN, CircuitBreaker.CLOSED]
+
+
+def test_failed_probe_opens_the_breaker_again(breaker, clock, transitions):
+    trip(breaker)
+    clock.now += 15
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    clock.now += 15
+    assert breaker.allow()
+    assert transitions == [CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN, CircuitBreaker.OPEN,
+                           CircuitBreaker.HALF_OPEN]
+
+
+def test_hedge_delay_is_the_latency_percentile():
+    policy = HedgePolicy(percentile=0.9, window=100, minimum_samples=10, min_delay_seconds=0.01)
+    for milliseconds in range(1, 10):
+        policy.record(milliseconds / 1000)
+    assert policy.delay() is None       # Not enough samples yet
+
+    # Recomputed every 20 samples; the window then holds 11..110 ms
+    for milliseconds in range(10, 111):
+        policy.record(milliseconds / 1000)
+    assert policy.delay() == pytest.approx(0.101)
+
+
+def test_hedge_delay_has_a_floor():
+    policy = HedgePolicy(minimum_samples=1, min_delay_seconds=0.25)
+    policy.record(0.001)
+    assert policy.delay() == 0.25
+
+
+def test_hedge_budget_limits_the_hedge_ratio():
+    policy = HedgePolicy(max_ratio=0.25, max_burst=2)
+    assert not policy.try_acquire()
+
+    for _ in range(4):
+        policy.delay()
+    assert policy.try_acquire()
+    assert not policy.try_acquire()
+
+    # Idle periods don't bank more than max_burst hedges
+    for _ in range(100):
+        policy.delay()
+    assert [policy.try_acquire() for _ in range(3)] == [True, True, False]
+
+
+def test_backoff_delay_is_jittered_below_the_cap():
+    random.seed(7)
+    for attempt in range(8):
+        cap = min(2.0, 0.25 * 2 ** attempt)
+        delays = [backoff_delay(attempt, 0.25, 2.0) for _ in range(200)]
+        assert all(0 <= delay <= cap for delay in delays)
+        assert max(delays) > cap / 2
+
+
+@pytest.fixture
+def eager_hedging(monkeypatch):
+    """Hedge every call after 20 ms."""
+    policy = HedgePolicy(minimum_samples=1, min_delay_seconds=0.02, max_ratio=1.0)
+    policy.record(0.001)
+    monkeypatch.setitem(rv.apple_hedge_policies, 'production', policy)
+    monkeypatch.setattr(rv, 'APPLE_HEDGE_ENABLED', True)
+
+
+def test_hedge_wins_when_the_first_request_fails(monkeypatch, eager_hedging):
+    calls = []
+    lock = threading.Lock()
+
+    def post(session, url, environment, payload, timeout):
+        with lock:
+            calls.append(timeout)
+            first = len(calls) == 1
+        if first:
+            time.sleep(0.05)
+            raise ConnectionError("reset by peer")
+        time.sleep(0.1)
+        return {'status': 0, 'from': 'hedge'}
+
+    monkeypatch.setattr(rv, '_post_to_apple', post)
+
+    assert rv._hedged_post_to_apple(None, 'url', 'production', b'{}', (5, 10)) == {'status': 0, 'from': 'hedge'}
+    assert len(calls) == 2
+    assert calls[1][1] == pytest.approx(10 - 0.02)
+
+
+def test_fast_failure_is_not_hedged(monkeypatch, eager_hedging):
+    calls = []
+
+    def post(session, url, environment, payload, timeout):
+        calls.append(timeout)
+        raise ConnectionError("refused")
+
+    monkeypatch.setattr(rv, '_post_to_apple', post)
+
+    with pytest.raises(ConnectionError):
+        rv._hedged_post_to_apple(None, 'url', 'production', b'{}', (5, 10))
+    assert len(calls) == 1
+
+
+def test_async_hedge_wins_when_the_first_request_fails(monkeypatch, eager_hedging):
+    calls = []
+
+    async def post(client, url, environment, payload, read_timeout):
+        calls.append(read_timeout)
+        if len(calls) == 1:
+            await asyncio.sleep(0.05)
+            raise ConnectionError("reset by peer")
+        await asyncio.sleep(0.1)
+        return {'status': 0, 'from': 'hedge'}
+
+    monkeypatch.setattr(rva, '_post_to_apple', post)
+
+    result = asyncio.run(rva._hedged_post_to_apple(None, 'url', 'production', b'{}', 10))
+    assert result == {'status': 0, 'from': 'hedge'}
+    assert len(calls) == 2
@@ -0,0 +1,80 @@
+import io
+import json
+import logging
+
+import pytest
+
+import structured_logging
+from structured_logging import (ForkSafeQueueHandler, JsonFormatter, RequestIdFilter, SamplingFilter,
+                                request_id_var)
+
+
+@pytest.fixture
+def capture():
+    """A logger routed through the queue handler; `lines()` flushes it and returns the parsed output."""
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JsonFormatter())
+    handler = ForkSafeQueueHandler(target)
+    handler.addFilter(RequestIdFilter())
+    handler.addFilter(SamplingFilter())
+
+    logger = logging.getLogger('test_structured_logging')
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+
+    def lines():
+        handler.close()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    logger.lines = lines
+    yield logger
+    logger.removeHandler(handler)
+    handler.close()
+
+
+def with_request_id(request_id, log, *args, **kwargs):
+    token = request_id_var.set(request_id)
+    try:
+        log(*args, **kwargs)
+    finally:
+        request_id_var.reset(token)
+
+
+def test_one_json_object_per_line_with_extra_fields(capture):
+    with_request_id('req-1', capture.info, "Validated %s receipt", 'sandbox',
+                    extra={'user_id': 'u1', 'duration_ms': 12.5})
+    with_request_id(None, capture.warning, "Multi\nline", extra={'status': 21007})
+
+    first, second = capture.lines()
+    assert first['msg'] == 'Validated sandbox receipt'
+    assert first['level'] == 'INFO'
+    assert first['logger'] == 'test_structured_logging'
+    assert (first['request_id'], first['user_id'], first['duration_ms']) == ('req-1', 'u1', 12.5)
+    assert second['msg'] == 'Multi\nline'
+    assert second['status'] == 21007
+    assert 'request_id' not in second
+
+
+def test_exceptions_are_formatted_before_crossing_threads(capture):
+    try:
+        raise ValueError("bad receipt")
+    except ValueError:
+        capture.exception("Validation failed")
+
+    [entry] = capture.lines()
+    assert 'ValueError: bad receipt' in entry['exc']
+
+
+def test_sample_rate_is_honoured(capture, monkeypatch):
+    monkeypatch.setattr(structured_logging.random, 'random', lambda: 0.5)
+
+    capture.info("dropped", extra={'sample_rate': 0.4})
+    capture.info("kept", extra={'sample_rate': 0.6})
+    capture.info("unsampled")
+    capture.warning("warnings are never sampled", extra={'sample_rate': 0.0})
+
+    entries = capture.lines()
+    assert [entry['msg'] for entry in entries] == ['kept', 'unsampled', 'warnings are never sampled']
+    assert all('sample_rate' not in entry for entry in entries)
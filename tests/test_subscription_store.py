@@ -0,0 +1,167 @@
+import threading
+
+import pytest
+
+from subscription_store import (
+    SQLiteSubscriptionStore, SubscriptionStore, SubscriptionWriteError, WriteBehindSubscriptionStore
+)
+
+
+def record(user_id, expires_date='2030-01-01T00:00:00Z', **fields):
+    return dict({
+        'user_id': user_id,
+        'product_id': 'brain_dumpster_monthly_premium',
+        'original_transaction_id': 1000 + int(user_id[1:]),
+        'expires_date': expires_date,
+        'environment': 'sandbox',
+        'is_premium': True,
+        'updated_at': '2026-01-01T00:00:00Z'
+    }, **fields)
+
+
+class RecordingStore(SubscriptionStore):
+    """In-memory backend that records batches and can block or fail them."""
+
+    def __init__(self):
+        self.batches = []
+        self.records = {}
+        self.fail = False
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def upsert_many(self, records):
+        self.gate.wait(5)
+        if self.fail:
+            raise RuntimeError("database is locked")
+        self.batches.append([dict(r) for r in records])
+        self.records.update((r['user_id'], dict(r)) for r in records)
+
+    def get(self, user_id):
+        return self.records.get(user_id)
+
+
+@pytest.fixture
+def sqlite_store():
+    store = SQLiteSubscriptionStore(':memory:')
+    yield store
+    store.close()
+
+
+def test_sqlite_round_trip(sqlite_store):
+    sqlite_store.upsert(record('u1', receipt=b'RECEIPT'))
+    sqlite_store.upsert(record('u2', expires_date='2029-01-01T00:00:00Z', is_premium=False))
+
+    stored = sqlite_store.get('u1')
+    assert stored == {
+        'user_id': 'u1',
+        'product_id': 'brain_dumpster_monthly_premium',
+        'original_transaction_id': '1001',
+        'expires_date': '2030-01-01T00:00:00Z',
+        'environment': 'sandbox',
+        'is_premium': True,
+        'updated_at': '2026-01-01T00:00:00Z'
+    }
+    assert sqlite_store.get('missing') is None
+    assert sqlite_store.get_by_original_transaction_id(1001)['user_id'] == 'u1'
+    assert sqlite_store.get_receipt('u1') == b'RECEIPT'
+    assert sqlite_store.get_receipt('u2') is None
+    assert sqlite_store.get('u2')['is_premium'] is False
+
+
+def test_sqlite_keeps_receipt_when_later_write_has_none(sqlite_store):
+    sqlite_store.upsert(record('u1', receipt=b'RECEIPT'))
+    sqlite_store.upsert(record('u1', is_premium=False))
+
+    assert sqlite_store.get('u1')['is_premium'] is False
+    assert sqlite_store.get_receipt('u1') == b'RECEIPT'
+
+
+def test_sqlite_expiring_before(sqlite_store):
+    sqlite_store.upsert_many([
+        record('u1', expires_date='2030-03-01T00:00:00Z'),
+        record('u2', expires_date='2030-01-01T00:00:00Z'),
+        record('u3', expires_date='2030-02-01T00:00:00Z', is_premium=False),
+        record('u4', expires_date=None),
+        record('u5', expires_date='2029-01-01T00:00:00Z'),
+    ])
+
+    due = sqlite_store.expiring_before('2030-06-01T00:00:00Z', expires_after='2029-06-01T00:00:00Z')
+    assert [r['user_id'] for r in due] == ['u2', 'u1']
+    assert [r['user_id'] for r in sqlite_store.expiring_before('2030-06-01', limit=1)] == ['u5']
+
+
+def test_sqlite_change_log(sqlite_store):
+    change_seq, records = sqlite_store.snapshot()
+    assert records == []
+
+    sqlite_store.upsert(record('u1'))
+    sqlite_store.upsert(record('u2'))
+    sqlite_store.upsert(record('u1', is_premium=False))
+
+    change_seq, changes = sqlite_store.changes_since(change_seq)
+    assert [(r['user_id'], r['is_premium']) for r in changes] == [('u1', False), ('u2', True), ('u1', False)]
+    assert sqlite_store.changes_since(change_seq) == (change_seq, [])
+
+
+def test_write_behind_round_trip():
+    backend = SQLiteSubscriptionStore(':memory:')
+    store = WriteBehindSubscriptionStore(backend, flush_interval=0.01)
+    store.upsert(record('u1', receipt=b'RECEIPT'))
+
+    # Visible before and after the commit
+    assert store.get('u1')['expires_date'] == '2030-01-01T00:00:00Z'
+    assert store.get_receipt('u1') == b'RECEIPT'
+    store.flush(timeout=5)
+    assert backend.get('u1') == store.get('u1')
+    assert backend.get_receipt('u1') == b'RECEIPT'
+    store.close()
+
+
+def test_write_behind_coalesces_writes_for_the_same_user():
+    backend = RecordingStore()
+    store = WriteBehindSubscriptionStore(backend, flush_interval=0.01)
+
+    # Hold the writer inside its first batch while u1 is written three times
+    backend.gate.clear()
+    store.upsert(record('u0'))
+    for month in ('01', '02', '03'):
+        store.upsert(record('u1', expires_date=f'2030-{month}-01T00:00:00Z'))
+    assert store.get('u1')['expires_date'] == '2030-03-01T00:00:00Z'
+    backend.gate.set()
+    store.flush(timeout=5)
+
+    u1_writes = [r for batch in backend.batches for r in batch if r['user_id'] == 'u1']
+    assert len(u1_writes) == 1
+    assert u1_writes[0]['expires_date'] == '2030-03-01T00:00:00Z'
+
+
+def test_write_behind_retries_failed_batches():
+    backend = RecordingStore()
+    backend.fail = True
+    store = WriteBehindSubscriptionStore(backend, flush_interval=0.01,
+                                         retry_base_seconds=0.01, retry_max_seconds=0.05)
+    store.upsert(record('u1'))
+
+    with pytest.raises(SubscriptionWriteError):
+        store.flush(timeout=5)
+    # Still pending, still readable
+    assert store.get('u1')['user_id'] == 'u1'
+    assert backend.records == {}
+
+    store.upsert(record('u1', expires_date='2031-01-01T00:00:00Z'))
+    backend.fail = False
+    store.flush(timeout=5)
+    assert backend.records['u1']['expires_date'] == '2031-01-01T00:00:00Z'
+
+
+def test_write_behind_flush_timeout():
+    backend = RecordingStore()
+    store = WriteBehindSubscriptionStore(backend, flush_interval=0.01)
+    backend.gate.clear()
+    store.upsert(record('u1'))
+
+    with pytest.raises(SubscriptionWriteError):
+        store.flush(timeout=0.05)
+    backend.gate.set()
+    store.flush(timeout=5)
+    assert 'u1' in backend.records
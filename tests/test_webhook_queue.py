@@ -0,0 +1,94 @@
+import pytest
+
+import webhook_queue
+from webhook_queue import WebhookQueue, WebhookQueueWorker
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(webhook_queue, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def queue(clock):
+    queue = WebhookQueue(':memory:', max_attempts=3, retry_base_seconds=60, retry_max_seconds=600)
+    yield queue
+    queue.close()
+
+
+def test_identical_payloads_are_queued_once(queue):
+    assert queue.enqueue('a.b.c') is True
+    assert queue.enqueue('a.b.c') is False
+    assert queue.pending_count() == 1
+
+
+def test_released_delivery_waits_out_its_backoff(queue, clock):
+    queue.enqueue('a.b.c')
+    [(item_id, _)] = queue.claim(10)
+    queue.release([item_id])
+
+    assert queue.claim(10) == []
+    clock.now += 59
+    assert queue.claim(10) == []
+    clock.now += 1
+    assert [row[0] for row in queue.claim(10)] == [item_id]
+
+    # The second failure waits twice as long
+    queue.release([item_id])
+    clock.now += 119
+    assert queue.claim(10) == []
+    clock.now += 1
+    assert [row[0] for row in queue.claim(10)] == [item_id]
+
+
+def test_delivery_fails_after_max_attempts(queue, clock):
+    queue.enqueue('a.b.c')
+    for _ in range(3):
+        clock.now += queue.retry_max_seconds
+        [(item_id, _)] = queue.claim(10)
+        queue.release([item_id])
+
+    clock.now += queue.retry_max_seconds
+    assert queue.claim(10) == []
+    assert queue.pending_count() == 0
+
+
+def test_backoff_is_capped(queue):
+    assert [queue.retry_delay(attempts) for attempts in range(1, 7)] == [60, 120, 240, 480, 600, 600]
+
+
+def test_expired_lease_is_claimed_again(queue, clock):
+    queue.enqueue('a.b.c')
+    [(item_id, _)] = queue.claim(10)
+
+    assert queue.claim(10) == []
+    clock.now += queue.lease_seconds + 1
+    assert [row[0] for row in queue.claim(10)] == [item_id]
+
+
+def test_worker_retries_failed_items_only_after_backoff(queue, clock):
+    handled = []
+
+    def handler(items):
+        handled.extend(payload for _, payload in items)
+        return [item_id for item_id, payload in items if payload == 'retry.me.please']
+
+    worker = WebhookQueueWorker(queue, handler)
+    queue.enqueue('retry.me.please')
+    queue.enqueue('fine.as.is')
+
+    assert worker.drain_once() == 2
+    assert worker.drain_once() == 0
+    clock.now += 60
+    assert worker.drain_once() == 1
+    assert handled == ['retry.me.please', 'fine.as.is', 'retry.me.please']
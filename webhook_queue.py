@@ -0,0 +1,293 @@
+"""
+Durable intake queue for App Store Server Notifications.
+
+The webhook handler only records the raw signedPayload here and answers
+Apple straight away; a WebhookQueueWorker thread in each server process
+drains the queue in batches. Byte-identical deliveries (Apple's retries)
+are dropped on insert. Deduplication by notificationUUID happens after the
+signature is verified, against processed_uuids() / mark_processed(), so a
+forged payload can't claim the UUID of a genuine notification. Payloads
+are deleted once processed; only the UUIDs are kept, for
+retention_seconds, to cover Apple's retry window.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('webhook_queue')
+
+
+class WebhookQueue:
+    """
+    SQLite-backed queue shared by all processes on the host.
+
+    Deliveries move pending -> claimed -> deleted (or failed). A claim is a
+    lease: rows whose worker died before finishing are claimed again once
+    it runs out. A released row waits out an exponential backoff
+    (retry_base_seconds, doubling up to retry_max_seconds) before it is
+    claimed again, so a store outage doesn't burn through its attempts;
+    rows that keep failing end up failed after max_attempts (kept for
+    retention_seconds for inspection).
+
+    claimed_until is the lease of a claimed row and the earliest retry time
+    of a released one.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS webhook_deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payload_sha256 TEXT NOT NULL UNIQUE,
+            signed_payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            received_at REAL NOT NULL,
+            claimed_until REAL,
+            processed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_state
+            ON webhook_deliveries (state, id);
+        CREATE TABLE IF NOT EXISTS webhook_processed (
+            notification_uuid TEXT PRIMARY KEY,
+            processed_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, lease_seconds=60, max_attempts=10, retention_seconds=7 * 24 * 60 * 60,
+                 retry_base_seconds=30.0, retry_max_seconds=2 * 60 * 60):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self._connection = None
+        self._connection_pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is not None and self._connection_pid == os.getpid():
+            return self._connection
+
+        connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+        if self.path != ':memory:':
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(self.SCHEMA)
+        self._connection = connection
+        self._connection_pid = os.getpid()
+        return connection
+
+    def enqueue(self, signed_payload):
+        """
+        Store a delivery. Returns False if the same payload was already received.
+        """
+        digest = hashlib.sha256(signed_payload.encode()).hexdigest()
+        with self._lock:
+            cursor = self._connect().execute(
+                'INSERT OR IGNORE INTO webhook_deliveries '
+                '(payload_sha256, signed_payload, received_at) VALUES (?, ?, ?)',
+                (digest, signed_payload, time.time())
+            )
+        return cursor.rowcount == 1
+
+    def claim(self, limit):
+        """
+        Lease up to limit pending deliveries, oldest first.
+        Returns [(id, signed_payload)].
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = connection.execute(
+                    "SELECT id, signed_payload FROM webhook_deliveries "
+                    "WHERE (state = 'pending' AND (claimed_until IS NULL OR claimed_until <= ?)) "
+                    "OR (state = 'claimed' AND claimed_until < ?) "
+                    "ORDER BY id LIMIT ?",
+                    (now, now, limit)
+                ).fetchall()
+                connection.executemany(
+                    "UPDATE webhook_deliveries "
+                    "SET state = 'claimed', claimed_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    [(now + self.lease_seconds, row[0]) for row in rows]
+                )
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        return rows
+
+    def complete(self, ids):
+        self._finish(
+            "DELETE FROM webhook_deliveries WHERE id = ?",
+            [(item_id,) for item_id in ids]
+        )
+
+    def release(self, ids):
+        """
+        Hand claimed deliveries back for a retry after a backoff (or give up
+        on them).
+        """
+        if not ids:
+            return
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT id, attempts FROM webhook_deliveries WHERE id IN (%s)' % ','.join('?' * len(ids)),
+                list(ids)
+            ).fetchall()
+        now = time.time()
+        self._finish(
+            "UPDATE webhook_deliveries SET "
+            "state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "claimed_until = ?, processed_at = ? WHERE id = ?",
+            [(self.max_attempts, now + self.retry_delay(attempts), now, item_id) for item_id, attempts in rows]
+        )
+
+    def retry_delay(self, attempts):
+        """
+        Seconds a delivery waits after its attempts-th failed attempt.
+        """
+        return min(self.retry_max_seconds, self.retry_base_seconds * 2 ** max(0, attempts - 1))
+
+    def processed_uuids(self, notification_uuids):
+        """
+        The subset of these (verified) notificationUUIDs already processed.
+        """
+        notification_uuids = list(notification_uuids)
+        if not notification_uuids:
+            return set()
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT notification_uuid FROM webhook_processed WHERE notification_uuid IN (%s)'
+                % ','.join('?' * len(notification_uuids)),
+                notification_uuids
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def mark_processed(self, notification_uuids):
+        now = time.time()
+        self._finish(
+            "INSERT OR IGNORE INTO webhook_processed (notification_uuid, processed_at) VALUES (?, ?)",
+            [(notification_uuid, now) for notification_uuid in notification_uuids]
+        )
+
+    def _finish(self, statement, rows):
+        if not rows:
+            return
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN')
+            try:
+                connection.executemany(statement, rows)
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def prune(self):
+        """
+        Forget failed deliveries and processed UUIDs older than the retention window.
+        """
+        cutoff = time.time() - self.retention_seconds
+        with self._lock:
+            connection = self._connect()
+            deleted = connection.execute(
+                "DELETE FROM webhook_deliveries WHERE state = 'failed' AND processed_at < ?",
+                (cutoff,)
+            ).rowcount
+            deleted += connection.execute(
+                "DELETE FROM webhook_processed WHERE processed_at < ?",
+                (cutoff,)
+            ).rowcount
+        return deleted
+
+    def pending_count(self):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT COUNT(*) FROM webhook_deliveries WHERE state IN ('pending', 'claimed')"
+            ).fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._connection_pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+            self._connection_pid = None
+
+
+class WebhookQueueWorker:
+    """
+    Drains a WebhookQueue on a background thread.
+
+    handler(items) gets a batch of (id, signed_payload) and returns the IDs
+    that should be retried; everything else in the batch is completed.
+    notify() wakes the worker for notifications received by this process;
+    ones received by other processes are picked up within poll_interval.
+    """
+
+    def __init__(self, queue, handler, batch_size=100, poll_interval=1.0, prune_interval=60 * 60):
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.prune_interval = prune_interval
+
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._last_prune = 0.0
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name='webhook-queue', daemon=True)
+        self._thread.start()
+        logger.info("Webhook queue worker started")
+
+    def stop(self, timeout=None):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def drain_once(self):
+        """
+        Process one batch. Returns the number of notifications claimed.
+        """
+        items = self.queue.claim(self.batch_size)
+        if not items:
+            return 0
+
+        try:
+            retry = set(self.handler(items) or ())
+        except Exception:
+            logger.exception("Webhook batch failed", extra={'batch': len(items)})
+            retry = {item_id for item_id, _ in items}
+
+        self.queue.complete([item_id for item_id, _ in items if item_id not in retry])
+        self.queue.release(list(retry))
+        return len(items)
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                if time.time() - self._last_prune >= self.prune_interval:
+                    self._last_prune = time.time()
+                    self.queue.prune()
+
+                if self.drain_once() >= self.batch_size:
+                    continue
+            except sqlite3.Error as e:
+                logger.warning("Webhook queue unavailable", extra={'error': str(e)})
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
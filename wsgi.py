@@ -0,0 +1,9 @@
+"""
+WSGI entry point for the receipt validation backend.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+
+from receipt_validation_endpoint import create_app
+
+app = create_app()